@@ -0,0 +1,71 @@
+"""Compare the scraper's extractors on pages the size of IANA's.
+
+The root zone database page is simulated by repeating the rows of the test
+fixture until there are as many as there are zones, and the zone pages by
+padding the test fragment out with the sort of boilerplate a real page has.
+
+Run with `python benchmarks/extract.py`.
+"""
+
+from os import path
+import re
+import timeit
+
+from uwhoisd import extract, scraper
+
+FIXTURES = path.join(path.dirname(__file__), "..", "tests")
+ZONES = 1500
+BOILERPLATE = "<div class='nav'><ul>" + "<li><a href='/x'>Navigation link</a></li>" * 100 + "</ul></div>"
+
+
+def read_fixture(name: str) -> str:
+    with open(path.join(FIXTURES, name), encoding="utf-8") as fh:
+        return fh.read()
+
+
+def make_root_zone_page() -> str:
+    html = read_fixture("iana-root-zone.html")
+    head, rest = html.split("<tbody>", 1)
+    rows, tail = rest.split("</tbody>", 1)
+    rows = re.findall(r"<tr>.*?</tr>", rows, re.DOTALL)
+    generated = [rows[i % len(rows)].replace(".html", f"{i}.html") for i in range(ZONES)]
+    return head + "<tbody>" + "".join(generated) + "</tbody>" + tail
+
+
+def make_zone_page() -> str:
+    html = read_fixture("zone-info-fragment.html")
+    return html.replace("<body>", "<body>" + BOILERPLATE).replace("</body>", BOILERPLATE + "</body>")
+
+
+def bench(name: str, func, number: int) -> float:
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<40} {best * 1000:8.3f} ms")
+    return best
+
+
+def main() -> None:
+    root = make_root_zone_page()
+    zone = make_zone_page()
+    if list(scraper.soup_zone_urls("http://example.com", root)) != list(
+        scraper.stream_zone_urls("http://example.com", root)
+    ):
+        raise SystemExit("The extractors disagree on the root zone page")
+    if scraper.soup_whois_server(zone) != extract.whois_server(zone):
+        raise SystemExit("The extractors disagree on the zone page")
+
+    for kind, html, number in (("root zone page", root, 5), ("zone page", zone, 200)):
+        print(f"{kind}: {len(html)} bytes")
+        soup = bench("  soup", lambda html=html, kind=kind: run("soup", kind, html), number)
+        stream = bench("  stream", lambda html=html, kind=kind: run("stream", kind, html), number)
+        print(f"  speedup: {soup / stream:.1f}x")
+
+
+def run(extractor: str, kind: str, html: str) -> None:
+    if kind == "zone page":
+        scraper.EXTRACTORS[extractor].whois_server(html)
+    else:
+        list(scraper.EXTRACTORS[extractor].zone_urls("http://example.com", html))
+
+
+if __name__ == "__main__":
+    main()
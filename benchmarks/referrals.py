@@ -0,0 +1,79 @@
+"""Compare scanning thin registries' responses in full and by their heads.
+
+The full scan decodes the whole response and searches it for the registrar's
+WHOIS server; the windowed one scans only the head, as it arrives.
+
+Besides the real transcript, there's one padded out with a megabyte of notices
+after the referral, as some registries send, and a hostile one: a megabyte on
+a single line with no referral at all.
+
+Run with `python benchmarks/referrals.py`.
+"""
+
+from os import path
+import re
+import timeit
+import typing as t
+
+from uwhoisd import client, routing, utils
+
+HERE = path.dirname(__file__)
+CHUNK_SIZE = 4096
+PADDING = 1024 * 1024
+
+
+def read_transcript(name: str) -> bytes:
+    with open(path.join(HERE, "..", "tests", "transcripts", name), "rb") as fh:
+        return fh.read()
+
+
+def chunked(data: bytes) -> list[bytes]:
+    return [data[i : i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+def full(pattern: re.Pattern, chunks: list[bytes]) -> t.Optional[str]:
+    matches = pattern.search(client.decode(b"".join(chunks)))
+    return None if matches is None else matches.group("server")
+
+
+def windowed(pattern: re.Pattern, chunks: list[bytes]) -> t.Optional[str]:
+    scanner = routing.ReferralScanner(pattern)
+    for chunk in chunks:
+        scanner.feed(chunk)
+    matches = scanner.close()
+    return None if matches is None else matches.group("server")
+
+
+def bench(name: str, func, number: int) -> float:
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<40} {best * 1000:8.3f} ms")
+    return best
+
+
+def count_patterns() -> None:
+    parser = utils.make_config_parser(path.join(HERE, "..", "extra", "uwhoisd.ini"))
+    patterns = parser.items("recursion_patterns")
+    print(f"recursion patterns: {len(patterns)} zones, {len({pattern for _, pattern in patterns})} distinct")
+
+
+def main() -> None:
+    count_patterns()
+    pattern = re.compile(r"Whois Server: ?(?P<server>[\-a-z0-9.]+)", re.IGNORECASE)
+    transcript = read_transcript("google.com.txt")
+    responses = (
+        ("google.com", transcript, "whois.markmonitor.com", 2000),
+        ("padded", transcript + b"NOTICE: boilerplate.\r\n" * (PADDING // 22), "whois.markmonitor.com", 20),
+        ("hostile", b"A" * PADDING, None, 20),
+    )
+    for kind, data, expected, number in responses:
+        chunks = chunked(data)
+        if full(pattern, chunks) != expected or windowed(pattern, chunks) != expected:
+            raise SystemExit(f"The scanners disagree on the {kind} response")
+        print(f"{kind}: {len(data)} bytes")
+        before = bench("  full", lambda chunks=chunks: full(pattern, chunks), number)
+        after = bench("  windowed", lambda chunks=chunks: windowed(pattern, chunks), number)
+        print(f"  speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,18 @@
 import asyncio
 import configparser
 import contextlib
+import functools
 import logging
 import logging.config
 import os.path
 import re
+import signal
 import socket
 import sys
+import time
 import typing as t
 
-from . import caching, client, server, utils
+from . import caching, client, health, metrics, networks, resolver, rl, routing, server, snapshot, utils, workers
 
 USAGE = "Usage: %s <config>"
 
@@ -19,18 +22,149 @@ PORT = socket.getservbyname("whois", "tcp")
 
 logger = logging.getLogger(__name__)
 
+UPSTREAM_DURATION = metrics.histogram(
+    "uwhoisd_upstream_duration_seconds",
+    "Time taken by queries to upstream WHOIS servers, by zone, server, and outcome.",
+    ("zone", "server", "outcome"),
+)
+# Labels zones and servers that aren't in the routing tables in the metrics.
+# Clients can make up any number of those, and each would be a new series.
+OTHER = "other"
+RELOADS = metrics.counter(
+    "uwhoisd_config_reloads_total",
+    "Reloads of the routing tables, by whether they succeeded.",
+    ("result",),
+)
+REFERRALS = metrics.counter(
+    "uwhoisd_referral_lookups_total",
+    "Lookups of cached referrals from registries to registrar WHOIS servers, by whether they were hits.",
+    ("result",),
+)
+
+
+@contextlib.contextmanager
+def observe_upstream(zone: str, server: str) -> t.Iterator[None]:
+    """Record how long a query to an upstream WHOIS server took and how it went.
+
+    Args:
+        zone: The zone being queried.
+        server: The upstream WHOIS server.
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        raise
+    except rl.RateLimitedError:
+        outcome = "rate_limited"
+        raise
+    except health.UnavailableError:
+        outcome = "unavailable"
+        raise
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = "cancelled"
+        raise
+    finally:
+        UPSTREAM_DURATION.observe(time.perf_counter() - start, (zone, server, outcome))
+
+
+class RoutingTables(t.NamedTuple):
+    """Everything needed to route queries, as read from the configuration.
+
+    Attributes:
+        suffix: Hostname suffix for zones without a server override.
+        conservative: Zones under which every name is to be queried against
+            the zone itself.
+        overrides: Maps zones onto their WHOIS servers.
+        prefixes: Maps zones onto query prefixes.
+        recursion_patterns: Maps thin zones onto the patterns for extracting
+            registrar WHOIS servers.
+        router: The router built from the tables.
+    """
+
+    suffix: str
+    conservative: t.Sequence[str]
+    overrides: dict[str, str]
+    prefixes: dict[str, str]
+    recursion_patterns: dict[str, re.Pattern]
+    router: routing.Router
+
+
+def read_routing_tables(parser: utils.ConfigParser, routes: t.Optional[snapshot.Routes] = None) -> RoutingTables:
+    """Read the routing tables from the configuration and build a router.
+
+    Args:
+        parser: The config parser to read from.
+        routes: The routing tables, if they've been read already, such as
+            from a routing snapshot.
+
+    Returns:
+        The routing tables.
+    """
+    suffix = parser.get("uwhoisd", "suffix")
+    conservative = parser.get_list("uwhoisd", "conservative")
+    if routes is None:
+        routes = snapshot.get_routes(parser)
+    # Many zones share a pattern, so each distinct pattern's compiled once.
+    compiled: dict[str, re.Pattern] = {}
+    recursion_patterns = {}
+    for zone, pattern in routes.recursion_patterns.items():
+        if pattern not in compiled:
+            compiled[pattern] = re.compile(pattern, re.IGNORECASE)
+        recursion_patterns[zone] = compiled[pattern]
+    router = routing.Router.build(
+        suffix,
+        PORT,
+        routes.overrides,
+        routes.prefixes,
+        recursion_patterns,
+        conservative,
+        routes.assignments,
+        parser.get("addresses", "whois"),
+    )
+    return RoutingTables(
+        suffix,
+        conservative,
+        dict(routes.overrides),
+        dict(routes.prefixes),
+        recursion_patterns,
+        router,
+    )
+
+
+def load_routing_tables(config_path: str) -> RoutingTables:
+    """Read the configuration afresh and build a router from it.
+
+    Args:
+        config_path: The path to the main config file.
+
+    Returns:
+        The routing tables.
+    """
+    return read_routing_tables(*snapshot.read_config(config_path))
+
 
 class UWhois:
     """Universal WHOIS proxy."""
 
     __slots__ = (
         "conservative",
+        "health",
+        "limiter",
         "overrides",
         "page_feed",
         "prefixes",
         "recursion_patterns",
+        "referral_window",
+        "referrals",
         "registry_whois",
+        "resolver",
+        "router",
         "suffix",
+        "timeouts",
     )
 
     def __init__(self) -> None:
@@ -42,23 +176,73 @@ class UWhois:
         self.registry_whois: bool = False
         self.page_feed: bool = True
         self.conservative: t.Sequence[str] = ()
-
-    def read_config(self, parser: utils.ConfigParser) -> None:
+        self.referral_window = routing.REFERRAL_WINDOW
+        self.router = routing.Router(None, PORT)
+        self.limiter = rl.UpstreamLimiter()
+        self.health = health.HealthTracker()
+        self.resolver = resolver.Resolver()
+        self.referrals: t.Optional[caching.LRU] = None
+        self.timeouts: dict[str, client.Timeouts] = {}
+
+    def read_config(
+        self,
+        parser: utils.ConfigParser,
+        routes: t.Optional[snapshot.Routes] = None,
+        limit_share: int = 1,
+    ) -> None:
         """Read the configuration for this object from a config file.
 
         Args:
             parser: The config parser to read from.
+            routes: The routing tables, if they've been read already, such as
+                from a routing snapshot.
+            limit_share: How many ways to split the upstream limits, for when
+                several workers each enforce their own.
         """
         self.registry_whois = parser.get_bool("uwhoisd", "registry_whois")
         self.page_feed = parser.get_bool("uwhoisd", "page_feed")
-        self.suffix = parser.get("uwhoisd", "suffix")
-        self.conservative = parser.get_list("uwhoisd", "conservative")
+        self.referral_window = parser.getint("uwhoisd", "referral_window")
+        self.set_routing_tables(read_routing_tables(parser, routes))
+
+        self.limiter = rl.UpstreamLimiter(
+            {
+                name: rl.partition_limits(rl.parse_limits(value), limit_share)
+                for name, value in parser.get_section_dict("upstream_limits").items()
+            }
+        )
+        self.health = health.get_health_tracker(dict(parser.items("health")))
+        self.resolver = resolver.Resolver(**dict(parser.items("resolver")))  # type: ignore[arg-type]
+
+        timeouts = parser.get_section_dict("timeouts")
+        default = client.parse_timeouts(timeouts.pop("default", ""))
+        self.timeouts = {zone: client.parse_timeouts(value, default) for zone, value in timeouts.items()}
+        self.timeouts["default"] = default
+
+        max_age = parser.getint("referrals", "max_age")
+        if max_age > 0:
+            self.referrals = caching.LRU(max_size=parser.getint("referrals", "max_size"), max_age=max_age)
+
+    def set_routing_tables(self, tables: RoutingTables) -> routing.Router:
+        """Swap in new routing tables.
+
+        Nothing here waits, so no query ever sees a mix of the old and new
+        tables. Queries already under way hold on to the route they started
+        with, so finish on the old tables.
 
-        for section in ("overrides", "prefixes"):
-            setattr(self, section, parser.get_section_dict(section))
+        Args:
+            tables: The new routing tables.
 
-        for zone, pattern in parser.items("recursion_patterns"):
-            self.recursion_patterns[zone] = re.compile(utils.decode_value(pattern), re.IGNORECASE)
+        Returns:
+            The router being replaced.
+        """
+        old = self.router
+        self.suffix = tables.suffix
+        self.conservative = tables.conservative
+        self.overrides = tables.overrides
+        self.prefixes = tables.prefixes
+        self.recursion_patterns = tables.recursion_patterns
+        self.router = tables.router
+        return old
 
     def get_whois_server(self, zone: str) -> tuple[str, int]:
         """Get the WHOIS server for the given zone.
@@ -69,11 +253,8 @@ class UWhois:
         Returns:
             A tuple of the WHOIS server and port.
         """
-        server = self.overrides.get(zone, f"{zone}.{self.suffix}")
-        if ":" in server:
-            server, port = server.split(":", 1)
-            return server, int(port)
-        return server, PORT
+        route = self.router.route_zone(zone)
+        return route.server, route.port
 
     def get_registrar_whois_server(self, zone: str, response: str) -> t.Optional[str]:
         """Extract the registrar's WHOIS server from the registry response.
@@ -85,9 +266,25 @@ class UWhois:
         Returns:
             The registrar's WHOIS server, or None if not found.
         """
-        matches = self.recursion_patterns[zone].search(response)
+        scanner = routing.ReferralScanner(self.recursion_patterns[zone], self.referral_window)
+        scanner.feed(response.encode())
+        matches = scanner.close()
         return None if matches is None else matches.group("server")
 
+    def get_timeouts(self, zone: str) -> client.Timeouts:
+        """Get the timeouts for querying the given zone.
+
+        Args:
+            zone: The zone being queried.
+
+        Returns:
+            The timeouts.
+        """
+        timeouts = self.timeouts.get(zone)
+        if timeouts is None:
+            timeouts = self.timeouts.get("default", client.DEFAULT_TIMEOUTS)
+        return timeouts
+
     def get_prefix(self, zone: str) -> str:
         """Get the prefix required when querying the servers for the given zone.
 
@@ -97,7 +294,7 @@ class UWhois:
         Returns:
             The prefix string.
         """
-        return self.prefixes.get(zone, "")
+        return self.router.route_zone(zone).prefix
 
     async def whois(self, query: str) -> str:
         """Query the appropriate WHOIS server.
@@ -108,31 +305,484 @@ class UWhois:
         Returns:
             The WHOIS response.
         """
+        chunks = [chunk async for chunk in self.stream(query)]
+        return client.decode(b"".join(chunks))
+
+    async def stream(self, query: str) -> t.AsyncIterator[bytes]:
+        """Query the appropriate WHOIS server, yielding the response as it arrives.
+
+        Responses are passed through as they're received without being
+        decoded. The exception is a thin registry's response, which has to be
+        read in full to find the registrar's WHOIS server, and is held back
+        entirely if it's not to be included.
+
+        If the registry's response isn't to be included and the registrar's
+        WHOIS server for the name is already known from an earlier query, the
+        registry is skipped entirely, unless the registrar no longer knows the
+        name, in which case the registry is asked after all.
+
+        The whole query, however many servers it takes, has to be answered
+        within the zone's total timeout, with whatever time the registry
+        doesn't use left over for the registrar.
+
+        Args:
+            query: The WHOIS query.
+
+        Yields:
+            Chunks of the raw WHOIS response.
+        """
         # Figure out the zone whose WHOIS server we're meant to be querying.
-        for zone in self.conservative:
-            if query.endswith(f".{zone}"):
-                break
-        else:
-            _, zone = utils.split_fqdn(query)
+        route = self.router.route(query)
+        deadline = client.Deadline(self.get_timeouts(route.zone).total)
+
+        registrar_server = self.get_referral(route, query)
+        if registrar_server is not None:
+            logger.info("Using cached referral to %s about %s", registrar_server, query)
+            response = await self.query_referred(route, registrar_server, query, deadline)
+            if response is not None:
+                yield response
+                return
 
         # Query the registry's WHOIS server.
-        server, port = self.get_whois_server(zone)
-        logger.info("Querying %s about %s", server, query)
-        response = await client.query_whois(server, port, self.get_prefix(zone) + query)
+        if route.pattern is None:
+            async for chunk in self.query_registry(route, query, deadline):
+                yield chunk
+            return
 
         # Thin registry? Query the registrar's WHOIS server.
-        if zone in self.recursion_patterns:
-            registrar_server = self.get_registrar_whois_server(zone, response)
-            if registrar_server is not None:
-                if not self.registry_whois:
-                    response = ""
-                elif self.page_feed:
-                    # A form feed character so it's possible to find the split.
-                    response += "\f"
-                logger.info("Recursive query to %s about %s", registrar_server, query)
-                response += await client.query_whois(registrar_server, port, query)
+        chunks: list[bytes] = []
+        scanner = routing.ReferralScanner(route.pattern, self.referral_window)
+        async for chunk in self.query_registry(route, query, deadline, chunks, scanner):
+            yield chunk
+        matches = scanner.close()
+        if matches is None:
+            if not self.registry_whois:
+                yield b"".join(chunks)
+            return
+        if self.registry_whois and self.page_feed:
+            # A form feed character so it's possible to find the split.
+            yield b"\f"
+        registrar_server = matches.group("server")
+        self.set_referral(query, registrar_server)
+        logger.info("Recursive query to %s about %s", registrar_server, query)
+        async for chunk in self.query_registrar(route, registrar_server, query, deadline):
+            yield chunk
+
+    async def query_registry(
+        self,
+        route: routing.Route,
+        query: str,
+        deadline: client.Deadline,
+        chunks: t.Optional[list[bytes]] = None,
+        scanner: t.Optional[routing.ReferralScanner] = None,
+    ) -> t.AsyncIterator[bytes]:
+        """Query a registry's WHOIS server.
+
+        Args:
+            route: The route for the query.
+            query: The WHOIS query.
+            deadline: The deadline for the query.
+            chunks: If the registry's thin, the response is collected here, and
+                only passed on if the registry's response is wanted. Once the
+                registrar's WHOIS server is found, there's no need to keep
+                collecting it.
+            scanner: If the registry's thin, what looks for the registrar's
+                WHOIS server in the response as it arrives.
+
+        Yields:
+            Chunks of the raw WHOIS response.
+        """
+        logger.info("Querying %s about %s", route.server, query)
+        async for chunk in self.query_upstream(
+            route.zone,
+            route.server,
+            route.port,
+            route.prefix + query,
+            deadline,
+            limit_zone=route.zone,
+        ):
+            if scanner is None or self.registry_whois:
+                yield chunk
+            if scanner is None:
+                continue
+            if scanner.feed(chunk) is None and chunks is not None and not self.registry_whois:
+                chunks.append(chunk)
+
+    def get_referral(self, route: routing.Route, query: str) -> t.Optional[str]:
+        """Look up the registrar's WHOIS server for a name, if it's known.
+
+        Cached referrals are only used if the registry's response isn't
+        wanted, as otherwise the registry has to be queried anyway.
+
+        Args:
+            route: The route for the query.
+            query: The WHOIS query.
 
-        return response
+        Returns:
+            The registrar's WHOIS server, or `None` if it isn't known or
+            isn't to be used.
+        """
+        if self.referrals is None or route.pattern is None or self.registry_whois:
+            return None
+        registrar_server = self.referrals.get(query)
+        REFERRALS.inc(("miss" if registrar_server is None else "hit",))
+        return registrar_server
+
+    def set_referral(self, query: str, registrar_server: t.Optional[str]) -> None:
+        """Remember the registrar's WHOIS server for a name.
+
+        Args:
+            query: The WHOIS query.
+            registrar_server: The registrar's WHOIS server, or `None` to
+                forget it.
+        """
+        if self.referrals is None:
+            return
+        if registrar_server is None:
+            self.referrals.discard(query)
+        else:
+            self.referrals.set(query, registrar_server)
+
+    async def query_registrar(
+        self,
+        route: routing.Route,
+        registrar_server: str,
+        query: str,
+        deadline: client.Deadline,
+        *,
+        referred: bool = False,
+    ) -> t.AsyncIterator[bytes]:
+        """Query a registrar's WHOIS server.
+
+        Args:
+            route: The route for the query.
+            registrar_server: The registrar's WHOIS server.
+            query: The WHOIS query.
+            deadline: The deadline for the query.
+            referred: Whether the registrar's WHOIS server came from a cached
+                referral, which is to be forgotten if the query fails.
+
+        Yields:
+            Chunks of the raw WHOIS response.
+        """
+        try:
+            async for chunk in self.query_upstream(route.zone, registrar_server, route.port, query, deadline):
+                yield chunk
+        except Exception:
+            if referred:
+                # The registrar might have changed, so check with the
+                # registry next time.
+                self.set_referral(query, None)
+            raise
+
+    async def query_referred(
+        self,
+        route: routing.Route,
+        registrar_server: str,
+        query: str,
+        deadline: client.Deadline,
+    ) -> t.Optional[bytes]:
+        """Query the registrar's WHOIS server given by a cached referral.
+
+        The response is read in full, as if the registrar says it doesn't know
+        the name, it may have moved to another registrar since the referral
+        was cached, in which case the referral is forgotten so the registry
+        can be asked instead.
+
+        Args:
+            route: The route for the query.
+            registrar_server: The registrar's WHOIS server.
+            query: The WHOIS query.
+            deadline: The deadline for the query.
+
+        Returns:
+            The raw WHOIS response, or `None` if the registrar doesn't know
+            the name.
+        """
+        chunks = [
+            chunk async for chunk in self.query_registrar(route, registrar_server, query, deadline, referred=True)
+        ]
+        response = b"".join(chunks)
+        if caching.classify(client.decode(response)) != caching.NOT_FOUND:
+            return response
+        logger.info("%s no longer knows about %s, so asking the registry", registrar_server, query)
+        self.set_referral(query, None)
+        return None
+
+    async def query_upstream(
+        self,
+        zone: str,
+        server: str,
+        port: int,
+        query: str,
+        deadline: client.Deadline,
+        limit_zone: t.Optional[str] = None,
+    ) -> t.AsyncIterator[bytes]:
+        """Query an upstream WHOIS server, within its limits and if it's healthy.
+
+        Args:
+            zone: The zone being queried.
+            server: The WHOIS server hostname.
+            port: The WHOIS server port.
+            query: The WHOIS query, including any prefix.
+            deadline: The deadline for the query.
+            limit_zone: The zone to look up the upstream's limits by, if any.
+
+        Yields:
+            Chunks of the raw WHOIS response.
+
+        Raises:
+            health.UnavailableError: If the upstream's unhealthy.
+        """
+        timeouts = self.get_timeouts(zone)
+        with observe_upstream(
+            zone if zone in self.router.zones else OTHER,
+            server if server in self.router.servers else OTHER,
+        ):
+            # Fail fast rather than wait on the limits only to fail anyway.
+            self.health.check(server, port)
+            async with self.limiter.slot(server, limit_zone, deadline.limit(timeouts.total)):
+                with self.health.track(server, port):
+                    async for chunk in client.stream_whois(server, port, query, self.resolver, timeouts, deadline):
+                        yield chunk
+
+
+async def run_services(*services: t.Awaitable[None]) -> None:
+    """Run several services together until they all finish, or until SIGTERM.
+
+    Stopping on SIGTERM rather than dying outright gives the caller the chance
+    to clean up, such as finishing the cache's queued writes.
+
+    Args:
+        services: The services to run.
+    """
+    loop = asyncio.get_running_loop()
+    running = asyncio.ensure_future(asyncio.gather(*services))
+    stopped = False
+
+    def stop() -> None:
+        nonlocal stopped
+        stopped = True
+        running.cancel()
+
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    try:
+        await running
+    except asyncio.CancelledError:
+        if not stopped:
+            raise
+        logger.info("Stopping")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+
+
+async def reload_routing_tables(config_path: str, uwhois: UWhois, caches: t.Iterable[object]) -> bool:
+    """Re-read the routing tables and swap them in.
+
+    The configuration is read and the new router built in a thread, so
+    queries carry on being answered in the meantime. Once the new tables are
+    in place, anything cached for a query that'd now be routed differently
+    is dropped, and everything else is kept. Failing to drop them is logged,
+    but doesn't undo the reload.
+
+    Args:
+        config_path: The path to the main config file.
+        uwhois: The WHOIS proxy whose routing tables are to be replaced.
+        caches: Caches keyed by query to drop stale entries from. Any that
+            can't be invalidated selectively are left alone.
+
+    Returns:
+        `True` if the routing tables were replaced.
+    """
+    logger.info("Reloading routing tables from '%s'", config_path)
+    start = time.perf_counter()
+    try:
+        tables = await asyncio.get_running_loop().run_in_executor(None, load_routing_tables, config_path)
+    except (configparser.Error, OSError, ValueError, re.error):
+        logger.exception("Could not reload config file; keeping the current routing tables")
+        RELOADS.inc(("failed",))
+        return False
+    old = uwhois.set_routing_tables(tables)
+
+    def stale(query: str) -> bool:
+        return old.route(query) != tables.router.route(query)
+
+    RELOADS.inc(("ok",))
+    dropped = 0
+    for cache in caches:
+        if not isinstance(cache, caching.Invalidatable):
+            continue
+        try:
+            dropped += await cache.invalidate(stale)
+        except Exception:
+            # The new tables are in place regardless, so carry on serving. The
+            # stale entries will expire in their own time.
+            logger.exception("Could not drop cached entries for rerouted queries from %r", cache)
+    logger.info(
+        "Reloaded routing tables in %.3fs; dropped %d cached entries for rerouted queries",
+        time.perf_counter() - start,
+        dropped,
+    )
+    return True
+
+
+async def handle_reloads(config_path: str, uwhois: UWhois, caches: t.Sequence[object]) -> None:
+    """Reload the routing tables whenever the process gets a SIGHUP.
+
+    Any SIGHUPs that arrive during a reload lead to a single reload once
+    it's finished. A reload failing is logged, and the server carries on.
+
+    Args:
+        config_path: The path to the main config file.
+        uwhois: The WHOIS proxy whose routing tables are to be replaced.
+        caches: Caches keyed by query to drop stale entries from.
+    """
+    loop = asyncio.get_running_loop()
+    requested = asyncio.Event()
+    loop.add_signal_handler(signal.SIGHUP, requested.set)
+    try:
+        while True:
+            await requested.wait()
+            requested.clear()
+            try:
+                await reload_routing_tables(config_path, uwhois, caches)
+            except Exception:
+                # A reload going wrong mustn't take the server down with it.
+                logger.exception("Reloading the routing tables failed")
+                RELOADS.inc(("failed",))
+    finally:
+        loop.remove_signal_handler(signal.SIGHUP)
+
+
+def register_health_metrics(tracker: health.HealthTracker) -> None:
+    """Expose the health of the upstream WHOIS servers as metrics.
+
+    Args:
+        tracker: The upstream health tracker.
+    """
+    metrics.REGISTRY.register(
+        metrics.Callback(
+            "uwhoisd_upstream_breaker_state",
+            "Whether each upstream's circuit breaker is in the given state.",
+            ("upstream", "state"),
+            tracker.collect,
+        )
+    )
+    metrics.REGISTRY.register(
+        metrics.Callback(
+            "uwhoisd_upstream_success_rate",
+            "Moving average of the proportion of queries to each upstream that succeed.",
+            ("upstream",),
+            tracker.collect_success_rates,
+        )
+    )
+    metrics.REGISTRY.register(
+        metrics.Callback(
+            "uwhoisd_upstream_latency_seconds",
+            "Moving average of the latency of queries to each upstream.",
+            ("upstream",),
+            tracker.collect_latencies,
+        )
+    )
+
+
+def serve(
+    parser: utils.ConfigParser,
+    uwhois: UWhois,
+    sock: t.Optional[socket.socket] = None,
+    cache_share: int = 1,
+    worker: int = 0,
+    *,
+    http_sock: t.Optional[socket.socket] = None,
+    config_path: t.Optional[str] = None,
+    limit_share: int = 1,
+) -> int:
+    """Run the service in this process.
+
+    Args:
+        parser: The config parser to read from.
+        uwhois: The configured WHOIS proxy.
+        sock: A listening socket to serve on, if already bound.
+        cache_share: How many ways to split the cache's size limits, for when
+            several workers each have their own cache.
+        worker: The index of this worker process. Each worker serves its own
+            metrics, on the configured metrics port plus this index.
+        http_sock: A listening socket to serve the HTTP API on, if already
+            bound.
+        config_path: The path to the main config file, to reload the
+            routing tables from on SIGHUP, if any.
+        limit_share: How many ways to split the per-client rate limits, for
+            when several workers each enforce their own.
+
+    Returns:
+        The exit status.
+    """
+    try:
+        iface = parser.get("uwhoisd", "iface")
+        port = parser.getint("uwhoisd", "port")
+        reuse_port = parser.get_bool("uwhoisd", "reuse_port")
+        metrics_iface = parser.get("metrics", "iface")
+        metrics_port = parser.getint("metrics", "port")
+        http_iface = parser.get("http", "iface")
+        http_port = parser.getint("http", "port")
+        http_options = server.get_http_options(dict(parser.items("http")))
+
+        cache = caching.get_cache(caching.partition_config(dict(parser.items("cache")), cache_share))
+        policy = caching.get_ttl_policy(dict(parser.items("negative_cache")))
+        refresher = caching.get_refresher(dict(parser.items("refresh")))
+        keys = networks.get_covering_prefixes(dict(parser.items("addresses")))
+        stats = caching.Stats()
+        whois = caching.wrap_whois(cache, uwhois.whois, stats, policy, refresher, keys)
+        stream = None
+        if parser.get_bool("uwhoisd", "stream"):
+            stream = caching.wrap_whois_stream(cache, uwhois.stream, stats, policy, refresher, keys)
+
+        limiter = rl.get_client_limiter(rl.partition_client_config(dict(parser.items("client_limits")), limit_share))
+        sessions = None
+        max_session_queries = parser.getint("uwhoisd", "session_max_queries")
+        if max_session_queries > 0:
+            sessions = server.Sessions(max_session_queries, parser.getfloat("uwhoisd", "session_idle_timeout"))
+    except configparser.Error:
+        logger.exception("Could not parse config file")
+        return 1
+
+    services = [
+        server.start_service(iface, port, whois, limiter, stream, sock=sock, reuse_port=reuse_port, sessions=sessions)
+    ]
+    if http_port > 0 or http_sock is not None:
+        services.append(
+            server.start_http_service(
+                http_iface, http_port, whois, limiter, http_options, sock=http_sock, reuse_port=reuse_port
+            )
+        )
+    if config_path is not None:
+        services.append(handle_reloads(config_path, uwhois, (cache, policy, uwhois.referrals)))
+    if metrics_port > 0:
+        # Not every cache can say how big it is.
+        if isinstance(cache, t.Sized):
+            metrics.REGISTRY.register(
+                metrics.Callback("uwhoisd_cache_entries", "Entries in the cache.", (), lambda: {(): len(cache)})
+            )
+        metrics.REGISTRY.register(
+            metrics.Callback(
+                "uwhoisd_resolver_entries",
+                "Hosts in the resolver's cache.",
+                (),
+                lambda: {(): len(uwhois.resolver.cache)},
+            )
+        )
+        register_health_metrics(uwhois.health)
+        services.append(metrics.start_service(metrics_iface, metrics_port + worker))
+
+    try:
+        asyncio.run(run_services(*services))
+    finally:
+        if isinstance(cache, caching.Closable):
+            cache.close()
+        logger.info("Cache statistics: %r", stats)
+        logger.info("Resolver statistics: %r", uwhois.resolver)
+        logger.info("Upstream health: %r", uwhois.health)
+    return 0
 
 
 def main() -> int:
@@ -145,23 +795,48 @@ def main() -> int:
 
     try:
         logger.info("Reading config file at '%s'", sys.argv[1])
-        parser = utils.make_config_parser(sys.argv[1])
+        parser, routes = snapshot.read_config(sys.argv[1])
 
         iface = parser.get("uwhoisd", "iface")
         port = parser.getint("uwhoisd", "port")
         logger.info("Listen on %s:%d", iface, port)
 
+        worker_count = parser.getint("uwhoisd", "workers")
+        # Each worker enforces the limits on its own, so each gets its share.
+        limit_share = max(1, worker_count)
+
         uwhois = UWhois()
-        uwhois.read_config(parser)
+        uwhois.read_config(parser, routes, limit_share)
 
-        cache = caching.get_cache(dict(parser.items("cache")))
-        whois = caching.wrap_whois(cache, uwhois.whois)
+        reuse_port = parser.get_bool("uwhoisd", "reuse_port")
+        cache_share = worker_count if parser.get_bool("uwhoisd", "partition_cache") else 1
+        http_iface = parser.get("http", "iface")
+        http_port = parser.getint("http", "port")
     except configparser.Error:
         logger.exception("Could not parse config file")
         return 1
-    else:
-        asyncio.run(server.start_service(iface, port, whois))
-        return 0
+
+    if worker_count <= 1:
+        return serve(parser, uwhois, config_path=sys.argv[1])
+
+    # Without SO_REUSEPORT, the workers all accept connections on a socket
+    # bound before they're forked.
+    sock = None if reuse_port else workers.bind(iface, port)
+    http_sock = None
+    if not reuse_port and http_port > 0:
+        http_sock = workers.bind(http_iface, http_port)
+    logger.info("Starting %d workers", worker_count)
+    target = functools.partial(
+        serve,
+        parser,
+        uwhois,
+        sock,
+        cache_share,
+        http_sock=http_sock,
+        config_path=sys.argv[1],
+        limit_share=limit_share,
+    )
+    return workers.Supervisor(worker_count, target).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,330 @@
+"""Bulk WHOIS lookups, with the results written out as NDJSON."""
+
+import argparse
+import asyncio
+import collections
+import configparser
+import itertools
+import json
+import logging
+import sys
+import typing as t
+
+from . import UWhois, caching, health, networks, rl, utils
+
+logger = logging.getLogger(__name__)
+
+# A lookup's result, as written out.
+Result = dict[str, str]
+
+# How many lines to read from the input at a time.
+READ_CHUNK = 256
+
+
+class Batch:
+    """A batch of queries, scheduled fairly across their upstream servers.
+
+    Queries are queued by the WHOIS server they're routed to, and each time a
+    query can be started, the queues are taken in turn, so a batch made up
+    mostly of names under one zone doesn't hold up the rest, and no single
+    upstream has more than `per_upstream` of the batch's queries at a time.
+    A query appearing more than once in the batch is only looked up once.
+
+    Args:
+        route: Called with a query to get the upstream it's routed to.
+        concurrency: The most queries to have in flight at once.
+        per_upstream: The most queries to have in flight against any one
+            upstream at once.
+        lookahead: The most queries to take from the input ahead of their
+            being started, when the input is fed in while the batch runs.
+    """
+
+    __slots__ = (
+        "active",
+        "concurrency",
+        "lookahead",
+        "per_upstream",
+        "queues",
+        "route",
+        "seen",
+    )
+
+    def __init__(
+        self,
+        route: t.Callable[[str], str],
+        concurrency: int = 32,
+        per_upstream: int = 4,
+        lookahead: int = 1024,
+    ) -> None:
+        super().__init__()
+        self.route = route
+        self.concurrency = max(1, concurrency)
+        self.per_upstream = max(1, per_upstream)
+        self.lookahead = max(1, lookahead)
+        # An ordered dict so the upstreams can be rotated through.
+        self.queues: collections.OrderedDict[str, collections.deque[str]] = collections.OrderedDict()
+        self.active: collections.Counter[str] = collections.Counter()
+        self.seen: set[str] = set()
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def add(self, query: str) -> bool:
+        """Queue up a query, unless it's already part of the batch.
+
+        Args:
+            query: The cleaned up query.
+
+        Returns:
+            `True` if the query was queued.
+        """
+        if query in self.seen:
+            return False
+        self.seen.add(query)
+        upstream = self.route(query) if utils.is_well_formed_query(query) else ""
+        queue = self.queues.get(upstream)
+        if queue is None:
+            queue = self.queues[upstream] = collections.deque()
+        queue.append(query)
+        return True
+
+    def next(self) -> t.Optional[tuple[str, str]]:
+        """Take the next query to start.
+
+        Returns:
+            The query and its upstream, or `None` if every upstream with any
+            queries left is already busy with as many as it's allowed.
+        """
+        for upstream, queue in self.queues.items():
+            if self.active[upstream] < self.per_upstream:
+                query = queue.popleft()
+                if queue:
+                    self.queues.move_to_end(upstream)
+                else:
+                    del self.queues[upstream]
+                self.active[upstream] += 1
+                return query, upstream
+        return None
+
+    async def lookup(self, whois: t.Callable[[str], t.Awaitable[str]], query: str, upstream: str) -> Result:
+        """Look up a query.
+
+        Args:
+            whois: The WHOIS query function to use.
+            query: The cleaned up query.
+            upstream: The upstream the query is routed to.
+
+        Returns:
+            The result, with the response if the lookup succeeded, and the
+            reason it didn't otherwise.
+        """
+        try:
+            if not upstream:
+                return {"query": query, "error": "Bad query"}
+            return {"query": query, "response": await whois(query)}
+        except asyncio.TimeoutError:
+            return {"query": query, "error": "Timeout from upstream server"}
+        except (rl.RateLimitedError, health.UnavailableError) as exc:
+            return {"query": query, "error": str(exc)}
+        except (OSError, ValueError) as exc:
+            logger.warning("Lookup of '%s' failed: %r", query, exc)
+            return {"query": query, "error": str(exc) or type(exc).__name__}
+        finally:
+            self.active[upstream] -= 1
+
+    async def run(
+        self,
+        whois: t.Callable[[str], t.Awaitable[str]],
+        queries: t.Optional[asyncio.Queue[t.Optional[str]]] = None,
+    ) -> t.AsyncIterator[Result]:
+        """Look up every query in the batch.
+
+        Args:
+            whois: The WHOIS query function to use.
+            queries: Further queries to add to the batch as it runs, up to
+                `lookahead` at a time, ending with `None`.
+
+        Yields:
+            The results, in the order the lookups complete.
+        """
+        pending: set[asyncio.Future[Result]] = set()
+        more: t.Optional[asyncio.Future[t.Optional[str]]] = None
+        try:
+            while True:
+                self.start(whois, pending)
+                if queries is not None and more is None and len(self) < self.lookahead:
+                    more = asyncio.ensure_future(queries.get())
+                if more is None and not pending:
+                    break
+                waiting: set[asyncio.Future[t.Any]] = {*pending} if more is None else {*pending, more}
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if more in done:
+                    query = more.result()
+                    more = None
+                    if query is None:
+                        queries = None
+                    else:
+                        self.add(query)
+                for future in pending & done:
+                    pending.discard(future)
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            if more is not None:
+                more.cancel()
+
+    def start(self, whois: t.Callable[[str], t.Awaitable[str]], pending: set[asyncio.Future[Result]]) -> None:
+        """Start as many queries as can be.
+
+        Args:
+            whois: The WHOIS query function to use.
+            pending: The lookups in flight, to add the new ones to.
+        """
+        while len(pending) < self.concurrency:
+            item = self.next()
+            if item is None:
+                break
+            pending.add(asyncio.ensure_future(self.lookup(whois, *item)))
+
+
+def read_queries(lines: t.Iterable[str]) -> t.Iterator[str]:
+    """Read queries, one per line, skipping blank lines and comments.
+
+    Args:
+        lines: The lines to read.
+
+    Yields:
+        The cleaned up queries.
+    """
+    for line in lines:
+        query = line.split("#", 1)[0].strip().lower()
+        if query:
+            yield query
+
+
+async def feed_queries(lines: t.Iterable[str], queries: asyncio.Queue[t.Optional[str]]) -> None:
+    """Read queries into a queue, a chunk at a time, ending with `None`.
+
+    The lines are read in a thread, so reading from a slow pipe doesn't hold
+    up the lookups.
+
+    Args:
+        lines: The lines to read.
+        queries: The queue to put the cleaned up queries on.
+    """
+    loop = asyncio.get_running_loop()
+    reader = read_queries(lines)
+    try:
+        while chunk := await loop.run_in_executor(None, list, itertools.islice(reader, READ_CHUNK)):
+            for query in chunk:
+                await queries.put(query)
+    except Exception:
+        # Don't leave the batch waiting for more: the rest is lost anyway.
+        while not queries.empty():
+            queries.get_nowait()
+        queries.put_nowait(None)
+        raise
+    await queries.put(None)
+
+
+async def run_batch(
+    batch: Batch,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    out: t.TextIO,
+    lines: t.Optional[t.Iterable[str]] = None,
+) -> int:
+    """Look up a batch of queries, writing the results out as NDJSON.
+
+    Args:
+        batch: The batch of queries.
+        whois: The WHOIS query function to use.
+        out: Where to write the results.
+        lines: Input to read further queries from, one per line, while the
+            batch runs.
+
+    Returns:
+        The number of lookups that failed.
+    """
+    if lines is None:
+        return await write_results(batch.run(whois), out)
+    queries: asyncio.Queue[t.Optional[str]] = asyncio.Queue(READ_CHUNK)
+    reader = asyncio.ensure_future(feed_queries(lines, queries))
+    try:
+        failed = await write_results(batch.run(whois, queries), out)
+    finally:
+        reader.cancel()
+    # Raise any error from reading the input.
+    await reader
+    return failed
+
+
+async def write_results(results: t.AsyncIterator[Result], out: t.TextIO) -> int:
+    """Write the results of lookups out as NDJSON.
+
+    Args:
+        results: The results.
+        out: Where to write the results.
+
+    Returns:
+        The number of lookups that failed.
+    """
+    failed = 0
+    async for result in results:
+        if "error" in result:
+            failed += 1
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+    return failed
+
+
+def make_arg_parser() -> argparse.ArgumentParser:
+    """Create the argument parser.
+
+    Returns:
+        The argument parser.
+    """
+    parser = argparse.ArgumentParser(description="Look up WHOIS records in bulk, writing them out as NDJSON.")
+    parser.add_argument("--config", help="uwhoisd configuration")
+    parser.add_argument("--concurrency", type=int, help="Most lookups to have in flight at once")
+    parser.add_argument("--per-upstream", type=int, help="Most lookups to have in flight per upstream server")
+    parser.add_argument(
+        "input",
+        nargs="?",
+        type=argparse.FileType("r"),
+        default=sys.stdin,
+        help="File of names to look up, one per line (default: stdin)",
+    )
+    return parser
+
+
+def main() -> int:
+    """Driver for bulk lookups."""
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    args = make_arg_parser().parse_args()
+
+    try:
+        parser = utils.make_config_parser(args.config)
+        uwhois = UWhois()
+        uwhois.read_config(parser)
+        concurrency = args.concurrency or parser.getint("bulk", "concurrency")
+        per_upstream = args.per_upstream or parser.getint("bulk", "per_upstream")
+        cache = caching.get_cache(dict(parser.items("cache")))
+        policy = caching.get_ttl_policy(dict(parser.items("negative_cache")))
+        keys = networks.get_covering_prefixes(dict(parser.items("addresses")))
+    except configparser.Error:
+        logger.exception("Could not parse config file")
+        return 1
+
+    batch = Batch(lambda query: uwhois.router.route(query).server, concurrency, per_upstream)
+    stats = caching.Stats()
+    whois = caching.wrap_whois(cache, uwhois.whois, stats, policy, keys=keys)
+
+    failed = asyncio.run(run_batch(batch, whois, sys.stdout, args.input))
+    logger.info("Done: looked up %d names, %d failed; cache statistics: %r", len(batch.seen), failed, stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,68 @@
 """Caching support."""
 
+import asyncio
 import collections
+import concurrent.futures
+import functools
 from importlib import metadata
 import logging
+import re
+import sqlite3
+import threading
 import time
 import typing as t
 
+from . import client, metrics
+
 logger = logging.getLogger(__name__)
 
+T = t.TypeVar("T")
+
+LOOKUP_DURATION = metrics.histogram(
+    "uwhoisd_lookup_duration_seconds",
+    "Time taken to look up queries, by whether they were cache hits, misses, or coalesced with another lookup.",
+    ("cache",),
+)
+EVICTIONS = metrics.counter(
+    "uwhoisd_cache_evictions_total",
+    "Entries evicted from the cache, by whether they expired, were pushed out to make room, or were invalidated.",
+    ("reason",),
+)
+REFRESHES = metrics.counter(
+    "uwhoisd_cache_refreshes_total",
+    "Cache entries refreshed in the background, by whether they'd gone stale or were hot and about to.",
+    ("reason",),
+)
+RESPONSES = metrics.counter(
+    "uwhoisd_upstream_responses_total",
+    "Upstream lookups, by what kind of response they got.",
+    ("class",),
+)
+
+# The kinds of response a lookup can get.
+FOUND = "found"
+NOT_FOUND = "not_found"
+RATE_LIMITED = "rate_limited"
+TIMEOUT = "timeout"
+
+# What registries say when a name isn't registered.
+NOT_FOUND_RESPONSE = re.compile(
+    r"^[%#\s]*(?:error:\d+:\s*)?"
+    r"(?:no match\b|not found\b|no entries found|no data found|no matching record|domain not found"
+    r"|(?:the queried )?object does not exist|status:\s*(?:free|available)\s*$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+# What registries say when they're rate limiting us. They say so in place of
+# a record, so only the first line counts, as records' terms of use often
+# mention rate limits too.
+RATE_LIMITED_RESPONSE = re.compile(
+    r"\A\s*[%#]?\s*(?:error:\d+:\s*)?[^\n]{0,60}?"
+    r"(?:limit exceeded|queries exceeded|quota exceeded|too many (?:requests|queries|connections)|rate limit)",
+    re.IGNORECASE,
+)
+# A field that only turns up in a record for a name.
+RECORD_FIELD = re.compile(r"^\s*domain(?: name)?:", re.IGNORECASE | re.MULTILINE)
+
 
 class Cache(t.Protocol):
     """A WHOIS cache protocol."""
@@ -22,19 +77,137 @@ class Cache(t.Protocol):
             The cached value, or `None` if not found.
         """
 
-    def set(self, key: str, value: str) -> None:
+    def get_entry(self, key: str) -> t.Optional[tuple[str, float]]:
+        """Retrieve a value from the cache along with how fresh it is.
+
+        Unlike `get`, this also returns values that have gone stale but are
+        still within the cache's grace period.
+
+        Args:
+            key: The cache key to look up.
+
+        Returns:
+            The cached value and the number of seconds until it goes stale,
+            which is negative if it already has, or `None` if not found.
+        """
+
+    def set(self, key: str, value: str, max_age: t.Optional[int] = None) -> None:
         """Store a value in the cache.
 
         Args:
             key: The cache key to store the value under.
             value: The value to store.
+            max_age: How many seconds to consider the value live for, if not
+                the cache's own maximum age.
+        """
+
+
+@t.runtime_checkable
+class Closable(t.Protocol):
+    """A cache that holds resources to be released once it's done with."""
+
+    def close(self) -> None:
+        """Finish any outstanding work and release the cache's resources."""
+
+
+@t.runtime_checkable
+class Invalidatable(t.Protocol):
+    """A cache whose entries can be invalidated selectively.
+
+    Checking every key can take a while with a big cache, so it's done off
+    the event loop.
+    """
+
+    async def invalidate(self, stale: t.Callable[[str], bool]) -> int:
+        """Remove every entry whose key is stale.
+
+        Args:
+            stale: Called with each key to check if its entry is to go.
+
+        Returns:
+            The number of entries removed.
         """
 
 
+class Keys(t.Protocol):
+    """Maps queries onto the keys their responses are cached under."""
+
+    def key(self, query: str) -> str:
+        """Get the key to look up a query's response under.
+
+        Args:
+            query: The WHOIS query.
+
+        Returns:
+            The cache key.
+        """
+
+    def key_response(self, query: str, response: str) -> str:
+        """Get the key to cache a query's response under.
+
+        Args:
+            query: The WHOIS query.
+            response: The response.
+
+        Returns:
+            The cache key.
+        """
+
+
+async def find_stale(keys: list[str], stale: t.Callable[[str], bool]) -> list[str]:
+    """Check which keys are stale in a thread, to keep the event loop free.
+
+    Args:
+        keys: The keys to check.
+        stale: Called with each key to check if it's stale.
+
+    Returns:
+        The stale keys.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: [key for key in keys if stale(key)])
+
+
 class UnknownCacheError(Exception):
     """The supplied cache type name cannot be found."""
 
 
+def get_entry_points(group: str) -> t.Iterable[metadata.EntryPoint]:
+    """Get the entry points in the given group.
+
+    Args:
+        group: The entry point group name.
+
+    Returns:
+        The entry points in the group.
+    """
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=group)
+    # Python 3.9 hands back a dict of groups.
+    return eps.get(group, [])  # type: ignore[attr-defined]
+
+
+def partition_config(cfg: dict[str, str], parts: int) -> dict[str, str]:
+    """Split a cache configuration's size limits into equal parts.
+
+    This is for when each of several worker processes has a cache of its own
+    and the total across them is to stay within the configured limits.
+
+    Args:
+        cfg: The cache configuration.
+        parts: The number of parts to split the limits into.
+
+    Returns:
+        The cache configuration for each part.
+    """
+    cfg = dict(cfg)
+    if parts > 1:
+        for key in ("max_size", "max_bytes"):
+            if key in cfg:
+                cfg[key] = str(max(1, int(cfg[key]) // parts))
+    return cfg
+
+
 def get_cache(cfg: dict[str, str]) -> t.Optional[Cache]:
     """Attempt to load the configured cache.
 
@@ -49,8 +222,7 @@ def get_cache(cfg: dict[str, str]) -> t.Optional[Cache]:
     if cache_name == "null":
         logger.info("Caching deactivated")
         return None
-    eps = metadata.entry_points()
-    for ep in eps.get("uwhoisd.cache", []):
+    for ep in get_entry_points("uwhoisd.cache"):
         if ep.name == cache_name:
             logger.info("Using cache '%s' with the parameters %r", cache_name, cfg)
             cache_type = ep.load()
@@ -58,31 +230,696 @@ def get_cache(cfg: dict[str, str]) -> t.Optional[Cache]:
     raise UnknownCacheError(cache_name)
 
 
+class Stats:
+    """Counters describing how WHOIS queries were satisfied.
+
+    Attributes:
+        hits: Queries answered from the cache.
+        misses: Queries that led to an upstream lookup.
+        coalesced: Queries that piggybacked on an upstream lookup that was
+            already in flight for the same key.
+    """
+
+    __slots__ = (
+        "coalesced",
+        "hits",
+        "misses",
+    )
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __repr__(self) -> str:
+        return f"<Stats hits={self.hits} misses={self.misses} coalesced={self.coalesced}>"
+
+
+def classify(response: str) -> str:
+    """Work out what kind of response a WHOIS server gave.
+
+    Args:
+        response: The response.
+
+    Returns:
+        One of `FOUND`, `NOT_FOUND`, or `RATE_LIMITED`.
+    """
+    if RATE_LIMITED_RESPONSE.search(response) and not RECORD_FIELD.search(response):
+        return RATE_LIMITED
+    if NOT_FOUND_RESPONSE.search(response):
+        return NOT_FOUND
+    return FOUND
+
+
+class TTLPolicy:
+    """How long to cache responses for, by what kind of response they are.
+
+    Responses saying a name isn't registered, or that the upstream server is
+    rate limiting us, are cached for times of their own, typically shorter
+    than for a found name. Upstream timeouts are remembered for a short while
+    too, so clients asking after a registry that's down are told so straight
+    away rather than each waiting on it in turn.
+
+    Args:
+        not_found: Seconds to cache responses for names that aren't
+            registered.
+        rate_limited: Seconds to cache responses saying we're being rate
+            limited.
+        timeout: Seconds to remember that a query timed out.
+        max_failures: Maximum number of failed queries to remember.
+    """
+
+    __slots__ = (
+        "failures",
+        "timeout",
+        "ttls",
+    )
+
+    def __init__(
+        self,
+        not_found: int = 60,
+        rate_limited: int = 10,
+        timeout: int = 10,
+        max_failures: int = 4096,
+    ) -> None:
+        super().__init__()
+        self.ttls: dict[str, t.Optional[int]] = {
+            FOUND: None,
+            NOT_FOUND: int(not_found),
+            RATE_LIMITED: int(rate_limited),
+        }
+        self.timeout = int(timeout)
+        self.failures = LRU(max_size=int(max_failures), max_age=self.timeout)
+
+    def store(self, cache: Cache, key: str, response: str) -> None:
+        """Cache a response for as long as its kind calls for.
+
+        Args:
+            cache: The cache to store the response in.
+            key: The cache key to store the response under.
+            response: The response.
+        """
+        kind = classify(response)
+        RESPONSES.inc((kind,))
+        ttl = self.ttls[kind]
+        if ttl is None:
+            cache.set(key, response)
+        elif ttl > 0:
+            cache.set(key, response, max_age=ttl)
+
+    def fail(self, key: str, exc: BaseException) -> None:
+        """Note that looking up a query failed.
+
+        Args:
+            key: The cache key for the query.
+            exc: The exception the lookup failed with.
+        """
+        # Only the upstream taking too long says anything about the upstream,
+        # as opposed to, say, the query waiting too long for its turn.
+        if isinstance(exc, client.UpstreamTimeoutError):
+            RESPONSES.inc((TIMEOUT,))
+            if self.timeout > 0:
+                self.failures.set(key, TIMEOUT)
+
+    def check(self, key: str) -> bool:
+        """Check whether a query recently failed.
+
+        Args:
+            key: The cache key for the query.
+
+        Returns:
+            `True` if the query recently failed.
+        """
+        return self.failures.get(key) is not None
+
+    async def invalidate(self, stale: t.Callable[[str], bool]) -> int:
+        """Forget the failures of every query whose key is stale.
+
+        Args:
+            stale: Called with each key to check if its failure is to go.
+
+        Returns:
+            The number of failures forgotten.
+        """
+        return await self.failures.invalidate(stale)
+
+
+def get_ttl_policy(cfg: dict[str, str]) -> TTLPolicy:
+    """Create the TTL policy for responses from the configuration.
+
+    Args:
+        cfg: The negative cache configuration.
+
+    Returns:
+        The TTL policy.
+    """
+    return TTLPolicy(**{key: int(value) for key, value in cfg.items()})
+
+
+class SingleFlight(t.Generic[T]):
+    """Coalesce concurrent calls for the same key into a single call.
+
+    The first caller for a key starts the call; anyone else asking for the same
+    key while it's still running waits on that call instead of starting their
+    own, and gets either its result or its exception.
+
+    The call runs as a task of its own, so a caller being cancelled (say,
+    because its client hung up) doesn't take the call down with it for
+    everyone else. Once every caller has gone, though, the call is cancelled,
+    as there's nobody left waiting on it.
+    """
+
+    __slots__ = (
+        "in_flight",
+        "waiters",
+    )
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.in_flight: dict[str, asyncio.Future] = {}
+        # Maps calls onto the number of callers waiting on them.
+        self.waiters: dict[asyncio.Future, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.in_flight)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.in_flight
+
+    def _forget(self, key: str, fut: asyncio.Future) -> None:
+        if self.in_flight.get(key) is fut:
+            del self.in_flight[key]
+        # Mark any exception as retrieved in case every waiter went away.
+        if not fut.cancelled():
+            fut.exception()
+
+    def _leave(self, fut: asyncio.Future) -> None:
+        waiters = self.waiters.pop(fut) - 1
+        if waiters > 0:
+            self.waiters[fut] = waiters
+        elif not fut.done():
+            fut.cancel()
+
+    async def run(
+        self,
+        key: str,
+        func: t.Callable[[], t.Awaitable[T]],
+        stats: t.Optional[Stats] = None,
+    ) -> T:
+        """Run `func`, or wait on the call already in flight for `key`.
+
+        Args:
+            key: The key identifying the call.
+            func: Called with no arguments to start the call if there's
+                none in flight.
+            stats: Counters to update, if any.
+
+        Returns:
+            The result of the call.
+        """
+        fut = self.in_flight.get(key)
+        if fut is None:
+            if stats is not None:
+                stats.misses += 1
+            fut = asyncio.ensure_future(func())
+            self.in_flight[key] = fut
+            fut.add_done_callback(functools.partial(self._forget, key))
+        elif stats is not None:
+            stats.coalesced += 1
+        self.waiters[fut] = self.waiters.get(fut, 0) + 1
+        try:
+            return await asyncio.shield(fut)
+        finally:
+            self._leave(fut)
+
+
+class Refresher:
+    """Refresh cache entries in the background.
+
+    Entries that have gone stale but are still within the cache's grace period
+    are served as they are while a background lookup refreshes them, so the
+    client that happens to ask just after an entry goes stale doesn't pay for
+    a full upstream lookup. Entries that are hot can also be refreshed shortly
+    before they go stale.
+
+    There's never more than one refresh of an entry at a time, and never more
+    than `max_refreshes` in all: past that, stale entries are served without
+    being refreshed until there's room. Refreshes are ordinary upstream
+    lookups, so they're subject to the same upstream rate limits as anything
+    else, and coalesce with any lookup already in flight for the same query.
+
+    Args:
+        refresh_ahead: How many seconds before a hot entry goes stale to
+            refresh it, or 0 to only refresh entries once they're stale.
+        hot_hits: Number of hits an entry needs to count as hot.
+        max_refreshes: Maximum number of refreshes to run at once.
+        max_tracked: Maximum number of entries to count hits for.
+    """
+
+    __slots__ = (
+        "hits",
+        "hot_hits",
+        "max_refreshes",
+        "max_tracked",
+        "refresh_ahead",
+        "refreshing",
+    )
+
+    def __init__(
+        self,
+        refresh_ahead: int = 0,
+        hot_hits: int = 10,
+        max_refreshes: int = 16,
+        max_tracked: int = 4096,
+    ) -> None:
+        super().__init__()
+        self.refresh_ahead = int(refresh_ahead)
+        self.hot_hits = int(hot_hits)
+        self.max_refreshes = int(max_refreshes)
+        self.max_tracked = int(max_tracked)
+        self.hits: dict[str, int] = {}
+        self.refreshing: dict[str, asyncio.Future] = {}
+
+    def _done(self, key: str, fut: asyncio.Future) -> None:
+        del self.refreshing[key]
+        if not fut.cancelled() and fut.exception() is not None:
+            logger.info("Could not refresh '%s': %r", key, fut.exception())
+
+    def is_due(self, key: str, ttl: float) -> t.Optional[str]:
+        """Note a hit on an entry, and check whether it's due a refresh.
+
+        Args:
+            key: The cache key of the entry.
+            ttl: The number of seconds until the entry goes stale.
+
+        Returns:
+            Why the entry is due a refresh, or `None` if it isn't.
+        """
+        if ttl <= 0:
+            return "stale"
+        if self.refresh_ahead <= 0:
+            return None
+        hits = self.hits.get(key, 0) + 1
+        if hits >= self.hot_hits and ttl <= self.refresh_ahead:
+            return "ahead"
+        if key not in self.hits and len(self.hits) >= self.max_tracked:
+            # Start counting afresh rather than track every key ever hit.
+            self.hits.clear()
+        self.hits[key] = hits
+        return None
+
+    def hit(self, key: str, ttl: float, refresh: t.Callable[[], t.Awaitable[object]]) -> None:
+        """Note a hit on an entry, refreshing it if it's due.
+
+        Args:
+            key: The cache key of the entry.
+            ttl: The number of seconds until the entry goes stale.
+            refresh: Called with no arguments to refresh the entry.
+        """
+        reason = self.is_due(key, ttl)
+        if reason is None or key in self.refreshing or len(self.refreshing) >= self.max_refreshes:
+            return
+        logger.info("Refreshing '%s' in the background", key)
+        REFRESHES.inc((reason,))
+        self.hits.pop(key, None)
+        fut = asyncio.ensure_future(refresh())
+        self.refreshing[key] = fut
+        fut.add_done_callback(functools.partial(self._done, key))
+
+
+def get_refresher(cfg: dict[str, str]) -> Refresher:
+    """Create the background refresher from the configuration.
+
+    Args:
+        cfg: The refresh configuration.
+
+    Returns:
+        The refresher.
+    """
+    return Refresher(**{key: int(value) for key, value in cfg.items()})
+
+
+def get_cached(
+    cache: t.Optional[Cache],
+    query: str,
+    stats: t.Optional[Stats] = None,
+    policy: t.Optional[TTLPolicy] = None,
+    refresher: t.Optional[Refresher] = None,
+    refresh: t.Optional[t.Callable[[], t.Awaitable[object]]] = None,
+) -> t.Optional[str]:
+    """Look up a query's response in the cache, if there is one.
+
+    Args:
+        cache: The cache to use, or `None` if caching is disabled.
+        query: The WHOIS query.
+        stats: Counters to update with cache hits, if any.
+        policy: The TTL policy to check for recent failures, if any.
+        refresher: The refresher to serve stale responses while they're
+            refreshed, if any.
+        refresh: Called with no arguments to refresh the response.
+
+    Returns:
+        The cached response, or `None` on a miss.
+
+    Raises:
+        asyncio.TimeoutError: The query recently timed out upstream and
+            there's no response to fall back on.
+    """
+    if cache is None:
+        return None
+    # A stale response is better than none, so it takes precedence over a
+    # recent failure, such as when the upstream's unhealthy.
+    entry = cache.get_entry(query)
+    if entry is not None:
+        response, ttl = entry
+        if refresher is not None and refresh is not None:
+            refresher.hit(query, ttl, refresh)
+        elif ttl <= 0:
+            entry = None
+    if entry is None and policy is not None and policy.check(query):
+        logger.info("Cached timeout for '%s'", query)
+        if stats is not None:
+            stats.hits += 1
+        raise asyncio.TimeoutError
+    if entry is None:
+        return None
+    logger.info("Cache hit for '%s'", query)
+    if stats is not None:
+        stats.hits += 1
+    return response
+
+
+def store(
+    cache: t.Optional[Cache],
+    query: str,
+    response: str,
+    policy: t.Optional[TTLPolicy] = None,
+) -> None:
+    """Store a query's response in the cache, if there is one.
+
+    Args:
+        cache: The cache to use, or `None` if caching is disabled.
+        query: The WHOIS query.
+        response: The response.
+        policy: The TTL policy deciding how long to cache the response for,
+            or `None` to use the cache's own maximum age.
+    """
+    if cache is None:
+        return
+    if policy is None:
+        cache.set(query, response)
+    else:
+        policy.store(cache, query, response)
+
+
+def fail(
+    cache: t.Optional[Cache],
+    query: str,
+    exc: BaseException,
+    policy: t.Optional[TTLPolicy] = None,
+) -> None:
+    """Note that looking up a query failed, if failures are being cached.
+
+    Args:
+        cache: The cache to use, or `None` if caching is disabled.
+        query: The WHOIS query.
+        exc: The exception the lookup failed with.
+        policy: The TTL policy to note the failure with, if any.
+    """
+    if cache is not None and policy is not None:
+        policy.fail(query, exc)
+
+
 def wrap_whois(
     cache: t.Optional[Cache],
     whois_func: t.Callable[[str], t.Awaitable[str]],
+    stats: t.Optional[Stats] = None,
+    policy: t.Optional[TTLPolicy] = None,
+    refresher: t.Optional[Refresher] = None,
+    keys: t.Optional[Keys] = None,
 ) -> t.Callable[[str], t.Awaitable[str]]:
     """Wrap a WHOIS query function with a cache.
 
+    Concurrent misses for the same cache key share a single upstream lookup,
+    even when caching is disabled.
+
     Args:
         cache: The cache to use, or `None` to disable caching.
         whois_func: The WHOIS query function to wrap.
+        stats: Counters to update with cache hits, misses, and coalesced
+            queries, if any.
+        policy: The TTL policy for responses and failures, or `None` to
+            cache every response for the cache's own maximum age.
+        refresher: Refreshes stale and hot entries in the background, or
+            `None` to treat stale entries as misses.
+        keys: Maps queries onto their cache keys, or `None` to key responses
+            by their query.
 
     Returns:
         The wrapped WHOIS query function.
     """
-    if cache is None:
-        return whois_func
+    flights: SingleFlight[str] = SingleFlight()
 
-    async def wrapped(query: str) -> str:
-        response = cache.get(query)
-        if response is None:
+    async def lookup(query: str, key: str) -> str:
+        try:
             response = await whois_func(query)
-            cache.set(query, response)
-        else:
-            logger.info("Cache hit for '%s'", query)
+        except Exception as exc:
+            fail(cache, key, exc, policy)
+            raise
+        store(cache, key if keys is None else keys.key_response(query, response), response, policy)
         return response
 
+    async def refresh(query: str, key: str) -> str:
+        return await flights.run(key, functools.partial(lookup, query, key))
+
+    async def wrapped(query: str) -> str:
+        start = time.perf_counter()
+        key = query if keys is None else keys.key(query)
+        response = get_cached(
+            cache,
+            key,
+            stats,
+            policy,
+            refresher,
+            functools.partial(refresh, query, key),
+        )
+        if response is not None:
+            LOOKUP_DURATION.observe(time.perf_counter() - start, ("hit",))
+            return response
+        result = "coalesced" if key in flights else "miss"
+        try:
+            return await flights.run(key, functools.partial(lookup, query, key), stats)
+        finally:
+            LOOKUP_DURATION.observe(time.perf_counter() - start, (result,))
+
+    return wrapped
+
+
+class Broadcast:
+    """A response that's still arriving, shared by everyone waiting on it.
+
+    Each reader gets every chunk fed in from the start, however late they
+    started reading. If every reader gives up before the response is
+    complete, whatever's feeding it in is cancelled.
+    """
+
+    __slots__ = (
+        "chunks",
+        "closed",
+        "error",
+        "fed",
+        "feeder",
+        "readers",
+    )
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.chunks: list[bytes] = []
+        self.closed = False
+        self.error: t.Optional[BaseException] = None
+        self.fed = asyncio.Event()
+        self.feeder: t.Optional[asyncio.Future] = None
+        self.readers = 0
+
+    def _notify(self) -> None:
+        fed, self.fed = self.fed, asyncio.Event()
+        fed.set()
+
+    def feed(self, chunk: bytes) -> None:
+        """Add a chunk to the response.
+
+        Args:
+            chunk: The chunk to add.
+        """
+        self.chunks.append(chunk)
+        self._notify()
+
+    def close(self, error: t.Optional[BaseException] = None) -> None:
+        """Mark the response as complete.
+
+        Args:
+            error: The exception that ended the response early, if any.
+        """
+        self.closed = True
+        self.error = error
+        self._notify()
+
+    async def relay(self, chunks: t.AsyncIterator[bytes]) -> None:
+        """Feed in chunks as they arrive, closing the response once done.
+
+        Args:
+            chunks: The chunks to feed in.
+        """
+        try:
+            async for chunk in chunks:
+                self.feed(chunk)
+        except Exception as exc:
+            self.close(exc)
+        except BaseException as exc:
+            # Cancelled, so don't leave anyone who joined since waiting.
+            self.close(exc)
+            raise
+        else:
+            self.close()
+
+    async def wait(self) -> None:
+        """Wait for the response to be complete.
+
+        This counts as reading the response, so it won't be cancelled for
+        want of readers while waiting.
+        """
+        async for _ in self:
+            pass
+
+    def settle(
+        self,
+        cache: t.Optional[Cache],
+        query: str,
+        policy: t.Optional[TTLPolicy] = None,
+        keys: t.Optional[Keys] = None,
+        key: t.Optional[str] = None,
+    ) -> None:
+        """Cache the complete response, or note that it failed.
+
+        Args:
+            cache: The cache to use, or `None` if caching is disabled.
+            query: The WHOIS query.
+            policy: The TTL policy for responses and failures, if any.
+            keys: Maps queries onto their cache keys, if not keyed by query.
+            key: The key the response was looked up under, if not the query.
+        """
+        if key is None:
+            key = query
+        if self.error is None:
+            response = str(b"".join(self.chunks), "utf-8", "ignore")
+            store(cache, key if keys is None else keys.key_response(query, response), response, policy)
+        else:
+            fail(cache, key, self.error, policy)
+
+    async def __aiter__(self) -> t.AsyncIterator[bytes]:
+        self.readers += 1
+        try:
+            i = 0
+            while True:
+                while i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                if self.closed:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self.fed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and not self.closed and self.feeder is not None:
+                self.feeder.cancel()
+
+
+def wrap_whois_stream(
+    cache: t.Optional[Cache],
+    stream_func: t.Callable[[str], t.AsyncIterator[bytes]],
+    stats: t.Optional[Stats] = None,
+    policy: t.Optional[TTLPolicy] = None,
+    refresher: t.Optional[Refresher] = None,
+    keys: t.Optional[Keys] = None,
+) -> t.Callable[[str], t.AsyncIterator[bytes]]:
+    """Wrap a streaming WHOIS query function with a cache.
+
+    This is the streaming counterpart of `wrap_whois`. On a miss, the response
+    is passed on chunk by chunk as it arrives from upstream, and is only
+    decoded once complete so it can be cached. Concurrent misses for the same
+    cache key share a single upstream lookup, with each receiving the chunks
+    as they arrive.
+
+    Args:
+        cache: The cache to use, or `None` to disable caching.
+        stream_func: The streaming WHOIS query function to wrap.
+        stats: Counters to update with cache hits, misses, and coalesced
+            queries, if any.
+        policy: The TTL policy for responses and failures, or `None` to
+            cache every response for the cache's own maximum age.
+        refresher: Refreshes stale and hot entries in the background, or
+            `None` to treat stale entries as misses.
+        keys: Maps queries onto their cache keys, or `None` to key responses
+            by their query.
+
+    Returns:
+        The wrapped streaming WHOIS query function.
+    """
+    if stats is None:
+        stats = Stats()
+    broadcasts: dict[str, Broadcast] = {}
+    # Keep a reference to running lookups so they're not garbage collected.
+    lookups: set[asyncio.Future] = set()
+
+    async def lookup(query: str, key: str, broadcast: Broadcast) -> None:
+        try:
+            await broadcast.relay(stream_func(query))
+        finally:
+            del broadcasts[key]
+        broadcast.settle(cache, query, policy, keys, key)
+
+    def start_lookup(query: str, key: str) -> Broadcast:
+        broadcast = broadcasts[key] = Broadcast()
+        broadcast.feeder = asyncio.ensure_future(lookup(query, key, broadcast))
+        lookups.add(broadcast.feeder)
+        broadcast.feeder.add_done_callback(lookups.discard)
+        return broadcast
+
+    async def refresh(query: str, key: str) -> None:
+        if key not in broadcasts:
+            await start_lookup(query, key).wait()
+
+    async def wrapped(query: str) -> t.AsyncIterator[bytes]:
+        start = time.perf_counter()
+        key = query if keys is None else keys.key(query)
+        response = get_cached(
+            cache,
+            key,
+            stats,
+            policy,
+            refresher,
+            functools.partial(refresh, query, key),
+        )
+        if response is not None:
+            LOOKUP_DURATION.observe(time.perf_counter() - start, ("hit",))
+            yield response.encode()
+            return
+        broadcast = broadcasts.get(key)
+        if broadcast is None:
+            result = "miss"
+            stats.misses += 1
+            broadcast = start_lookup(query, key)
+        else:
+            result = "coalesced"
+            stats.coalesced += 1
+        try:
+            async for chunk in broadcast:
+                yield chunk
+        finally:
+            LOOKUP_DURATION.observe(time.perf_counter() - start, (result,))
+
     return wrapped
 
 
@@ -94,9 +931,16 @@ class LFU:
     2-tuples consisting of a counter giving the number of times this item
     occurs on the eviction queue and the value.
 
+    The time each entry goes stale is noted separately, so hits keeping an
+    entry on the queue don't keep it fresh forever. Entries can be given a
+    maximum age of their own, but are never kept past the cache's own maximum
+    age plus the grace period.
+
     Args:
         max_size: Maximum number of entries the cache can contain.
         max_age: Maximum number of seconds to consider an entry live.
+        grace: Number of seconds past its maximum age an entry can still be
+            served stale while it's refreshed.
     """
 
     # I may end up reimplementing an LRU cache if it turns out that's more apt,
@@ -105,6 +949,8 @@ class LFU:
 
     __slots__ = (
         "cache",
+        "expires",
+        "grace",
         "max_age",
         "max_size",
         "queue",
@@ -112,40 +958,48 @@ class LFU:
 
     clock = staticmethod(time.time)
 
-    def __init__(self, max_size: int = 256, max_age: int = 300) -> None:
+    def __init__(self, max_size: int = 256, max_age: int = 300, grace: int = 0) -> None:
         super().__init__()
         self.cache: dict[str, tuple[int, str]] = {}
+        self.expires: dict[str, float] = {}
         self.queue: t.Deque[tuple[int, str]] = collections.deque()
         self.max_size = int(max_size)
         self.max_age = int(max_age)
+        self.grace = int(grace)
+
+    def __len__(self) -> int:
+        return len(self.cache)
 
     def evict_one(self) -> None:
         """Remove the item at the head of the eviction cache."""
         _, key = self.queue.popleft()
         self.attempt_eviction(key)
 
-    def attempt_eviction(self, key: str) -> None:
+    def attempt_eviction(self, key: str, reason: str = "capacity") -> None:
         """Attempt to remove the named item from the cache.
 
         Args:
             key: The cache key to evict.
+            reason: Why the item is being evicted.
         """
         counter, value = self.cache[key]
         counter -= 1
         if counter == 0:
             del self.cache[key]
+            self.expires.pop(key, None)
+            EVICTIONS.inc((reason,))
         else:
             self.cache[key] = (counter, value)
 
     def evict_expired(self) -> None:
         """Evict any items older than the maximum age from the cache."""
-        cutoff = self.clock() - self.max_age
+        cutoff = self.clock() - self.max_age - self.grace
         while len(self.queue) > 0:
             ts, key = self.queue.popleft()
             if ts > cutoff:
                 self.queue.appendleft((ts, key))
                 break
-            self.attempt_eviction(key)
+            self.attempt_eviction(key, "expired")
 
     def get(self, key: str) -> t.Optional[str]:
         """Pull a value from the cache corresponding to the key.
@@ -156,17 +1010,50 @@ class LFU:
         Returns:
             The cached value, or `None` if not found.
         """
+        entry = self.get_entry(key)
+        if entry is None or entry[1] <= 0:
+            return None
+        return entry[0]
+
+    def get_entry(self, key: str) -> t.Optional[tuple[str, float]]:
+        """Pull a value from the cache along with how fresh it is.
+
+        Args:
+            key: The cache key to look up.
+
+        Returns:
+            The cached value and the number of seconds until it goes stale,
+            or `None` if not found.
+        """
         self.evict_expired()
         if key not in self.cache:
             return None
+        expires = self.expires[key]
+        ttl = expires - self.clock()
+        if ttl <= -self.grace:
+            return None
         _, value = self.cache[key]
-        # Force this onto the top of the queue.
-        self.set(key, value)
-        return value
+        # Force this onto the top of the queue. Doing so might evict this very
+        # entry before it's put back, so its expiry time is put back too.
+        self.push(key, value)
+        self.expires[key] = expires
+        return value, ttl
 
-    def set(self, key: str, value: str) -> None:
+    def set(self, key: str, value: str, max_age: t.Optional[int] = None) -> None:
         """Add `value` to the cache, to be referenced by `key`.
 
+        Args:
+            key: The cache key to store the value under.
+            value: The value to store.
+            max_age: How many seconds to consider the value live for, if not
+                the cache's own maximum age.
+        """
+        self.push(key, value)
+        self.expires[key] = self.clock() + (self.max_age if max_age is None else int(max_age))
+
+    def push(self, key: str, value: str) -> None:
+        """Put `value` onto the top of the queue under `key`.
+
         Args:
             key: The cache key to store the value under.
             value: The value to store.
@@ -179,3 +1066,425 @@ class LFU:
             counter = 0
         self.cache[key] = (counter + 1, value)
         self.queue.append((int(self.clock()), key))
+
+    async def invalidate(self, stale: t.Callable[[str], bool]) -> int:
+        """Remove every entry whose key is stale.
+
+        Args:
+            stale: Called with each key to check if its entry is to go.
+
+        Returns:
+            The number of entries removed.
+        """
+        # Anything cached while the keys were being checked is left alone.
+        dropped = {key for key in await find_stale(list(self.cache), stale) if key in self.cache}
+        if dropped:
+            for key in dropped:
+                del self.cache[key]
+                self.expires.pop(key, None)
+            # Rebuilt rather than left to drain, so the counters stay in step
+            # with the queue if any of the keys are cached again.
+            self.queue = collections.deque(item for item in self.queue if item[1] not in dropped)
+            EVICTIONS.inc(("invalidated",), len(dropped))
+        return len(dropped)
+
+
+class LRU:
+    """An LRU cache bounded by both entry count and total response size.
+
+    Each key occupies exactly one slot however often it's hit, and both
+    lookups and insertions take constant time. Entries expire lazily: an
+    expired entry is dropped when it's next looked up, or when it falls off
+    the end of the cache. Entries can be given a maximum age of their own.
+
+    Args:
+        max_size: Maximum number of entries the cache can contain.
+        max_age: Maximum number of seconds to consider an entry live.
+        max_bytes: Maximum total size of cached responses in bytes.
+        grace: Number of seconds past its maximum age an entry can still be
+            served stale while it's refreshed.
+    """
+
+    __slots__ = (
+        "cache",
+        "grace",
+        "max_age",
+        "max_bytes",
+        "max_size",
+        "size",
+    )
+
+    clock = staticmethod(time.time)
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        max_age: int = 300,
+        max_bytes: int = 4 * 1024 * 1024,
+        grace: int = 0,
+    ) -> None:
+        super().__init__()
+        # Maps keys onto the time they expire, their value, and its size.
+        self.cache: t.OrderedDict[str, tuple[float, str, int]] = collections.OrderedDict()
+        self.max_size = int(max_size)
+        self.max_age = int(max_age)
+        self.max_bytes = int(max_bytes)
+        self.grace = int(grace)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def discard(self, key: str) -> None:
+        """Remove the named item from the cache if present.
+
+        Args:
+            key: The cache key to remove.
+        """
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def get(self, key: str) -> t.Optional[str]:
+        """Pull a value from the cache corresponding to the key.
+
+        Args:
+            key: The cache key to look up.
+
+        Returns:
+            The cached value, or `None` if not found.
+        """
+        entry = self.get_entry(key)
+        if entry is None or entry[1] <= 0:
+            return None
+        return entry[0]
+
+    def get_entry(self, key: str) -> t.Optional[tuple[str, float]]:
+        """Pull a value from the cache along with how fresh it is.
+
+        Args:
+            key: The cache key to look up.
+
+        Returns:
+            The cached value and the number of seconds until it goes stale,
+            or `None` if not found.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        expires, value, _ = entry
+        ttl = expires - self.clock()
+        if ttl <= -self.grace:
+            self.discard(key)
+            EVICTIONS.inc(("expired",))
+            return None
+        self.cache.move_to_end(key)
+        return value, ttl
+
+    def set(self, key: str, value: str, max_age: t.Optional[int] = None) -> None:
+        """Add `value` to the cache, to be referenced by `key`.
+
+        Args:
+            key: The cache key to store the value under.
+            value: The value to store.
+            max_age: How many seconds to consider the value live for, if not
+                the cache's own maximum age.
+        """
+        self.discard(key)
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        self.cache[key] = (self.clock() + (self.max_age if max_age is None else int(max_age)), value, size)
+        self.size += size
+        while len(self.cache) > self.max_size or self.size > self.max_bytes:
+            _, (_, _, evicted) = self.cache.popitem(last=False)
+            self.size -= evicted
+            EVICTIONS.inc(("capacity",))
+
+    async def invalidate(self, stale: t.Callable[[str], bool]) -> int:
+        """Remove every entry whose key is stale.
+
+        Args:
+            stale: Called with each key to check if its entry is to go.
+
+        Returns:
+            The number of entries removed.
+        """
+        dropped = [key for key in await find_stale(list(self.cache), stale) if key in self.cache]
+        for key in dropped:
+            self.discard(key)
+        if dropped:
+            EVICTIONS.inc(("invalidated",), len(dropped))
+        return len(dropped)
+
+
+class SQLite:
+    """A persistent cache backed by an SQLite database.
+
+    The cache survives restarts, and several processes on the same host can
+    share it by pointing at the same file: the database is put into WAL mode
+    so readers don't block on a writer. Lookups are a single primary key read,
+    which is cheap enough to do on the event loop.
+
+    Writes are another matter, as they can wait on other processes for the
+    write lock, so they're queued and made in order by a thread of the cache's
+    own. Until a write's been made, lookups are answered from the queue, and
+    a write that fails is logged and dropped rather than failing the query.
+
+    Disk usage is bounded by evicting the oldest entries once the cache holds
+    more than `max_size` entries or `max_bytes` bytes of responses. Space freed
+    this way is reused by SQLite rather than given back to the filesystem, so
+    the file stays around its high-water mark. Expired entries and overflow
+    are cleared out by the writer thread every `prune_interval` writes.
+
+    Args:
+        path: Path to the database file.
+        max_size: Maximum number of entries the cache can contain.
+        max_age: Maximum number of seconds to consider an entry live.
+        max_bytes: Maximum total size of cached responses in bytes.
+        prune_interval: Number of writes between pruning passes.
+        grace: Number of seconds past its maximum age an entry can still be
+            served stale while it's refreshed.
+    """
+
+    __slots__ = (
+        "conn",
+        "grace",
+        "lock",
+        "max_age",
+        "max_bytes",
+        "max_size",
+        "pending",
+        "prune_interval",
+        "write_conn",
+        "writer",
+        "writes",
+    )
+
+    clock = staticmethod(time.time)
+
+    def __init__(
+        self,
+        path: str = "uwhoisd-cache.sqlite",
+        max_size: int = 65536,
+        max_age: int = 300,
+        max_bytes: int = 64 * 1024 * 1024,
+        prune_interval: int = 64,
+        grace: int = 0,
+    ) -> None:
+        super().__init__()
+        self.max_size = int(max_size)
+        self.max_age = int(max_age)
+        self.max_bytes = int(max_bytes)
+        self.prune_interval = int(prune_interval)
+        self.grace = int(grace)
+        self.writes = 0
+        # Maps the keys of entries waiting to be written onto their
+        # timestamps and values.
+        self.pending: dict[str, tuple[float, str]] = {}
+        self.lock = threading.Lock()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="uwhoisd-sqlite")
+        self.conn = self.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key   TEXT PRIMARY KEY,
+                ts    REAL NOT NULL,
+                size  INTEGER NOT NULL,
+                value TEXT NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_ts ON cache (ts)")
+        # Only ever used by the writer thread.
+        self.write_conn = self.connect(path)
+
+    @staticmethod
+    def connect(path: str) -> sqlite3.Connection:
+        """Open a connection to the database.
+
+        Args:
+            path: Path to the database file.
+
+        Returns:
+            The connection.
+        """
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA busy_timeout = 1000")
+        return conn
+
+    def close(self) -> None:
+        """Finish any queued writes, then close the database connections."""
+        self.writer.shutdown(wait=True)
+        self.write_conn.close()
+        self.conn.close()
+
+    def flush(self) -> None:
+        """Wait for the writes queued so far to be made."""
+        self.writer.submit(lambda: None).result()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: str) -> t.Optional[str]:
+        """Pull a value from the cache corresponding to the key.
+
+        Args:
+            key: The cache key to look up.
+
+        Returns:
+            The cached value, or `None` if not found.
+        """
+        entry = self.get_entry(key)
+        if entry is None or entry[1] <= 0:
+            return None
+        return entry[0]
+
+    def get_entry(self, key: str) -> t.Optional[tuple[str, float]]:
+        """Pull a value from the cache along with how fresh it is.
+
+        Args:
+            key: The cache key to look up.
+
+        Returns:
+            The cached value and the number of seconds until it goes stale,
+            or `None` if not found.
+        """
+        now = self.clock()
+        with self.lock:
+            pending = self.pending.get(key)
+        if pending is not None:
+            ts, value = pending
+        else:
+            try:
+                row = self.conn.execute(
+                    "SELECT ts, value FROM cache WHERE key = ? AND ts > ?",
+                    (key, now - self.max_age - self.grace),
+                ).fetchone()
+            except sqlite3.Error:
+                logger.warning("Could not read '%s' from the SQLite cache", key, exc_info=True)
+                return None
+            if row is None:
+                return None
+            ts, value = row
+        ttl = ts + self.max_age - now
+        return None if ttl <= -self.grace else (value, ttl)
+
+    def set(self, key: str, value: str, max_age: t.Optional[int] = None) -> None:
+        """Add `value` to the cache, to be referenced by `key`.
+
+        The value's written by the writer thread; until then, it's looked up
+        from the queue.
+
+        Args:
+            key: The cache key to store the value under.
+            value: The value to store.
+            max_age: How many seconds to consider the value live for, if not
+                the cache's own maximum age.
+        """
+        ts = self.clock()
+        if max_age is not None:
+            # Shift the timestamp so the entry expires after its own maximum
+            # age. This also puts shorter-lived entries first in line to be
+            # evicted.
+            ts += int(max_age) - self.max_age
+        entry = (ts, value)
+        with self.lock:
+            self.pending[key] = entry
+        self.writer.submit(self.write, key, entry)
+
+    def write(self, key: str, entry: tuple[float, str]) -> None:
+        """Write an entry to the database, on the writer thread.
+
+        Args:
+            key: The cache key to store the entry under.
+            entry: The entry's timestamp and value.
+        """
+        ts, value = entry
+        try:
+            self.write_conn.execute(
+                "INSERT OR REPLACE INTO cache (key, ts, size, value) VALUES (?, ?, ?, ?)",
+                (key, ts, len(value.encode()), value),
+            )
+        except sqlite3.Error:
+            logger.warning("Could not write '%s' to the SQLite cache", key, exc_info=True)
+        finally:
+            with self.lock:
+                # Unless it's been replaced by a later write in the meantime.
+                if self.pending.get(key) is entry:
+                    del self.pending[key]
+        self.writes += 1
+        if self.writes % self.prune_interval == 0:
+            try:
+                self.trim()
+            except sqlite3.Error:
+                logger.warning("Could not prune the SQLite cache", exc_info=True)
+
+    def prune(self) -> None:
+        """Prune the cache on the writer thread, and wait for it to finish."""
+        self.writer.submit(self.trim).result()
+
+    def trim(self) -> None:
+        """Remove expired entries, then the oldest entries until within bounds.
+
+        Only to be called on the writer thread.
+        """
+        with self.write_conn:
+            self.write_conn.execute("BEGIN IMMEDIATE")
+            cursor = self.write_conn.execute(
+                "DELETE FROM cache WHERE ts <= ?",
+                (self.clock() - self.max_age - self.grace,),
+            )
+            EVICTIONS.inc(("expired",), cursor.rowcount)
+            count, total = self.write_conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+            excess = count - self.max_size
+            if excess > 0:
+                cursor = self.write_conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY ts LIMIT ?)",
+                    (excess,),
+                )
+                EVICTIONS.inc(("capacity",), cursor.rowcount)
+            if total > self.max_bytes:
+                # Walk from the newest entry back, keeping as many as fit.
+                cursor = self.write_conn.execute(
+                    """
+                    DELETE FROM cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY ts DESC, key) AS running
+                            FROM cache
+                        ) WHERE running > ?
+                    )
+                    """,
+                    (self.max_bytes,),
+                )
+                EVICTIONS.inc(("capacity",), cursor.rowcount)
+
+    async def invalidate(self, stale: t.Callable[[str], bool]) -> int:
+        """Remove every entry whose key is stale, on the writer thread.
+
+        Args:
+            stale: Called with each key to check if its entry is to go.
+
+        Returns:
+            The number of entries removed.
+        """
+        return await asyncio.wrap_future(self.writer.submit(self.drop_stale, stale))
+
+    def drop_stale(self, stale: t.Callable[[str], bool]) -> int:
+        """Remove every entry whose key is stale, on the writer thread.
+
+        Args:
+            stale: Called with each key to check if its entry is to go.
+
+        Returns:
+            The number of entries removed.
+        """
+        with self.write_conn:
+            self.write_conn.execute("BEGIN IMMEDIATE")
+            dropped = [(key,) for (key,) in self.write_conn.execute("SELECT key FROM cache") if stale(key)]
+            self.write_conn.executemany("DELETE FROM cache WHERE key = ?", dropped)
+        if dropped:
+            EVICTIONS.inc(("invalidated",), len(dropped))
+        return len(dropped)
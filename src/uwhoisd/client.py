@@ -1,27 +1,273 @@
 """Client."""
 
 import asyncio
+import typing as t
 
+from . import metrics
+from . import resolver as resolver_
 
-async def query_whois(host: str, port: int, query: str) -> str:
+# Maximum number of bytes to read from an upstream server at a time.
+CHUNK_SIZE = 65536
+
+# Seconds to allow for reading the response from an upstream server.
+TIMEOUT = 5
+
+CONNECTIONS = metrics.gauge("uwhoisd_upstream_connections", "Open connections to upstream WHOIS servers.")
+BYTES_RECEIVED = metrics.counter("uwhoisd_upstream_bytes_received_total", "Bytes received from upstream WHOIS servers.")
+
+T = t.TypeVar("T")
+
+
+class UpstreamTimeoutError(asyncio.TimeoutError):
+    """An upstream WHOIS server took longer to connect to or answer than it's allowed.
+
+    This is as opposed to a query running out of time for other reasons, such
+    as waiting its turn for the upstream or what the servers queried before it
+    used, which says nothing about the upstream.
+    """
+
+
+class Timeouts(t.NamedTuple):
+    """Timeouts, in seconds, for answering a query.
+
+    Attributes:
+        total: Time to answer the query in, however many upstream servers
+            need to be queried to do so.
+        resolve: Time to resolve an upstream server's hostname in.
+        connect: Time to connect to an upstream server's address in.
+        read: Time to read an upstream server's response in.
+    """
+
+    total: float = 10.0
+    resolve: float = 2.0
+    connect: float = 3.0
+    read: float = TIMEOUT
+
+
+DEFAULT_TIMEOUTS = Timeouts()
+
+
+def parse_timeouts(value: str, base: Timeouts = DEFAULT_TIMEOUTS) -> Timeouts:
+    """Parse a set of timeouts from the configuration.
+
+    Timeouts are given as space-separated `name=value` pairs, with the names
+    being those of the fields of `Timeouts`.
+
+    Args:
+        value: The configuration value.
+        base: The timeouts to use for any not given.
+
+    Returns:
+        The timeouts.
+    """
+    fields: dict[str, float] = {}
+    for pair in value.split():
+        name, _, setting = pair.partition("=")
+        if name not in Timeouts._fields:
+            raise ValueError(f"Unknown timeout: {name!r}")
+        fields[name] = float(setting)
+    return base._replace(**fields)
+
+
+class Deadline:
+    """The time by which a query has to be answered.
+
+    A deadline is shared by every upstream query made to answer a client's
+    query, so whatever time one doesn't use is left for the next, and each
+    phase of each upstream query is cut short if the deadline comes first.
+
+    Args:
+        timeout: Seconds from now until the deadline.
+    """
+
+    __slots__ = ("expires",)
+
+    def __init__(self, timeout: float) -> None:
+        super().__init__()
+        self.expires = asyncio.get_running_loop().time() + timeout
+
+    def remaining(self) -> float:
+        """Get the time left until the deadline.
+
+        Returns:
+            The number of seconds left, which is negative once it's passed.
+        """
+        return self.expires - asyncio.get_running_loop().time()
+
+    def limit(self, timeout: float) -> float:
+        """Cap a timeout so it doesn't run past the deadline.
+
+        Args:
+            timeout: The timeout in seconds.
+
+        Returns:
+            The lesser of the timeout and the time left until the deadline.
+
+        Raises:
+            asyncio.TimeoutError: The deadline has already passed.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise asyncio.TimeoutError
+        return min(timeout, remaining)
+
+
+async def wait_for(aw: t.Awaitable[T], timeout: float, deadline: Deadline) -> T:
+    """Wait on an upstream WHOIS server, within a phase's timeout and the deadline.
+
+    Args:
+        aw: What to wait on.
+        timeout: Seconds left of the phase's timeout.
+        deadline: The deadline for the query.
+
+    Returns:
+        The result of what was waited on.
+
+    Raises:
+        UpstreamTimeoutError: The upstream didn't finish within the phase's
+            timeout.
+        asyncio.TimeoutError: The deadline came first.
+    """
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise asyncio.TimeoutError
+    try:
+        return await asyncio.wait_for(aw, min(timeout, remaining))
+    except asyncio.TimeoutError:
+        if remaining < timeout:
+            raise
+        raise UpstreamTimeoutError from None
+
+
+async def connect(
+    host: str,
+    port: int,
+    resolver: t.Optional[resolver_.Resolver] = None,
+    timeouts: Timeouts = DEFAULT_TIMEOUTS,
+    deadline: t.Optional[Deadline] = None,
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Connect to a WHOIS server.
+
+    If a resolver is given, the server's addresses are taken from it and
+    tried in turn, and any that can't be connected to in time are discarded
+    from it.
+
+    Args:
+        host: The WHOIS server hostname.
+        port: The WHOIS server port.
+        resolver: The resolver to use, if any.
+        timeouts: The timeouts for resolving and connecting.
+        deadline: The deadline for the query, if any.
+
+    Returns:
+        The reader and writer for the connection.
+
+    Raises:
+        UpstreamTimeoutError: If connecting took too long.
+        asyncio.TimeoutError: If resolving took too long, or the deadline
+            passed.
+    """
+    if deadline is None:
+        deadline = Deadline(timeouts.resolve + timeouts.connect)
+    if resolver is None:
+        return await wait_for(asyncio.open_connection(host, port), timeouts.resolve + timeouts.connect, deadline)
+
+    addrs = await asyncio.wait_for(resolver.resolve(host, port), deadline.limit(timeouts.resolve))
+    last_exc: t.Optional[Exception] = None
+    for addr in addrs:
+        try:
+            return await wait_for(asyncio.open_connection(addr[1], port, family=addr[0]), timeouts.connect, deadline)
+        except (OSError, asyncio.TimeoutError) as exc:  # noqa: PERF203
+            resolver.discard(host, addr)
+            last_exc = exc
+    if last_exc is None:  # pragma: no cover
+        raise OSError(f"No addresses for {host}")
+    raise last_exc
+
+
+async def stream_whois(
+    host: str,
+    port: int,
+    query: str,
+    resolver: t.Optional[resolver_.Resolver] = None,
+    timeouts: Timeouts = DEFAULT_TIMEOUTS,
+    deadline: t.Optional[Deadline] = None,
+) -> t.AsyncIterator[bytes]:
+    """Query a WHOIS server, yielding the response as it arrives.
+
+    Args:
+        host: The WHOIS server hostname.
+        port: The WHOIS server port.
+        query: The WHOIS query.
+        resolver: The resolver to use, if any.
+        timeouts: The timeouts for each phase of the query.
+        deadline: The deadline for the query, if any, which cuts short any
+            phase that would otherwise run past it.
+
+    Yields:
+        Chunks of the raw WHOIS response.
+
+    Raises:
+        UpstreamTimeoutError: If connecting or reading took too long.
+        asyncio.TimeoutError: If resolving took too long, or the deadline
+            passed.
+    """
+    if deadline is None:
+        deadline = Deadline(timeouts.total)
+    reader, writer = await connect(host, port, resolver, timeouts, deadline)
+    CONNECTIONS.inc()
+    try:
+        # The whole of the response has to arrive within the read timeout.
+        read_deadline = Deadline(timeouts.read)
+        writer.write(f"{query}\r\n".encode())
+        await wait_for(writer.drain(), read_deadline.remaining(), deadline)
+
+        while True:
+            chunk = await wait_for(reader.read(CHUNK_SIZE), read_deadline.remaining(), deadline)
+            if chunk == b"":
+                break
+            BYTES_RECEIVED.inc(amount=len(chunk))
+            yield chunk
+    finally:
+        CONNECTIONS.dec()
+        writer.close()
+        await writer.wait_closed()
+
+
+async def query_whois(
+    host: str,
+    port: int,
+    query: str,
+    resolver: t.Optional[resolver_.Resolver] = None,
+    timeouts: Timeouts = DEFAULT_TIMEOUTS,
+    deadline: t.Optional[Deadline] = None,
+) -> str:
     """Query a WHOIS server.
 
     Args:
         host: The WHOIS server hostname.
         port: The WHOIS server port.
         query: The WHOIS query.
+        resolver: The resolver to use, if any.
+        timeouts: The timeouts for each phase of the query.
+        deadline: The deadline for the query, if any.
 
     Returns:
         The WHOIS response.
     """
-    reader, writer = await asyncio.open_connection(host, port)
+    chunks = [chunk async for chunk in stream_whois(host, port, query, resolver, timeouts, deadline)]
+    return decode(b"".join(chunks))
 
-    writer.write(f"{query}\r\n".encode())
-    await writer.drain()
 
-    response = await asyncio.wait_for(reader.read(), timeout=5)
+def decode(response: bytes) -> str:
+    """Decode a raw WHOIS response.
 
-    writer.close()
-    await writer.wait_closed()
+    Args:
+        response: The raw response.
 
+    Returns:
+        The decoded response.
+    """
     return str(response, "utf-8", "ignore")
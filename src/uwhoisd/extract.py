@@ -0,0 +1,278 @@
+"""Streaming extraction of what the scraper needs from IANA's pages.
+
+Rather than parsing each page into a tree and searching it, these scan over
+the page as it's parsed, keeping only the stack of open elements, and give
+the same results as searching the tree Beautiful Soup would build.
+"""
+
+from html.parser import HTMLParser
+import typing as t
+from urllib.parse import urljoin
+
+# Elements that never have any content, and so are never closed.
+VOID_ELEMENTS = frozenset(
+    (
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "param",
+        "source",
+        "track",
+        "wbr",
+    )
+)
+
+# How much of a page to feed to the parser at a time.
+CHUNK_SIZE = 16384
+
+
+class Element:
+    """An open element, tracking just enough to work out its `.string`.
+
+    An element's `.string` is the text of its only child, if it has just the
+    one, and that child is either text or has a `.string` of its own.
+    """
+
+    __slots__ = ("attrs", "children", "string", "tag")
+
+    def __init__(self, tag: str, attrs: t.Mapping[str, t.Optional[str]]) -> None:
+        super().__init__()
+        self.tag = tag
+        self.attrs = attrs
+        self.children = 0
+        self.string: t.Optional[str] = None
+
+    def add_child(self, string: t.Optional[str]) -> None:
+        """Note a child of the element.
+
+        Args:
+            string: The child's text, or its `.string` if it's an element.
+        """
+        self.children += 1
+        self.string = string
+
+    def get_string(self) -> t.Optional[str]:
+        """Get the element's `.string`.
+
+        Returns:
+            The text of the element's only child, if it has one.
+        """
+        return self.string if self.children == 1 else None
+
+
+class Scanner(HTMLParser):
+    """Base class for scanners, which maintains the stack of open elements.
+
+    Subclasses override `opened`, `closed`, and `text` to pick out what they
+    need, and set `done` once they have it.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.stack: list[Element] = [Element("", {})]
+        self.done = False
+
+    def opened(self, element: Element) -> None:
+        """Called when an element is opened, after it's pushed onto the stack."""
+
+    def closed(self, element: Element) -> None:
+        """Called when an element is closed, after it's popped off the stack."""
+
+    def text(self, data: str) -> None:
+        """Called with each text node, before it's added to its parent."""
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, t.Optional[str]]]) -> None:
+        element = Element(tag, dict(attrs))
+        self.stack.append(element)
+        self.opened(element)
+        if tag in VOID_ELEMENTS:
+            self.close_element()
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, t.Optional[str]]]) -> None:
+        self.stack.append(Element(tag, dict(attrs)))
+        self.opened(self.stack[-1])
+        self.close_element()
+
+    def handle_endtag(self, tag: str) -> None:
+        # Like Beautiful Soup, close anything left open inside the element,
+        # and ignore end tags for elements that aren't open.
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                while len(self.stack) > i:
+                    self.close_element()
+                return
+
+    def handle_data(self, data: str) -> None:
+        self.text(data)
+        self.stack[-1].add_child(data)
+
+    def handle_comment(self, data: str) -> None:
+        self.handle_data(data)
+
+    def close_element(self) -> None:
+        """Close the innermost open element."""
+        element = self.stack.pop()
+        self.stack[-1].add_child(element.get_string())
+        self.closed(element)
+
+    def scan(self, html: str) -> None:
+        """Scan a page, stopping early once the scanner's done.
+
+        Args:
+            html: The page.
+        """
+        for i in range(0, len(html), CHUNK_SIZE):
+            self.feed(html[i : i + CHUNK_SIZE])
+            if self.done:
+                return
+        self.close()
+
+
+class ZoneTableScanner(Scanner):
+    """Picks the links to each zone's page out of the root zone database.
+
+    This matches what the `#tld-table .tld a` selector would, and for each
+    link, collects the `.string` of every cell in its row.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        # Per open element, whether it's within the table, and whether it's
+        # within an element with the `tld` class within the table.
+        self.scopes: list[tuple[bool, bool]] = [(False, False)]
+        # Per open row, the `.string` of each of its cells, and its links.
+        self.rows: list[tuple[list[t.Optional[str]], list[Element]]] = []
+        # Per open cell, its row's cells and its index among them.
+        self.cells: list[tuple[list[t.Optional[str]], int]] = []
+        # Each link found and its row's cells, in the order found.
+        self.found: list[tuple[Element, list[t.Optional[str]]]] = []
+
+    def opened(self, element: Element) -> None:
+        in_table, in_tld = self.scopes[-1]
+        if element.tag == "a" and in_tld and self.rows:
+            self.rows[-1][1].append(element)
+        elif element.tag == "tr":
+            self.rows.append(([], []))
+        elif element.tag == "td" and self.rows:
+            cells = self.rows[-1][0]
+            cells.append(None)
+            self.cells.append((cells, len(cells) - 1))
+        classes = (element.attrs.get("class") or "").split()
+        self.scopes.append(
+            (
+                in_table or element.attrs.get("id") == "tld-table",
+                in_tld or (in_table and "tld" in classes),
+            )
+        )
+
+    def closed(self, element: Element) -> None:
+        self.scopes.pop()
+        if element.tag == "td" and self.cells:
+            cells, i = self.cells.pop()
+            cells[i] = element.get_string()
+        elif element.tag == "tr" and self.rows:
+            cells, links = self.rows.pop()
+            self.found.extend((link, cells) for link in links)
+
+
+def zone_urls(base_url: str, html: str) -> t.Iterator[tuple[str, str]]:
+    """Extract zone URLs from the root zone database HTML.
+
+    Args:
+        base_url: The base URL of the root zone database.
+        html: The root zone database page.
+
+    Yields:
+        Tuples of (zone, zone URL), with the zone as it appears on the page.
+    """
+    scanner = ZoneTableScanner()
+    scanner.scan(html)
+    for link, cells in scanner.found:
+        label = link.get_string()
+        if "href" not in link.attrs or label is None:
+            continue
+        # Is this a zone we should skip/ignore?
+        if len(cells) > 1 and cells[1] == "test":
+            continue
+        if len(cells) > 2 and cells[2] in ("Not assigned", "Retired"):
+            continue
+        yield (label, urljoin(base_url, link.attrs["href"] or ""))
+
+
+# States of the WHOIS server scanner.
+SEARCHING = 0
+AFTER_LABEL = 1
+IN_TEXT = 2
+IN_ELEMENT = 3
+DONE = 4
+
+
+class WhoisServerScanner(Scanner):
+    """Picks the WHOIS server out of a zone's page.
+
+    The WHOIS server is the text of whatever follows the first `<b>` element
+    reading `WHOIS Server:`, whether that's text or an element.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.state = SEARCHING
+        # The depth of the label's next sibling, if it's an element.
+        self.depth = 0
+        self.parts: list[str] = []
+
+    def finish(self) -> None:
+        self.state = DONE
+        self.done = True
+
+    def opened(self, element: Element) -> None:  # noqa: ARG002
+        if self.state == AFTER_LABEL:
+            self.state = IN_ELEMENT
+            self.depth = len(self.stack) - 1
+        elif self.state == IN_TEXT:
+            self.finish()
+
+    def closed(self, element: Element) -> None:
+        if self.state == SEARCHING:
+            if element.tag == "b" and element.get_string() == "WHOIS Server:":
+                self.state = AFTER_LABEL
+        elif self.state == AFTER_LABEL or (self.state == IN_ELEMENT and len(self.stack) == self.depth):
+            self.finish()
+
+    def text(self, data: str) -> None:
+        if self.state == AFTER_LABEL:
+            self.state = IN_TEXT
+        if self.state in (IN_TEXT, IN_ELEMENT):
+            self.parts.append(data)
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.state in (AFTER_LABEL, IN_TEXT):
+            self.finish()
+        elif self.state != DONE:
+            super().handle_endtag(tag)
+
+    def handle_comment(self, data: str) -> None:
+        # Comments aren't part of an element's text.
+        self.stack[-1].add_child(data)
+
+
+def whois_server(html: str) -> t.Optional[str]:
+    """Extract the WHOIS server from a zone HTML page.
+
+    Args:
+        html: The zone's page.
+
+    Returns:
+        The WHOIS server, or `None` if not found.
+    """
+    scanner = WhoisServerScanner()
+    scanner.scan(html)
+    server = "".join(scanner.parts).strip().lower()
+    return None if server == "" else server
@@ -0,0 +1,293 @@
+"""Upstream health tracking."""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+# An upstream WHOIS server, as a 2-tuple of its hostname and port.
+Upstream = tuple[str, int]
+
+# Circuit breaker states.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# How much weight each new query gets in the moving averages.
+SMOOTHING = 0.1
+
+
+class UnavailableError(Exception):
+    """An upstream WHOIS server is being avoided as it's unhealthy."""
+
+    def __init__(self, upstream: Upstream) -> None:
+        super().__init__(f"Upstream server {upstream[0]}:{upstream[1]} is unavailable")
+        self.upstream = upstream
+
+
+class Breaker:
+    """Tracks the health of an upstream WHOIS server.
+
+    The success rate and latency of queries against the upstream are tracked
+    as exponentially weighted moving averages. After `threshold` consecutive
+    failures, the breaker opens and queries against the upstream fail fast
+    rather than each waiting on it to time out. After `reset_timeout` seconds,
+    the breaker goes half-open and lets a single query through as a probe: if
+    it succeeds, the breaker closes again, and if not, it reopens.
+
+    Args:
+        upstream: The upstream WHOIS server.
+        threshold: Number of consecutive failures that open the breaker, or 0
+            to never open it.
+        reset_timeout: Seconds to wait after opening before probing.
+    """
+
+    __slots__ = (
+        "failures",
+        "latency",
+        "opened",
+        "probing",
+        "reset_timeout",
+        "state",
+        "success_rate",
+        "threshold",
+        "upstream",
+    )
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, upstream: Upstream, threshold: int = 5, reset_timeout: float = 30) -> None:
+        super().__init__()
+        self.upstream = upstream
+        self.threshold = int(threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.probing = False
+        self.success_rate = 1.0
+        self.latency = 0.0
+
+    def __repr__(self) -> str:
+        return (
+            f"<Breaker {self.upstream[0]}:{self.upstream[1]} state={self.state}"
+            f" success_rate={self.success_rate:.2f} latency={self.latency:.3f}>"
+        )
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            log = logger.warning if state == OPEN else logger.info
+            log("Circuit breaker for %s:%d is now %s", self.upstream[0], self.upstream[1], state)
+            self.state = state
+
+    def is_available(self) -> bool:
+        """Check whether a query could be made against the upstream.
+
+        Unlike `allow`, this doesn't change the breaker's state.
+
+        Returns:
+            `True` if the breaker is closed or due a probe.
+        """
+        if self.state == OPEN:
+            return self.clock() - self.opened >= self.reset_timeout
+        return self.state == CLOSED or not self.probing
+
+    def allow(self) -> bool:
+        """Check whether a query can be made against the upstream.
+
+        If the breaker's been open long enough, this moves it to half-open and
+        lets the query through as the probe.
+
+        Returns:
+            `True` if the query can go ahead.
+        """
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if self.clock() - self.opened < self.reset_timeout:
+                return False
+            self._transition(HALF_OPEN)
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def _record(self, success: float, latency: float) -> None:
+        self.probing = False
+        self.success_rate += SMOOTHING * (success - self.success_rate)
+        self.latency += SMOOTHING * (latency - self.latency)
+
+    def succeed(self, latency: float) -> None:
+        """Record a successful query against the upstream.
+
+        Args:
+            latency: How long the query took in seconds.
+        """
+        self._record(1.0, latency)
+        self.failures = 0
+        self._transition(CLOSED)
+
+    def fail(self, latency: float) -> None:
+        """Record a failed query against the upstream.
+
+        Args:
+            latency: How long the query took in seconds.
+        """
+        self._record(0.0, latency)
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.threshold > 0 and self.failures >= self.threshold):
+            self.opened = self.clock()
+            self._transition(OPEN)
+
+    def abandon(self) -> None:
+        """Note that a query was abandoned before it could succeed or fail."""
+        self.probing = False
+
+
+class HealthTracker:
+    """Tracks the health of every upstream WHOIS server queried.
+
+    Which servers get queried is up to clients, as a made up zone is sent to
+    a made up server, so breakers are kept in least recently used order, and
+    once there are too many, the least recently used are dropped. An upstream
+    whose breaker was dropped starts afresh.
+
+    Args:
+        threshold: Number of consecutive failures that open an upstream's
+            breaker, or 0 to never open it.
+        reset_timeout: Seconds to wait after opening a breaker before probing.
+        max_upstreams: Maximum number of breakers to keep.
+    """
+
+    __slots__ = (
+        "breakers",
+        "max_upstreams",
+        "reset_timeout",
+        "threshold",
+    )
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30, max_upstreams: int = 1024) -> None:
+        super().__init__()
+        self.threshold = int(threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.max_upstreams = int(max_upstreams)
+        self.breakers: t.OrderedDict[Upstream, Breaker] = collections.OrderedDict()
+
+    def __repr__(self) -> str:
+        unhealthy = sum(1 for breaker in self.breakers.values() if breaker.state != CLOSED)
+        return f"<HealthTracker upstreams={len(self.breakers)} unhealthy={unhealthy}>"
+
+    def get_breaker(self, server: str, port: int) -> Breaker:
+        """Get the breaker for an upstream.
+
+        Args:
+            server: The WHOIS server hostname.
+            port: The WHOIS server port.
+
+        Returns:
+            The breaker.
+        """
+        upstream = (server, port)
+        breaker = self.breakers.get(upstream)
+        if breaker is None:
+            breaker = self.breakers[upstream] = Breaker(upstream, self.threshold, self.reset_timeout)
+            while len(self.breakers) > self.max_upstreams:
+                self.breakers.popitem(last=False)
+        else:
+            self.breakers.move_to_end(upstream)
+        return breaker
+
+    def check(self, server: str, port: int) -> None:
+        """Fail fast if an upstream is unavailable.
+
+        This is for checking before waiting on anything else, such as the
+        upstream's rate limits, in preference to waiting only to fail.
+
+        Args:
+            server: The WHOIS server hostname.
+            port: The WHOIS server port.
+
+        Raises:
+            UnavailableError: If the upstream's breaker is open.
+        """
+        breaker = self.get_breaker(server, port)
+        if not breaker.is_available():
+            raise UnavailableError(breaker.upstream)
+
+    @contextlib.contextmanager
+    def track(self, server: str, port: int) -> t.Iterator[None]:
+        """Track the outcome of a query against an upstream.
+
+        Timeouts and connection errors count as failures. Anything else going
+        wrong isn't the upstream's fault, so doesn't count either way.
+
+        Args:
+            server: The WHOIS server hostname.
+            port: The WHOIS server port.
+
+        Raises:
+            UnavailableError: If the upstream's breaker is open.
+        """
+        breaker = self.get_breaker(server, port)
+        if not breaker.allow():
+            raise UnavailableError(breaker.upstream)
+        start = time.perf_counter()
+        try:
+            yield
+        except (OSError, asyncio.TimeoutError) as exc:
+            breaker.fail(time.perf_counter() - start)
+            logger.info("Query to %s:%d failed: %r", server, port, exc)
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.succeed(time.perf_counter() - start)
+
+    def collect(self) -> dict[tuple[str, ...], float]:
+        """Collect the state of every breaker for the metrics.
+
+        Returns:
+            Maps each upstream and state onto 1 if it's the upstream's current
+            state, and 0 otherwise.
+        """
+        return {
+            (f"{server}:{port}", state): float(breaker.state == state)
+            for (server, port), breaker in self.breakers.items()
+            for state in (CLOSED, OPEN, HALF_OPEN)
+        }
+
+    def collect_success_rates(self) -> dict[tuple[str, ...], float]:
+        """Collect the success rate of every upstream for the metrics.
+
+        Returns:
+            Maps each upstream onto its success rate.
+        """
+        return {(f"{server}:{port}",): breaker.success_rate for (server, port), breaker in self.breakers.items()}
+
+    def collect_latencies(self) -> dict[tuple[str, ...], float]:
+        """Collect the latency of every upstream for the metrics.
+
+        Returns:
+            Maps each upstream onto its average latency in seconds.
+        """
+        return {(f"{server}:{port}",): breaker.latency for (server, port), breaker in self.breakers.items()}
+
+
+def get_health_tracker(cfg: dict[str, str]) -> HealthTracker:
+    """Create the upstream health tracker from the configuration.
+
+    Args:
+        cfg: The health configuration.
+
+    Returns:
+        The health tracker.
+    """
+    return HealthTracker(
+        int(cfg.get("threshold", 5)),
+        float(cfg.get("reset_timeout", 30)),
+        int(cfg.get("max_upstreams", 1024)),
+    )
@@ -0,0 +1,375 @@
+"""Metrics, exposed in the Prometheus text format."""
+
+import asyncio
+import bisect
+import logging
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+Labels = tuple[str, ...]
+
+# Default histogram buckets in seconds, covering everything from cache hits to
+# upstream queries that time out.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    """Escape a label value.
+
+    Args:
+        value: The label value.
+
+    Returns:
+        The escaped label value.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: t.Sequence[str], values: t.Sequence[str], extra: str = "") -> str:
+    """Format a set of labels.
+
+    Args:
+        names: The label names.
+        values: The label values.
+        extra: Any extra preformatted label to add.
+
+    Returns:
+        The formatted labels, including braces, or an empty string if there
+        are none.
+    """
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    """Format a sample value.
+
+    Args:
+        value: The sample value.
+
+    Returns:
+        The formatted value.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class for metrics.
+
+    Args:
+        name: The metric name.
+        documentation: The help text for the metric.
+        labelnames: The names of the metric's labels.
+    """
+
+    __slots__ = (
+        "documentation",
+        "labelnames",
+        "name",
+    )
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: t.Sequence[str] = ()) -> None:
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> t.Iterator[str]:
+        """Generate the metric's sample lines.
+
+        Yields:
+            Sample lines.
+        """
+        raise NotImplementedError
+
+    def render(self) -> t.Iterator[str]:
+        """Generate the metric in the Prometheus text format.
+
+        Yields:
+            Lines of the exposition.
+        """
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    """A value that only ever goes up."""
+
+    __slots__ = ("values",)
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: t.Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        """Increment the counter.
+
+        Args:
+            labels: The label values, in the same order as the label names.
+            amount: The amount to increment the counter by.
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels: Labels = ()) -> float:
+        """Get the current value of the counter.
+
+        Args:
+            labels: The label values.
+
+        Returns:
+            The value.
+        """
+        return self.values.get(labels, 0)
+
+    def samples(self) -> t.Iterator[str]:
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    __slots__ = ()
+
+    kind = "gauge"
+
+    def dec(self, labels: Labels = (), amount: float = 1) -> None:
+        """Decrement the gauge.
+
+        Args:
+            labels: The label values, in the same order as the label names.
+            amount: The amount to decrement the gauge by.
+        """
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        """Set the gauge.
+
+        Args:
+            value: The new value.
+            labels: The label values, in the same order as the label names.
+        """
+        self.values[labels] = value
+
+
+class Callback(Metric):
+    """A metric whose values are collected from elsewhere when rendered.
+
+    Args:
+        name: The metric name.
+        documentation: The help text for the metric.
+        labelnames: The names of the metric's labels.
+        collect: Called to get the values, as a mapping of label values onto
+            sample values.
+        kind: The metric type.
+    """
+
+    __slots__ = ("collect", "kind")
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: t.Sequence[str],
+        collect: t.Callable[[], t.Mapping[Labels, float]],
+        kind: str = "gauge",
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self.kind = kind  # type: ignore[misc]
+
+    def samples(self) -> t.Iterator[str]:
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    """A distribution of observed values, such as latencies.
+
+    Args:
+        name: The metric name.
+        documentation: The help text for the metric.
+        labelnames: The names of the metric's labels.
+        buckets: The upper bounds of the buckets, in increasing order.
+    """
+
+    __slots__ = ("buckets", "values")
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: t.Sequence[str] = (),
+        buckets: t.Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Maps label values onto the count in each bucket (with a final
+        # bucket for anything bigger) and the sum of the observations.
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        """Record an observation.
+
+        Args:
+            value: The observed value.
+            labels: The label values, in the same order as the label names.
+        """
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        """Get the number of observations made.
+
+        Args:
+            labels: The label values.
+
+        Returns:
+            The number of observations.
+        """
+        entry = self.values.get(labels)
+        return 0 if entry is None else sum(entry[0])
+
+    def samples(self) -> t.Iterator[str]:
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}"
+            formatted = format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{formatted} {format_value(total[0])}"
+            yield f"{self.name}_count{formatted} {cumulative}"
+
+
+class Registry:
+    """A collection of metrics to be exposed together."""
+
+    __slots__ = ("metrics",)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric to the registry, replacing any of the same name.
+
+        Args:
+            metric: The metric to add.
+
+        Returns:
+            The metric.
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format.
+
+        Returns:
+            The exposition.
+        """
+        lines: list[str] = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: t.Sequence[str] = ()) -> Counter:
+    """Create a counter in the default registry.
+
+    Args:
+        name: The metric name.
+        documentation: The help text for the metric.
+        labelnames: The names of the metric's labels.
+
+    Returns:
+        The counter.
+    """
+    return t.cast("Counter", REGISTRY.register(Counter(name, documentation, labelnames)))
+
+
+def gauge(name: str, documentation: str, labelnames: t.Sequence[str] = ()) -> Gauge:
+    """Create a gauge in the default registry.
+
+    Args:
+        name: The metric name.
+        documentation: The help text for the metric.
+        labelnames: The names of the metric's labels.
+
+    Returns:
+        The gauge.
+    """
+    return t.cast("Gauge", REGISTRY.register(Gauge(name, documentation, labelnames)))
+
+
+def histogram(name: str, documentation: str, labelnames: t.Sequence[str] = ()) -> Histogram:
+    """Create a latency histogram in the default registry.
+
+    Args:
+        name: The metric name.
+        documentation: The help text for the metric.
+        labelnames: The names of the metric's labels.
+
+    Returns:
+        The histogram.
+    """
+    return t.cast("Histogram", REGISTRY.register(Histogram(name, documentation, labelnames)))
+
+
+async def start_service(iface: str, port: int, registry: Registry = REGISTRY) -> None:
+    """Serve the metrics over HTTP.
+
+    Args:
+        iface: The interface to bind to.
+        port: The port to bind to.
+        registry: The registry to expose.
+    """
+
+    async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        method, path, *_ = (*head.split(b"\r\n", 1)[0].decode("latin-1").split(" "), "", "")
+        if method != "GET":
+            status, body = "405 Method Not Allowed", b""
+        elif path.split("?", 1)[0] != "/metrics":
+            status, body = "404 Not Found", b""
+        else:
+            status, body = "200 OK", registry.render().encode()
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n".encode()
+            + body
+        )
+        await writer.drain()
+        writer.close()
+
+    logger.info("Serving metrics on %s:%d", iface, port)
+    svr = await asyncio.start_server(handle_request, host=iface, port=port)
+    async with svr:
+        await svr.serve_forever()
@@ -0,0 +1,257 @@
+"""IP address queries, and the networks they fall within."""
+
+import ipaddress
+import re
+import typing as t
+
+from . import utils
+
+T = t.TypeVar("T")
+
+Address = t.Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+Network = t.Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# The zones address queries fall under, by IP version.
+ZONES = {4: "ipv4", 6: "ipv6"}
+
+# Where to send queries for addresses not covered by any assignment. IANA's
+# WHOIS server refers them on to the right regional internet registry.
+DEFAULT_SERVER = "whois.iana.org"
+
+# Lines in a regional internet registry's response giving the network an
+# address falls within, as either a range or in CIDR notation.
+NETWORK_LINE = re.compile(r"^(?:inet6?num|netrange|cidr):[ \t]*(?P<value>\S.*?)\s*$", re.IGNORECASE | re.MULTILINE)
+
+
+def parse_network(value: str) -> t.Optional[Network]:
+    """Parse a network in CIDR notation, allowing trailing zeros to be left off.
+
+    Some registries abbreviate networks, such as `200.3.12/22` for
+    `200.3.12.0/22`, and the IPv4 assignments give just the first octet of
+    each /8.
+
+    Args:
+        value: The network.
+
+    Returns:
+        The network, or `None` if it's not valid.
+    """
+    address, _, length = value.strip().partition("/")
+    if ":" not in address:
+        octets = address.split(".")
+        if len(octets) == 1 and not length:
+            length = "8"
+        address = ".".join(octets + ["0"] * (4 - len(octets)))
+    try:
+        return ipaddress.ip_network(f"{address}/{length}" if length else address, strict=False)
+    except ValueError:
+        return None
+
+
+def parse_networks(value: str) -> t.Iterator[Network]:
+    """Parse the networks given on a line of a WHOIS response.
+
+    Args:
+        value: The value of the line, either a range of addresses or a comma
+            separated list of networks.
+
+    Yields:
+        The networks.
+    """
+    if "-" in value:
+        first, _, last = value.partition("-")
+        try:
+            yield from ipaddress.summarize_address_range(
+                ipaddress.ip_address(first.strip()),
+                ipaddress.ip_address(last.strip()),
+            )
+        except (ValueError, TypeError):
+            return
+        return
+    for part in value.split(","):
+        network = parse_network(part)
+        if network is not None:
+            yield network
+
+
+def find_network(response: str, address: Address) -> t.Optional[Network]:
+    """Find the most specific network a WHOIS response gives for an address.
+
+    Args:
+        response: The response to a query for the address.
+        address: The address.
+
+    Returns:
+        The network, or `None` if the response doesn't give one covering the
+        address.
+    """
+    found = None
+    for match in NETWORK_LINE.finditer(response):
+        for network in parse_networks(match.group("value")):
+            if address in network and (found is None or network.prefixlen > found.prefixlen):
+                found = network
+    return found
+
+
+class PrefixTable(t.Generic[T]):
+    """A longest-prefix-match table of IP networks.
+
+    Networks are kept in a dict per IP version and prefix length, keyed on the
+    network's address with the host bits shifted off. Finding the longest
+    network covering an address takes a single dict lookup for each distinct
+    prefix length in the table, longest first, however many networks there
+    are. A table built from the IPv4 assignments, which are all /8s, takes
+    just the one.
+    """
+
+    __slots__ = (
+        "lengths",
+        "tables",
+    )
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.tables: dict[tuple[int, int], dict[int, T]] = {}
+        # Per IP version, the prefix lengths in the table, longest first.
+        self.lengths: dict[int, list[int]] = {4: [], 6: []}
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self.tables.values())
+
+    def add(self, network: Network, value: T) -> None:
+        """Add a network to the table, replacing any existing entry for it.
+
+        Args:
+            network: The network.
+            value: The value to store for the network.
+        """
+        key = (network.version, network.prefixlen)
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = {}
+            lengths = self.lengths[network.version]
+            lengths.append(network.prefixlen)
+            lengths.sort(reverse=True)
+        table[int(network.network_address) >> (network.max_prefixlen - network.prefixlen)] = value
+
+    def lookup(self, address: Address) -> t.Optional[T]:
+        """Find the longest network in the table covering an address.
+
+        Args:
+            address: The address.
+
+        Returns:
+            The value stored for the network, or `None` if no network in the
+            table covers the address.
+        """
+        n = int(address)
+        for length in self.lengths[address.version]:
+            value = self.tables[(address.version, length)].get(n >> (address.max_prefixlen - length))
+            if value is not None:
+                return value
+        return None
+
+    def clear(self) -> None:
+        """Remove every network from the table."""
+        self.tables.clear()
+        for lengths in self.lengths.values():
+            lengths.clear()
+
+
+class CoveringPrefixes:
+    """Keys cached responses to address queries by the network they cover.
+
+    A regional internet registry answers a query for an address with the
+    record for the network it falls within, so every address in that network
+    gets the same response. Once a response is cached under its network, the
+    network's noted, and queries for any other address in it are answered
+    from the cache.
+
+    A response is never shared any wider than `ipv4_prefix` or `ipv6_prefix`
+    allows, even if the network it gives is, as there may be more specific
+    networks within it. Other queries, and responses that don't give a
+    network, are keyed by the query as usual.
+
+    Args:
+        ipv4_prefix: Length of the widest network to share IPv4 responses
+            across.
+        ipv6_prefix: Length of the widest network to share IPv6 responses
+            across.
+        max_size: Maximum number of networks to note. Once there are this
+            many, they're all forgotten, and noted afresh as they're seen.
+    """
+
+    __slots__ = (
+        "max_size",
+        "networks",
+        "prefixes",
+    )
+
+    def __init__(self, ipv4_prefix: int = 24, ipv6_prefix: int = 48, max_size: int = 65536) -> None:
+        super().__init__()
+        self.prefixes = {4: int(ipv4_prefix), 6: int(ipv6_prefix)}
+        self.max_size = int(max_size)
+        self.networks: PrefixTable[str] = PrefixTable()
+
+    def __repr__(self) -> str:
+        return f"<CoveringPrefixes networks={len(self.networks)}>"
+
+    def key(self, query: str) -> str:
+        """Get the key to look up a query's response under.
+
+        Args:
+            query: The WHOIS query.
+
+        Returns:
+            The network a response covering the address was cached under if
+            there is one, and the query otherwise.
+        """
+        address = utils.parse_address(query)
+        # Queries for whole networks are keyed as they are, as a response
+        # for part of one won't do.
+        if address is None or "/" in query:
+            return query
+        key = self.networks.lookup(address)
+        return query if key is None else key
+
+    def key_response(self, query: str, response: str) -> str:
+        """Get the key to cache a query's response under.
+
+        Args:
+            query: The WHOIS query.
+            response: The response.
+
+        Returns:
+            The network the response covers if it's an address query and the
+            response gives one, and the query otherwise.
+        """
+        address = utils.parse_address(query)
+        if address is None or "/" in query:
+            return query
+        network = find_network(response, address)
+        if network is None:
+            return query
+        widest = ipaddress.ip_network((address, self.prefixes[address.version]), strict=False)
+        if network.prefixlen < widest.prefixlen:
+            network = widest
+        if len(self.networks) >= self.max_size:
+            self.networks.clear()
+        key = str(network)
+        self.networks.add(network, key)
+        return key
+
+
+def get_covering_prefixes(cfg: dict[str, str]) -> CoveringPrefixes:
+    """Create the cache keying for address queries from the configuration.
+
+    Args:
+        cfg: The addresses configuration.
+
+    Returns:
+        The cache keying.
+    """
+    return CoveringPrefixes(
+        int(cfg.get("ipv4_prefix", 24)),
+        int(cfg.get("ipv6_prefix", 48)),
+        int(cfg.get("max_size", 65536)),
+    )
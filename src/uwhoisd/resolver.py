@@ -0,0 +1,158 @@
+"""Caching hostname resolution."""
+
+import asyncio
+import logging
+import socket
+import time
+import typing as t
+
+from . import caching, metrics
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = metrics.counter(
+    "uwhoisd_resolver_lookups_total",
+    "Hostname lookups, by whether they were answered from the resolver's cache.",
+    ("cache",),
+)
+EVICTIONS = metrics.counter(
+    "uwhoisd_resolver_evictions_total",
+    "Hosts evicted from the resolver's cache, by whether they expired or were pushed out to make room.",
+    ("reason",),
+)
+
+# A resolved address, as a 2-tuple of the address family and the host part of
+# the socket address.
+Address = tuple[int, str]
+
+
+class Resolver:
+    """An asynchronous resolver that caches the addresses of WHOIS servers.
+
+    Resolved addresses are cached for `max_age` seconds and failed lookups for
+    `negative_max_age` seconds. Concurrent lookups of the same host share a
+    single lookup, while lookups of different hosts run in parallel. An
+    address that can't be connected to can be discarded so later connections
+    skip it; once every address for a host has been discarded, the host is
+    looked up afresh.
+
+    Args:
+        max_size: Maximum number of hosts to cache.
+        max_age: Seconds to cache resolved addresses for.
+        negative_max_age: Seconds to cache failed lookups for.
+    """
+
+    __slots__ = (
+        "cache",
+        "flights",
+        "hits",
+        "max_age",
+        "max_size",
+        "misses",
+        "negative_max_age",
+    )
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, max_size: int = 4096, max_age: int = 300, negative_max_age: int = 30) -> None:
+        super().__init__()
+        # Maps hosts onto when their entry expires and their addresses, or the
+        # error looking them up raised.
+        self.cache: dict[str, tuple[float, t.Union[list[Address], OSError]]] = {}
+        self.flights: caching.SingleFlight[list[Address]] = caching.SingleFlight()
+        self.max_size = int(max_size)
+        self.max_age = int(max_age)
+        self.negative_max_age = int(negative_max_age)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"<Resolver hosts={len(self.cache)} hits={self.hits} misses={self.misses}>"
+
+    async def resolve(self, host: str, port: int) -> list[Address]:
+        """Get the addresses for a host.
+
+        Args:
+            host: The hostname to resolve.
+            port: The port that will be connected to.
+
+        Returns:
+            The host's addresses.
+
+        Raises:
+            OSError: If the lookup failed.
+        """
+        entry = self.cache.get(host)
+        if entry is not None:
+            expires, result = entry
+            if expires > self.clock():
+                self.hits += 1
+                LOOKUPS.inc(("hit",))
+                if isinstance(result, OSError):
+                    raise type(result)(*result.args)
+                return result
+            del self.cache[host]
+            EVICTIONS.inc(("expired",))
+        self.misses += 1
+        LOOKUPS.inc(("miss",))
+        return await self.flights.run(host, lambda: self.lookup(host, port))
+
+    async def lookup(self, host: str, port: int) -> list[Address]:
+        """Look up a host and cache the result.
+
+        Args:
+            host: The hostname to resolve.
+            port: The port that will be connected to.
+
+        Returns:
+            The host's addresses.
+
+        Raises:
+            OSError: If the lookup failed.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as exc:
+            self.store(host, self.negative_max_age, exc)
+            raise
+        addrs: list[Address] = []
+        for family, _, _, _, sockaddr in infos:
+            addr = (family, str(sockaddr[0]))
+            if addr not in addrs:
+                addrs.append(addr)
+        self.store(host, self.max_age, addrs)
+        return addrs
+
+    def store(self, host: str, max_age: int, result: t.Union[list[Address], OSError]) -> None:
+        """Cache the result of looking up a host.
+
+        Args:
+            host: The hostname.
+            max_age: Seconds to cache the result for.
+            result: The addresses, or the error raised by the lookup.
+        """
+        self.cache.pop(host, None)
+        if len(self.cache) >= self.max_size:
+            # Entries are kept in the order they were stored, so this drops
+            # the oldest.
+            del self.cache[next(iter(self.cache))]
+            EVICTIONS.inc(("capacity",))
+        self.cache[host] = (self.clock() + max_age, result)
+
+    def discard(self, host: str, addr: Address) -> None:
+        """Stop handing out an address that couldn't be connected to.
+
+        Args:
+            host: The hostname.
+            addr: The address to discard.
+        """
+        entry = self.cache.get(host)
+        if entry is None or isinstance(entry[1], OSError):
+            return
+        addrs = [other for other in entry[1] if other != addr]
+        if addrs:
+            self.cache[host] = (entry[0], addrs)
+        else:
+            del self.cache[host]
+        logger.info("Discarded address %s for %s", addr[1], host)
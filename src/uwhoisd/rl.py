@@ -1,7 +1,12 @@
 """Rate limiting."""
 
+import asyncio
+import collections
+import contextlib
 import functools
+import ipaddress
 import time
+import typing as t
 
 
 @functools.total_ordering
@@ -22,7 +27,7 @@ class TokenBucket:
 
     clock = staticmethod(time.time)
 
-    def __init__(self, rate: int, limit: int) -> None:
+    def __init__(self, rate: float, limit: int) -> None:
         super().__init__()
         self.ts = self.clock()
         self.rate = rate
@@ -71,3 +76,443 @@ class TokenBucket:
     def __setstate__(self, state):
         for k in self.__slots__:
             setattr(self, k, state[k])
+
+
+class RateLimitedError(Exception):
+    """Too many queries are already waiting on an upstream WHOIS server.
+
+    Args:
+        upstream: The name of the upstream whose limits were hit.
+    """
+
+    def __init__(self, upstream: str) -> None:
+        super().__init__(f"Rate limit exceeded for {upstream}")
+        self.upstream = upstream
+
+
+class Limits(t.NamedTuple):
+    """Limits on how hard an upstream WHOIS server can be queried.
+
+    Attributes:
+        rate: Queries per second allowed, or zero for no limit.
+        burst: How many queries can be made at once before the rate applies.
+        connections: Maximum number of concurrent connections, or zero for no
+            limit.
+        queue: Maximum number of queries that can wait for the upstream to
+            become available before further queries are rejected outright.
+    """
+
+    rate: float = 0.0
+    burst: int = 1
+    connections: int = 0
+    queue: int = 16
+
+
+def parse_limits(value: str) -> Limits:
+    """Parse a set of upstream limits from the configuration.
+
+    Limits are given as space-separated `name=value` pairs, with the names
+    being those of the fields of `Limits`. If a rate is given without a
+    burst, the burst is one second's worth of queries.
+
+    Args:
+        value: The configuration value.
+
+    Returns:
+        The limits.
+    """
+    fields: dict[str, t.Any] = {}
+    for pair in value.split():
+        name, _, setting = pair.partition("=")
+        if name not in Limits._fields:
+            raise ValueError(f"Unknown upstream limit: {name!r}")
+        fields[name] = float(setting) if name == "rate" else int(setting)
+    if "burst" not in fields:
+        fields["burst"] = max(1, int(fields.get("rate", 1)))
+    return Limits(**fields)
+
+
+def partition_limits(limits: Limits, parts: int) -> Limits:
+    """Split a set of upstream limits into equal parts.
+
+    This is for when each of several worker processes enforces the limits on
+    its own and the total across them is to stay within the configured
+    limits. Counts can't be split any finer than one each, so a count smaller
+    than the number of parts comes out as one.
+
+    Args:
+        limits: The limits.
+        parts: The number of parts to split the limits into.
+
+    Returns:
+        The limits for each part.
+    """
+    if parts <= 1:
+        return limits
+    return Limits(
+        limits.rate / parts,
+        max(1, limits.burst // parts),
+        max(1, limits.connections // parts) if limits.connections > 0 else 0,
+        max(1, limits.queue // parts) if limits.queue > 0 else 0,
+    )
+
+
+class Upstream:
+    """Enforces the limits on a single upstream WHOIS server.
+
+    Args:
+        name: The name of the upstream.
+        limits: The limits to enforce.
+    """
+
+    __slots__ = (
+        "active",
+        "bucket",
+        "name",
+        "queue",
+        "semaphore",
+        "waiting",
+    )
+
+    def __init__(self, name: str, limits: Limits) -> None:
+        super().__init__()
+        self.name = name
+        self.queue = limits.queue
+        self.bucket = TokenBucket(limits.rate, limits.burst) if limits.rate > 0 else None
+        self.semaphore = asyncio.Semaphore(limits.connections) if limits.connections > 0 else None
+        self.waiting = 0
+        self.active = 0
+
+    def is_idle(self) -> bool:
+        """Check if this upstream is no different from a brand new one.
+
+        Returns:
+            `True` if nothing is waiting on or querying the upstream, and its
+            bucket has refilled.
+        """
+        if self.waiting > 0 or self.active > 0:
+            return False
+        return self.bucket is None or self.bucket.tokens >= self.bucket.limit
+
+    def is_available(self) -> bool:
+        """Check if a query could be made against this upstream immediately.
+
+        Returns:
+            `True` if a query needn't wait.
+        """
+        if self.semaphore is not None and self.semaphore.locked():
+            return False
+        return self.bucket is None or self.bucket.tokens >= 1
+
+    async def acquire(self) -> None:
+        """Wait for a connection slot and a token for this upstream."""
+        if self.semaphore is not None:
+            await self.semaphore.acquire()
+        try:
+            if self.bucket is not None:
+                while not self.bucket.consume(1):
+                    await asyncio.sleep((1 - self.bucket.tokens) / self.bucket.rate)
+        except BaseException:
+            if self.semaphore is not None:
+                self.semaphore.release()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def slot(self, timeout: t.Optional[float] = None) -> t.AsyncIterator[None]:
+        """Wait for a connection slot and a token for this upstream.
+
+        Args:
+            timeout: Maximum number of seconds to wait, if any.
+
+        Raises:
+            RateLimitedError: If too many queries are already waiting.
+            asyncio.TimeoutError: If the wait took too long.
+        """
+        if self.waiting >= self.queue and not self.is_available():
+            raise RateLimitedError(self.name)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.acquire(), timeout)
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+
+class UpstreamLimiter:
+    """Per-upstream rate limits and concurrency caps.
+
+    Limits are looked up by server hostname, then by zone, and finally fall
+    back on the default limits, if any. Upstreams configured by zone share
+    their limits across all the zone's servers.
+
+    With default limits, every server queried gets its own upstream, and which
+    servers get queried is up to clients. Upstreams are kept in least recently
+    used order, and those that have sat idle long enough to be no different
+    from a brand new one are swept from the cold end as new ones are needed.
+    If there are still too many, the least recently used are dropped
+    regardless.
+
+    Args:
+        limits: Maps server hostnames and zones onto their limits. The
+            `default` key, if present, applies to any server not otherwise
+            listed.
+        max_upstreams: Maximum number of upstreams to track.
+    """
+
+    __slots__ = (
+        "default",
+        "limits",
+        "max_upstreams",
+        "upstreams",
+    )
+
+    def __init__(self, limits: t.Optional[t.Mapping[str, Limits]] = None, max_upstreams: int = 1024) -> None:
+        super().__init__()
+        self.limits = dict(limits or {})
+        self.default = self.limits.pop("default", None)
+        self.max_upstreams = int(max_upstreams)
+        self.upstreams: t.OrderedDict[str, Upstream] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.upstreams)
+
+    def get_upstream(self, server: str, zone: t.Optional[str] = None) -> t.Optional[Upstream]:
+        """Get the state tracking the limits on an upstream.
+
+        Args:
+            server: The WHOIS server hostname.
+            zone: The zone being queried, if known.
+
+        Returns:
+            The upstream, or `None` if it's not subject to any limits.
+        """
+        for name in (server, zone):
+            if name is not None and name in self.limits:
+                break
+        else:
+            if self.default is None:
+                return None
+            name = server
+        upstream = self.upstreams.get(name)
+        if upstream is None:
+            self.evict_idle()
+            upstream = Upstream(name, self.limits.get(name, self.default))  # type: ignore[arg-type]
+            self.upstreams[name] = upstream
+            while len(self.upstreams) > self.max_upstreams:
+                self.upstreams.popitem(last=False)
+        else:
+            self.upstreams.move_to_end(name)
+        return upstream
+
+    def evict_idle(self) -> None:
+        """Drop upstreams that are no different from brand new ones."""
+        while self.upstreams:
+            name, upstream = next(iter(self.upstreams.items()))
+            if not upstream.is_idle():
+                break
+            del self.upstreams[name]
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self,
+        server: str,
+        zone: t.Optional[str] = None,
+        timeout: t.Optional[float] = None,
+    ) -> t.AsyncIterator[None]:
+        """Wait until a query can be made against an upstream.
+
+        Args:
+            server: The WHOIS server hostname.
+            zone: The zone being queried, if known.
+            timeout: Maximum number of seconds to wait, if any.
+
+        Raises:
+            RateLimitedError: If too many queries are already waiting.
+            asyncio.TimeoutError: If the wait took too long.
+        """
+        upstream = self.get_upstream(server, zone)
+        if upstream is None:
+            yield
+        else:
+            async with upstream.slot(timeout):
+                yield
+
+
+class ClientLimiter:
+    """Per-client rate limiting with bounded memory.
+
+    Each client address gets its own token bucket and, optionally, so does
+    the network prefix it's in, so that somebody can't get around the limits
+    by spreading their queries across a block of addresses.
+
+    Buckets are kept in least recently used order. A bucket that has sat idle
+    long enough to refill is no different from a brand new one, so those are
+    swept from the cold end as new clients arrive, and if there are still too
+    many, the least recently used are dropped regardless.
+
+    Args:
+        rate: Queries per second allowed for each client address.
+        burst: How many queries a client can make at once.
+        prefix_rate: Queries per second allowed for each network prefix, or
+            zero to not limit by prefix.
+        prefix_burst: How many queries a network prefix can make at once.
+        ipv4_prefix: Length of the network prefix for IPv4 clients.
+        ipv6_prefix: Length of the network prefix for IPv6 clients.
+        max_clients: Maximum number of buckets to track.
+    """
+
+    __slots__ = (
+        "buckets",
+        "burst",
+        "ipv4_prefix",
+        "ipv6_prefix",
+        "max_clients",
+        "prefix_burst",
+        "prefix_rate",
+        "rate",
+    )
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        prefix_rate: float = 0,
+        prefix_burst: int = 1,
+        ipv4_prefix: int = 24,
+        ipv6_prefix: int = 48,
+        max_clients: int = 65536,
+    ) -> None:
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.prefix_rate = float(prefix_rate)
+        self.prefix_burst = int(prefix_burst)
+        self.ipv4_prefix = int(ipv4_prefix)
+        self.ipv6_prefix = int(ipv6_prefix)
+        self.max_clients = int(max_clients)
+        self.buckets: t.OrderedDict[str, TokenBucket] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def get_bucket(self, key: str, rate: float, limit: int) -> TokenBucket:
+        """Get the bucket for the given key, creating it if needed.
+
+        Args:
+            key: The client address or network prefix.
+            rate: The refill rate for a new bucket.
+            limit: The capacity of a new bucket.
+
+        Returns:
+            The bucket.
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.evict_idle()
+            bucket = self.buckets[key] = TokenBucket(rate, limit)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def evict_idle(self) -> None:
+        """Drop buckets that have been idle long enough to have refilled."""
+        now = TokenBucket.clock()
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if bucket.ts + bucket.limit / bucket.rate > now:
+                break
+            del self.buckets[key]
+
+    def get_prefix(self, addr: str) -> t.Optional[str]:
+        """Get the network prefix a client address falls in.
+
+        Args:
+            addr: The client address.
+
+        Returns:
+            The network prefix, or `None` if the address isn't an IP address.
+        """
+        try:
+            ip = ipaddress.ip_address(addr)
+        except ValueError:
+            return None
+        length = self.ipv4_prefix if ip.version == 4 else self.ipv6_prefix
+        return str(ipaddress.ip_network((ip, length), strict=False))
+
+    def max_cost(self) -> int:
+        """Get the most queries a client can make at once.
+
+        Returns:
+            The smaller of the client and network prefix bursts.
+        """
+        return min(self.burst, self.prefix_burst) if self.prefix_rate > 0 else self.burst
+
+    def allow(self, addr: str, cost: int = 1) -> bool:
+        """Check if a client may make some queries, and if so, charge them for them.
+
+        Args:
+            addr: The client address.
+            cost: How many queries the client is making.
+
+        Returns:
+            `True` if the client is within their limits.
+        """
+        buckets = [self.get_bucket(addr, self.rate, self.burst)]
+        if self.prefix_rate > 0:
+            prefix = self.get_prefix(addr)
+            if prefix is not None:
+                buckets.append(self.get_bucket(prefix, self.prefix_rate, self.prefix_burst))
+        # Only charge the client if they've tokens to spare in every bucket.
+        if all(bucket.tokens >= cost for bucket in buckets):
+            for bucket in buckets:
+                bucket.consume(cost)
+            return True
+        return False
+
+
+def partition_client_config(cfg: t.Mapping[str, str], parts: int) -> dict[str, str]:
+    """Split a per-client rate limiting configuration's limits into equal parts.
+
+    This is for when each of several worker processes limits clients on its
+    own. Connections are spread between the workers, so each enforcing its
+    share keeps a client within the configured limits overall.
+
+    Args:
+        cfg: The client limits configuration.
+        parts: The number of parts to split the limits into.
+
+    Returns:
+        The client limits configuration for each part.
+    """
+    cfg = dict(cfg)
+    if parts > 1:
+        for key in ("rate", "prefix_rate"):
+            if key in cfg:
+                cfg[key] = str(float(cfg[key]) / parts)
+        for key in ("burst", "prefix_burst"):
+            if key in cfg:
+                cfg[key] = str(max(1, int(cfg[key]) // parts))
+    return cfg
+
+
+def get_client_limiter(cfg: t.Mapping[str, str]) -> t.Optional[ClientLimiter]:
+    """Create the per-client rate limiter from the configuration.
+
+    Args:
+        cfg: The client limits configuration, giving the parameters to pass to
+            the `ClientLimiter` constructor.
+
+    Returns:
+        The limiter, or `None` if per-client rate limiting is disabled.
+    """
+    if float(cfg.get("rate", 0)) <= 0:
+        return None
+    return ClientLimiter(**cfg)  # type: ignore[arg-type]
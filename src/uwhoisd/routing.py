@@ -0,0 +1,335 @@
+"""Query routing."""
+
+import re
+import typing as t
+
+from . import networks, utils
+
+# How many bytes at the head of a thin registry's response to look for the
+# registrar's WHOIS server in.
+REFERRAL_WINDOW = 16384
+
+
+class Route(t.NamedTuple):
+    """Everything needed to query the registry for a zone.
+
+    Attributes:
+        zone: The zone the query falls under.
+        server: The WHOIS server for the zone.
+        port: The port the WHOIS server listens on.
+        prefix: Any prefix to add to the query.
+        pattern: The pattern for extracting the registrar's WHOIS server from
+            the registry's response if it's a thin registry, else `None`.
+    """
+
+    zone: str
+    server: str
+    port: int
+    prefix: str = ""
+    pattern: t.Optional[re.Pattern] = None
+
+
+def parse_server(server: str, default_port: int) -> tuple[str, int]:
+    """Split a `host[:port]` string into its host and port.
+
+    Args:
+        server: The server string.
+        default_port: The port to use if none is given.
+
+    Returns:
+        A tuple of the host and port.
+    """
+    if ":" in server:
+        host, port = server.split(":", 1)
+        return host, int(port)
+    return server, default_port
+
+
+class _Node:
+    __slots__ = ("children", "route")
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.children: dict[str, _Node] = {}
+        self.route: t.Optional[Route] = None
+
+
+class Router:
+    """Map queries onto the zone and WHOIS server they should be routed to.
+
+    Zones are kept in a trie keyed on their labels, last label first, so
+    resolving a query is a single walk down the trie taking time proportional
+    to the number of labels in the query rather than the number of zones
+    configured. The longest configured zone that's a proper suffix of the
+    query wins, so `example.co.bz` goes to `co.bz` if that's configured, and
+    `bz` otherwise.
+
+    If no configured zone matches, the query's zone is taken to be everything
+    after its first label, and the server is derived from that using `suffix`.
+
+    Queries for IP addresses are routed to the WHOIS server of the longest
+    assigned network covering them instead, or to a default server if none
+    does. They fall under the `ipv4` and `ipv6` zones, for the purposes of
+    prefixes, recursion patterns, timeouts, and limits.
+
+    Args:
+        suffix: Hostname suffix used to derive the WHOIS server of zones that
+            have no override.
+        default_port: Port to use when a server doesn't specify one.
+    """
+
+    __slots__ = (
+        "default_port",
+        "networks",
+        "root",
+        "servers",
+        "suffix",
+        "unassigned",
+        "zones",
+    )
+
+    def __init__(self, suffix: t.Optional[str], default_port: int) -> None:
+        super().__init__()
+        self.suffix = suffix
+        self.default_port = default_port
+        self.root = _Node()
+        self.networks: networks.PrefixTable[Route] = networks.PrefixTable()
+        # Per IP version, the route for addresses not in any assigned network.
+        self.unassigned = {
+            version: Route(zone, networks.DEFAULT_SERVER, default_port) for version, zone in networks.ZONES.items()
+        }
+        # The zones and servers in the routing tables, as opposed to those
+        # made up for queries under unknown zones.
+        self.zones: set[str] = set(networks.ZONES.values())
+        self.servers: set[str] = {networks.DEFAULT_SERVER}
+
+    @classmethod
+    def build(
+        cls,
+        suffix: t.Optional[str],
+        default_port: int,
+        overrides: t.Mapping[str, str],
+        prefixes: t.Mapping[str, str],
+        recursion_patterns: t.Mapping[str, re.Pattern],
+        conservative: t.Iterable[str] = (),
+        assignments: t.Optional[t.Mapping[str, str]] = None,
+        unassigned_server: str = networks.DEFAULT_SERVER,
+    ) -> "Router":
+        """Build a router from the routing tables in the configuration.
+
+        A zone without an override of its own inherits the server of the
+        nearest enclosing zone that has one, so listing `co.bz` among the
+        thin registries doesn't stop it going to the `bz` registry. Prefixes
+        and recursion patterns only ever apply to the zone they're listed
+        under.
+
+        Args:
+            suffix: Hostname suffix for zones without a server override.
+            default_port: Port to use when a server doesn't specify one.
+            overrides: Maps zones onto their WHOIS servers.
+            prefixes: Maps zones onto query prefixes.
+            recursion_patterns: Maps thin zones onto the patterns for
+                extracting registrar WHOIS servers.
+            conservative: Zones under which every name is to be queried
+                against the zone itself, however many labels it has.
+            assignments: Maps IP networks onto their WHOIS servers. A bare
+                number is taken to be the first octet of an IPv4 /8.
+            unassigned_server: The WHOIS server for IP addresses not in any
+                assigned network.
+
+        Returns:
+            The router.
+        """
+        router = cls(suffix, default_port)
+
+        def address_route(version: int, server: str) -> Route:
+            zone = networks.ZONES[version]
+            host, port = parse_server(server, default_port)
+            return Route(zone, host, port, prefixes.get(zone, ""), recursion_patterns.get(zone))
+
+        for version in networks.ZONES:
+            router.unassigned[version] = address_route(version, unassigned_server)
+            router.servers.add(router.unassigned[version].server)
+        for key, server in (assignments or {}).items():
+            network = networks.parse_network(key)
+            if network is None:
+                raise ValueError(f"Bad network in IP assignments: {key!r}")
+            route = address_route(network.version, server)
+            router.networks.add(network, route)
+            router.servers.add(route.server)
+
+        zones = set(overrides).union(prefixes, recursion_patterns, conservative).difference(networks.ZONES.values())
+        # Shortest first, so enclosing zones exist before the zones they
+        # enclose and can hand down their servers.
+        for zone in sorted(zones, key=lambda zone: zone.count(".")):
+            if zone in overrides:
+                server, port = parse_server(overrides[zone], default_port)
+            else:
+                enclosing = router.lookup(zone)
+                if enclosing is None:
+                    server, port = f"{zone}.{suffix}", default_port
+                else:
+                    server, port = enclosing.server, enclosing.port
+            router.add(Route(zone, server, port, prefixes.get(zone, ""), recursion_patterns.get(zone)))
+        return router
+
+    def add(self, route: Route) -> None:
+        """Add a route for a zone.
+
+        Args:
+            route: The route to add.
+        """
+        node = self.root
+        for label in reversed(route.zone.split(".")):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        node.route = route
+        self.zones.add(route.zone)
+        self.servers.add(route.server)
+
+    def lookup(self, query: str) -> t.Optional[Route]:
+        """Find the route for the longest configured zone enclosing a query.
+
+        Args:
+            query: The domain name being queried.
+
+        Returns:
+            The route, or `None` if no configured zone encloses the query.
+        """
+        labels = query.split(".")
+        node = self.root
+        found = None
+        # The leftmost label is never part of the zone.
+        for i in range(len(labels) - 1, 0, -1):
+            child = node.children.get(labels[i])
+            if child is None:
+                break
+            node = child
+            if node.route is not None:
+                found = node.route
+        return found
+
+    def route(self, query: str) -> Route:
+        """Work out where a query should be routed.
+
+        Args:
+            query: The domain name or IP address being queried.
+
+        Returns:
+            The route for the query.
+        """
+        address = utils.parse_address(query)
+        if address is not None:
+            route = self.networks.lookup(address)
+            return self.unassigned[address.version] if route is None else route
+        found = self.lookup(query)
+        if found is not None:
+            return found
+        zone = query.split(".", 1)[-1]
+        return Route(zone, f"{zone}.{self.suffix}", self.default_port)
+
+    def route_zone(self, zone: str) -> Route:
+        """Work out where queries for names in a zone should be routed.
+
+        Args:
+            zone: The zone.
+
+        Returns:
+            The zone's own route if it has one, else that of the nearest
+            enclosing zone that does, as for any query for a name in it.
+        """
+        # The leftmost label of a query is never part of its zone, so any
+        # label will do.
+        return self.route(f"_.{zone}")
+
+
+class ReferralScanner:
+    """Looks for the registrar's WHOIS server in a thin registry's response.
+
+    Only the head of the response is scanned, so however big the response,
+    scanning it takes a bounded amount of time and memory. The response is
+    scanned as it arrives, a batch of complete lines at a time, so each byte
+    is only looked at once, and nothing more is scanned once the registrar's
+    WHOIS server is found. Patterns are expected to match within a line, and
+    any line the window ends partway through is left out.
+
+    Args:
+        pattern: The pattern for extracting the registrar's WHOIS server.
+        window: How many bytes at the head of the response to scan.
+    """
+
+    __slots__ = (
+        "match",
+        "partial",
+        "pattern",
+        "remaining",
+    )
+
+    def __init__(self, pattern: re.Pattern, window: int = REFERRAL_WINDOW) -> None:
+        super().__init__()
+        self.pattern = pattern
+        self.remaining = int(window)
+        # The last line fed in, if it's not complete yet.
+        self.partial = bytearray()
+        self.match: t.Optional[re.Match] = None
+
+    def is_done(self) -> bool:
+        """Check if there's nothing more to scan.
+
+        Returns:
+            `True` if the registrar's WHOIS server was found, or the whole
+            window's been scanned.
+        """
+        return self.match is not None or self.remaining <= 0
+
+    def search(self, data: t.Union[bytes, bytearray]) -> None:
+        """Scan some complete lines of the response.
+
+        Args:
+            data: The lines.
+        """
+        if data:
+            self.match = self.pattern.search(str(data, "utf-8", "ignore"))
+
+    def feed(self, chunk: bytes) -> t.Optional[re.Match]:
+        """Scan the next chunk of the response.
+
+        Args:
+            chunk: The chunk.
+
+        Returns:
+            The match for the registrar's WHOIS server, if it's been found.
+        """
+        if self.is_done():
+            return self.match
+        if len(chunk) >= self.remaining:
+            # The window ends here, likely partway through a line. A line cut
+            # short could give a cut short server name, so it's left out.
+            self.partial += chunk[: self.remaining]
+            lines = self.partial[: self.partial.rfind(b"\n") + 1]
+            self.partial = bytearray()
+            self.remaining = 0
+            self.search(lines)
+            return self.match
+        self.remaining -= len(chunk)
+        end = chunk.rfind(b"\n") + 1
+        if end == 0:
+            self.partial += chunk
+            return None
+        lines = self.partial + chunk[:end]
+        self.partial = bytearray(chunk[end:])
+        self.search(lines)
+        return self.match
+
+    def close(self) -> t.Optional[re.Match]:
+        """Scan whatever's left of the head once the response is complete.
+
+        Returns:
+            The match for the registrar's WHOIS server, if found.
+        """
+        if self.match is None and self.partial:
+            self.search(self.partial)
+        self.partial = bytearray()
+        return self.match
@@ -1,23 +1,32 @@
 """A scraper which pulls zone WHOIS servers from IANA's root zone database."""
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
 import logging
+import os
 import socket
 import sys
+import threading
+import time
 import typing as t
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 import xml.etree.ElementTree as ET
 
 from bs4 import BeautifulSoup
 import requests
 
-from . import utils
+from . import extract, utils
 
 IPV4_ASSIGNMENTS = "https://www.iana.org/assignments/ipv4-address-space/ipv4-address-space.xml"
 ROOT_ZONE_DB = "https://www.iana.org/domains/root/db"
 
 NSS = {"assignments": "http://www.iana.org/assignments"}
 
+# Zone pages rarely change, so by default they're only checked weekly.
+MAX_AGE = 7 * 24 * 60 * 60
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,68 +52,372 @@ def fetch_ipv4_assignments(url: str) -> t.Iterator[tuple[str, str]]:
             yield prefix, whois
 
 
-def fetch(session: requests.Session, url: str) -> BeautifulSoup:
-    """Fetch a URL and parse it with Beautiful Soup for scraping.
+def munge_zone(zone: str) -> str:
+    """Beat the zone text into an a-label.
 
     Args:
-        session: The requests session to use.
-        url: The URL to fetch.
+        zone: The zone to clean up.
 
     Returns:
-        The parsed HTML body.
+        The munged zone.
     """
-    return BeautifulSoup(session.get(url, stream=False, timeout=10).text, "html.parser")
+    # The .strip() here is needed for RTL scripts like Arabic.
+    return zone.strip("\u200e\u200f.").encode("idna").decode().lower()
 
 
-def munge_zone(zone: str) -> str:
-    """Beat the zone text into an a-label.
+class Fetcher:
+    """Fetches pages for scraping, politely, from any number of threads.
+
+    Requests to each host are spaced out so that no more than `rate` are
+    started per second, however many threads are fetching at once. Each
+    thread gets its own session, as sessions aren't safe to share.
 
     Args:
-        zone: The zone to clean up.
+        rate: The most requests to start per second against any one host, or
+            0 for no limit.
+    """
+
+    __slots__ = (
+        "interval",
+        "local",
+        "lock",
+        "next_slots",
+    )
+
+    clock = staticmethod(time.monotonic)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, rate: float = 0) -> None:
+        super().__init__()
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.next_slots: dict[str, float] = {}
+
+    def wait(self, host: str) -> None:
+        """Wait for the next slot for a request against a host.
+
+        Args:
+            host: The host to be requested from.
+        """
+        if self.interval <= 0:
+            return
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_slots.get(host, now))
+            self.next_slots[host] = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+    def get(self, url: str, headers: t.Optional[t.Mapping[str, str]] = None) -> requests.Response:
+        """Fetch a URL.
+
+        Args:
+            url: The URL to fetch.
+            headers: Any extra request headers, such as for conditional
+                requests.
+
+        Returns:
+            The response.
+        """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        self.wait(urlsplit(url).netloc)
+        return session.get(url, headers=headers, stream=False, timeout=10)
+
+
+class ZoneState(t.NamedTuple):
+    """What was learnt about a zone's page the last time it was scraped.
+
+    Attributes:
+        url: The URL of the zone's page.
+        etag: The page's ETag, if it had one.
+        last_modified: The page's Last-Modified date, if it had one.
+        digest: The SHA-256 digest of the page.
+        whois_server: The WHOIS server found for the zone, if any.
+        checked: When the page was last checked, as a Unix timestamp.
+    """
+
+    url: str
+    etag: t.Optional[str] = None
+    last_modified: t.Optional[str] = None
+    digest: t.Optional[str] = None
+    whois_server: t.Optional[str] = None
+    checked: float = 0.0
+
+    def validators(self) -> dict[str, str]:
+        """Get the headers for making a conditional request for the page.
+
+        Returns:
+            The request headers.
+        """
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+def load_state(path: str) -> dict[str, ZoneState]:
+    """Load what was learnt about each zone's page on earlier scrapes.
+
+    Args:
+        path: The path to the state file.
 
     Returns:
-        The munged zone.
+        Maps zones onto their state, which is empty if the state file is
+        missing or unreadable.
     """
-    # The .strip() here is needed for RTL scripts like Arabic.
-    return zone.strip("\u200e\u200f.").encode("idna").decode().lower()
+    try:
+        with open(path, encoding="utf-8") as fh:
+            return {zone: ZoneState(**fields) for zone, fields in json.load(fh)["zones"].items()}
+    except FileNotFoundError:
+        return {}
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Ignoring unreadable state file %s", path)
+        return {}
+
+
+def save_state(path: str, state: t.Mapping[str, ZoneState]) -> None:
+    """Save what was learnt about each zone's page.
+
+    The state file is replaced atomically, so an interrupted save doesn't
+    lose the previous state.
+
+    Args:
+        path: The path to the state file.
+        state: Maps zones onto their state.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump({"zones": {zone: zone_state._asdict() for zone, zone_state in sorted(state.items())}}, fh, indent=1)
+    os.replace(tmp_path, path)
+
 
+class Extractor(t.NamedTuple):
+    """A way of pulling what the scraper needs out of IANA's pages.
 
-def scrape_whois_from_iana(root_zone_db_url: str, existing: t.Mapping[str, str]) -> t.Iterator[tuple[str, str]]:
+    Attributes:
+        zone_urls: Extracts the zones and the URLs of their pages, given the
+            base URL and HTML of the root zone database.
+        whois_server: Extracts the WHOIS server, if any, given the HTML of a
+            zone's page.
+    """
+
+    zone_urls: t.Callable[[str, str], t.Iterator[tuple[str, str]]]
+    whois_server: t.Callable[[str], t.Optional[str]]
+
+
+def soup_zone_urls(base_url: str, html: str) -> t.Iterator[tuple[str, str]]:
+    """Extract zone URLs from the root zone database HTML using Beautiful Soup.
+
+    Args:
+        base_url: The base URL of the root zone database.
+        html: The root zone database page.
+
+    Returns:
+        Tuples of (zone, zone URL).
+    """
+    return extract_zone_urls(base_url, BeautifulSoup(html, "html.parser"))
+
+
+def soup_whois_server(html: str) -> t.Optional[str]:
+    """Extract the WHOIS server from a zone HTML page using Beautiful Soup.
+
+    Args:
+        html: The zone's page.
+
+    Returns:
+        The WHOIS server, or `None` if not found.
+    """
+    return extract_whois_server(BeautifulSoup(html, "html.parser"))
+
+
+def stream_zone_urls(base_url: str, html: str) -> t.Iterator[tuple[str, str]]:
+    """Extract zone URLs from the root zone database HTML without a tree.
+
+    Args:
+        base_url: The base URL of the root zone database.
+        html: The root zone database page.
+
+    Yields:
+        Tuples of (zone, zone URL).
+    """
+    for zone, zone_url in extract.zone_urls(base_url, html):
+        yield (munge_zone(zone), zone_url)
+
+
+EXTRACTORS = {
+    "soup": Extractor(soup_zone_urls, soup_whois_server),
+    "stream": Extractor(stream_zone_urls, extract.whois_server),
+}
+
+
+def find_whois_server(zone: str, html: str, extractor: Extractor = EXTRACTORS["stream"]) -> t.Optional[str]:
+    """Find a zone's WHOIS server from its page in the root zone database.
+
+    Args:
+        zone: The zone.
+        html: The zone's page.
+        extractor: The extractor to use.
+
+    Returns:
+        The WHOIS server, or `None` if the zone doesn't appear to have one.
+    """
+    whois_server = extractor.whois_server(html)
+    # Fallback to trying whois.nic.*
+    if whois_server is None:
+        whois_server = f"whois.nic.{zone}"
+        logger.info("Trying fallback server: %s", whois_server)
+        try:
+            socket.gethostbyname(whois_server)
+        except socket.gaierror:
+            logger.info("No WHOIS server found for %s", zone)
+            return None
+    logger.info("WHOIS server for %s is %s", zone, whois_server)
+    return whois_server
+
+
+def scrape_zone(
+    fetcher: Fetcher,
+    zone: str,
+    zone_url: str,
+    previous: t.Optional[ZoneState] = None,
+    max_age: float = 0,
+    extractor: Extractor = EXTRACTORS["stream"],
+) -> ZoneState:
+    """Scrape a zone's page in the root zone database for its WHOIS server.
+
+    If the page was scraped before, it's only fetched again if it's been at
+    least `max_age` seconds since it was last checked, and then only if it's
+    changed since. A page that's been fetched again but turns out to be the
+    same as before isn't scraped again.
+
+    Args:
+        fetcher: The fetcher to use.
+        zone: The zone.
+        zone_url: The URL of the zone's page.
+        previous: What was learnt about the page when it was last scraped, if
+            it ever was.
+        max_age: Seconds to trust what was learnt about the page before
+            checking it again.
+        extractor: The extractor to use.
+
+    Returns:
+        What was learnt about the page.
+    """
+    now = time.time()
+    if previous is not None and previous.url != zone_url:
+        previous = None
+    if previous is not None and now - previous.checked < max_age:
+        return previous
+    logger.info("Scraping %s", zone_url)
+    response = fetcher.get(zone_url, None if previous is None else previous.validators())
+    if previous is not None and response.status_code == 304:
+        logger.info("%s is unchanged", zone_url)
+        return previous._replace(checked=now)
+    digest = hashlib.sha256(response.content).hexdigest()
+    if previous is not None and previous.digest == digest:
+        whois_server = previous.whois_server
+    else:
+        whois_server = find_whois_server(zone, response.text, extractor)
+    return ZoneState(
+        zone_url,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+        digest,
+        whois_server,
+        now,
+    )
+
+
+def scrape_whois_from_iana(
+    root_zone_db_url: str,
+    existing: t.Mapping[str, str],
+    workers: int = 1,
+    rate: float = 0,
+    state: t.Optional[dict[str, ZoneState]] = None,
+    max_age: float = 0,
+    extractor: Extractor = EXTRACTORS["stream"],
+) -> t.Iterator[tuple[str, str]]:
     """Scrape IANA's root zone database for WHOIS servers.
 
+    The zones' pages are scraped concurrently, but the zones come out in the
+    same order as in the root zone database regardless, so the output can be
+    diffed between runs.
+
     Args:
         root_zone_db_url: The URL of the root zone database.
         existing: A mapping of existing zones to WHOIS servers to skip.
+        workers: How many pages to scrape at once.
+        rate: The most requests to start per second against any one host, or
+            0 for no limit.
+        state: What was learnt about each zone's page on earlier scrapes, to
+            avoid scraping them again where possible. This is updated with
+            what's learnt on this scrape.
+        max_age: Seconds to trust what was learnt about a zone's page before
+            checking it again.
+        extractor: The extractor to use.
 
     Yields:
         Tuples of (zone, whois server).
     """
-    session = requests.Session()
+    fetcher = Fetcher(rate)
+    if state is None:
+        state = {}
 
     logger.info("Scraping %s", root_zone_db_url)
-    body = fetch(session, root_zone_db_url)
+    zones = list(extractor.zone_urls(root_zone_db_url, fetcher.get(root_zone_db_url).text))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # If we've already scraped a TLD, ignore it.
+        scraped = {
+            zone: executor.submit(scrape_zone, fetcher, zone, zone_url, state.get(zone), max_age, extractor)
+            for zone, zone_url in zones
+            if zone not in existing
+        }
+        try:
+            for zone, _ in zones:
+                if zone in existing:
+                    whois_server: t.Optional[str] = existing[zone]
+                else:
+                    state[zone] = scraped[zone].result()
+                    whois_server = state[zone].whois_server
+                if whois_server is not None:
+                    yield (zone, whois_server)
+        finally:
+            for future in scraped.values():
+                future.cancel()
+
+    # Forget about zones that have gone away.
+    for zone in set(state).difference(zone for zone, _ in zones):
+        del state[zone]
+
+
+def diff_overrides(old: t.Mapping[str, str], new: t.Iterable[tuple[str, str]]) -> t.Iterator[str]:
+    """Compare freshly scraped WHOIS servers against those scraped before.
 
-    for zone, zone_url in extract_zone_urls(root_zone_db_url, body):
-        # If we've already scraped this TLD, ignore it.
-        if zone in existing:
-            yield (zone, existing[zone])
-            continue
-
-        logger.info("Scraping %s", zone_url)
-        body = fetch(session, zone_url)
-        whois_server = extract_whois_server(body)
-        # Fallback to trying whois.nic.*
-        if whois_server is None:
-            whois_server = f"whois.nic.{zone}"
-            logger.info("Trying fallback server: %s", whois_server)
-            try:
-                socket.gethostbyname(whois_server)
-            except socket.gaierror:
-                logger.info("No WHOIS server found for %s", zone)
-                continue
+    Args:
+        old: Maps zones onto the WHOIS servers scraped before.
+        new: Tuples of (zone, whois server) freshly scraped.
 
-        logger.info("WHOIS server for %s is %s", zone, whois_server)
-        yield (zone, whois_server)
+    Yields:
+        A `+zone=server` line for each addition and a `-zone=server` line for
+        each removal, with changes being a removal followed by an addition.
+    """
+    seen = set()
+    for zone, whois_server in new:
+        seen.add(zone)
+        previous = old.get(zone)
+        if previous != whois_server:
+            if previous is not None:
+                yield f"-{zone}={previous}"
+            yield f"+{zone}={whois_server}"
+    for zone, whois_server in old.items():
+        if zone not in seen:
+            yield f"-{zone}={whois_server}"
 
 
 def extract_zone_urls(base_url: str, body: BeautifulSoup) -> t.Iterator[tuple[str, str]]:
@@ -158,6 +471,22 @@ def make_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Scrap WHOIS data.")
     parser.add_argument("--config", help="uwhoisd configuration")
     parser.add_argument("--ipv4", action="store_true", help="Scrape IPv4 assignments")
+    parser.add_argument("--workers", type=int, default=8, help="Number of zone pages to scrape at once")
+    parser.add_argument("--rate", type=float, default=5, help="Most requests per second to any one host")
+    parser.add_argument("--state", help="File to keep track of zone pages in, to avoid scraping them again")
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=MAX_AGE,
+        help="Seconds before zone pages in the state file are checked for changes (default: a week; 0 checks them all)",
+    )
+    parser.add_argument(
+        "--extractor",
+        choices=sorted(EXTRACTORS),
+        default="stream",
+        help="How to extract data from pages (default: stream)",
+    )
+    parser.add_argument("--diff", metavar="SCRAPED_INI", help="Only output changes against an earlier scrape")
     zone_group = parser.add_mutually_exclusive_group(required=True)
     zone_group.add_argument(
         "--new-only",
@@ -177,11 +506,29 @@ def main() -> int:
     parser = utils.make_config_parser(args.config)
 
     whois_servers = {} if args.full else parser.get_section_dict("overrides")
+    state = None if args.state is None else load_state(args.state)
     logger.info("Starting scrape of %s", ROOT_ZONE_DB)
-    print("[overrides]")
-    for zone, whois_server in scrape_whois_from_iana(ROOT_ZONE_DB, whois_servers):
-        logger.info("Scraped .%s: %s", zone, whois_server)
-        print(f"{zone}={whois_server}")
+    scraped = scrape_whois_from_iana(
+        ROOT_ZONE_DB,
+        whois_servers,
+        args.workers,
+        args.rate,
+        state,
+        args.max_age,
+        EXTRACTORS[args.extractor],
+    )
+    if args.diff is not None:
+        previous = utils.ConfigParser()
+        previous.read(args.diff)
+        for line in diff_overrides(previous.get_section_dict("overrides"), scraped):
+            print(line)
+    else:
+        print("[overrides]")
+        for zone, whois_server in scraped:
+            logger.info("Scraped .%s: %s", zone, whois_server)
+            print(f"{zone}={whois_server}")
+    if state is not None:
+        save_state(args.state, state)
 
     if args.ipv4:
         print("[ipv4_assignments]")
@@ -1,39 +1,622 @@
 import asyncio
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import socket
+import time
 import typing as t
+import urllib.parse
 
-from . import utils
+from . import health, metrics, rl, utils
 
+logger = logging.getLogger(__name__)
 
-async def start_service(iface: str, port: int, whois: t.Callable[[str], t.Awaitable[str]]) -> None:
+REQUEST_DURATION = metrics.histogram(
+    "uwhoisd_request_duration_seconds",
+    "Time taken to answer client queries, by outcome.",
+    ("outcome",),
+)
+RESPONSE_BYTES = metrics.counter("uwhoisd_response_bytes_total", "Bytes sent to clients.")
+
+
+def write(writer: asyncio.StreamWriter, data: bytes) -> int:
+    """Write data to a client.
+
+    Args:
+        writer: The client connection.
+        data: The data to write.
+
+    Returns:
+        The number of bytes written.
+    """
+    writer.write(data)
+    return len(data)
+
+
+async def respond(
+    writer: asyncio.StreamWriter,
+    query: str,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    stream: t.Optional[t.Callable[[str], t.AsyncIterator[bytes]]] = None,
+) -> None:
+    """Write the response to a query to the client.
+
+    Args:
+        writer: The client connection.
+        query: The cleaned up query.
+        whois: The WHOIS query function to use.
+        stream: The streaming WHOIS query function to use in preference to
+            `whois`, if any.
+    """
+    start = time.perf_counter()
+    # Anything not accounted for below is an unexpected error.
+    outcome = "error"
+    sent = 0
+    try:
+        if not utils.is_well_formed_query(query):
+            sent += write(writer, f"; Bad query: '{query}'\r\n".encode())
+            outcome = "bad_query"
+        elif stream is None:
+            sent += write(writer, (await whois(query)).encode())
+            outcome = "ok"
+        else:
+            async for chunk in stream(query):
+                sent += write(writer, chunk)
+                await writer.drain()
+            outcome = "ok"
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        sent += write(writer, b"; Timeout from upstream server\r\n")
+    except rl.RateLimitedError as exc:
+        outcome = "upstream_rate_limited"
+        sent += write(writer, f"; {exc}\r\n".encode())
+    except health.UnavailableError as exc:
+        outcome = "upstream_unavailable"
+        sent += write(writer, f"; {exc}\r\n".encode())
+    except asyncio.CancelledError:
+        outcome = "disconnected"
+        raise
+    finally:
+        REQUEST_DURATION.observe(time.perf_counter() - start, (outcome,))
+        RESPONSE_BYTES.inc(amount=sent)
+    await writer.drain()
+
+
+async def wait_closed(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Wait for the client's connection to be reset, or otherwise fail.
+
+    A client sending EOF hasn't necessarily hung up: clients such as `nc -N`
+    shut down their end for writing once they've sent the query, and still
+    wait for the response. Once EOF's been read, the connection's only known
+    to have gone when writing to it fails. Anything else the client sends in
+    the meantime is discarded.
+
+    Args:
+        reader: The client connection's reader.
+        writer: The client connection's writer.
+    """
+    with contextlib.suppress(OSError):
+        while await reader.read(1024):
+            pass
+        await writer.wait_closed()
+
+
+async def respond_unless_closed(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    query: str,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    stream: t.Optional[t.Callable[[str], t.AsyncIterator[bytes]]] = None,
+) -> None:
+    """Write the response to a query to the client, unless it hangs up first.
+
+    WHOIS clients wait for the server to close the connection once it's sent
+    the response, so a client whose connection is reset first has given up on
+    the response, and whatever work is going into it is cancelled. A client
+    that merely shuts down its end for writing still gets the response.
+
+    Args:
+        reader: The client connection's reader.
+        writer: The client connection's writer.
+        query: The cleaned up query.
+        whois: The WHOIS query function to use.
+        stream: The streaming WHOIS query function to use in preference to
+            `whois`, if any.
+    """
+    responding = asyncio.ensure_future(respond(writer, query, whois, stream))
+    closed = asyncio.ensure_future(wait_closed(reader, writer))
+    try:
+        await asyncio.wait((responding, closed), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        closed.cancel()
+        responding.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await responding
+
+
+class Sessions(t.NamedTuple):
+    """Limits on persistent sessions, for clients making many queries.
+
+    A client opts into a session by prefixing its first query with `-k`, as
+    with the RIPE WHOIS server, or sending `-k` on its own. Each response is
+    then followed by `END_OF_RESPONSE` and the connection is left open for the
+    next query. Queries can be pipelined, and are answered in order. Sending
+    `-k` again ends the session.
+
+    Attributes:
+        max_queries: The most queries a client can make in a session before
+            it's closed.
+        idle_timeout: Seconds to wait for the next query before closing the
+            session.
+    """
+
+    max_queries: int = 100
+    idle_timeout: float = 30.0
+
+
+# Prefix a client sends to open a session.
+SESSION_PREFIX = "-k"
+
+# Marks the end of each response in a session.
+END_OF_RESPONSE = b"\r\n; End of response\r\n"
+
+
+def clean_query(line: bytes) -> str:
+    """Clean up a query line sent by a client.
+
+    Args:
+        line: The query line.
+
+    Returns:
+        The cleaned up query.
+    """
+    return line.decode().strip().lower()
+
+
+def allow(writer: asyncio.StreamWriter, limiter: t.Optional[rl.ClientLimiter]) -> bool:
+    """Check if a client is allowed to make a query, telling it if not.
+
+    Args:
+        writer: The client connection.
+        limiter: Per-client rate limiter, if any.
+
+    Returns:
+        `True` if the query can go ahead.
+    """
+    if limiter is not None:
+        peer = writer.get_extra_info("peername")
+        if peer is not None and not limiter.allow(peer[0]):
+            REQUEST_DURATION.observe(0, ("rate_limited",))
+            writer.write(b"; Rate limited\r\n")
+            return False
+    return True
+
+
+async def run_session(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    query: str,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    sessions: Sessions,
+    limiter: t.Optional[rl.ClientLimiter] = None,
+    stream: t.Optional[t.Callable[[str], t.AsyncIterator[bytes]]] = None,
+) -> None:
+    """Answer queries from a client until it ends the session.
+
+    Args:
+        reader: The client connection's reader.
+        writer: The client connection's writer.
+        query: The client's first query, with the session prefix removed,
+            which may be empty.
+        whois: The WHOIS query function to use.
+        sessions: Limits on the session.
+        limiter: Per-client rate limiter, if any.
+        stream: The streaming WHOIS query function to use in preference to
+            `whois`, if any.
+    """
+    served = 0
+    while True:
+        if query:
+            # The first query was already allowed when the client connected.
+            if served == 0 or allow(writer, limiter):
+                await respond(writer, query, whois, stream)
+            served += 1
+            writer.write(END_OF_RESPONSE)
+            if served >= sessions.max_queries:
+                writer.write(b"; Query limit reached: closing\r\n")
+                break
+            await writer.drain()
+        try:
+            line = await asyncio.wait_for(reader.readuntil(b"\r\n"), timeout=sessions.idle_timeout)
+        except asyncio.TimeoutError:
+            writer.write(b"; Idle timeout: closing\r\n")
+            break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            break
+        query = clean_query(line)
+        if query == SESSION_PREFIX:
+            break
+    await writer.drain()
+
+
+async def start_service(
+    iface: str,
+    port: int,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    limiter: t.Optional[rl.ClientLimiter] = None,
+    stream: t.Optional[t.Callable[[str], t.AsyncIterator[bytes]]] = None,
+    sock: t.Optional[socket.socket] = None,
+    *,
+    reuse_port: bool = False,
+    sessions: t.Optional[Sessions] = None,
+) -> None:
     """Start the WHOIS server.
 
     Args:
         iface: The interface to bind to.
         port: The port to bind to.
         whois: The WHOIS query function to use.
+        limiter: Per-client rate limiter, if any.
+        stream: If given, a WHOIS query function yielding the raw response as
+            it arrives, which is used in preference to `whois` so responses
+            are forwarded to clients as they come in.
+        sock: A listening socket to serve on, in which case `iface` and `port`
+            are ignored.
+        reuse_port: Bind with `SO_REUSEPORT` so several processes can listen
+            on the same port.
+        sessions: Limits on persistent sessions, or `None` if clients can't
+            open them.
     """
 
     async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if not allow(writer, limiter):
+            await writer.drain()
+            writer.close()
+            return
+
         try:
-            query = await asyncio.wait_for(reader.readuntil(b"\r\n"), timeout=5)
+            query = clean_query(await asyncio.wait_for(reader.readuntil(b"\r\n"), timeout=5))
         except asyncio.TimeoutError:
             writer.write(b"; Query timeout: closing\r\n")
             await writer.drain()
             writer.close()
             return
 
-        cleaned = query.decode().strip().lower()
-        if not utils.is_well_formed_fqdn(cleaned):
-            result = f"; Bad query: '{cleaned}'\r\n"
+        prefix, _, rest = query.partition(" ")
+        if sessions is not None and prefix == SESSION_PREFIX:
+            await run_session(reader, writer, rest.strip(), whois, sessions, limiter, stream)
         else:
-            try:
-                result = await whois(cleaned)
-            except asyncio.TimeoutError:
-                result = "; Timeout from upstream server\r\n"
-        writer.write(result.encode())
-        await writer.drain()
+            await respond_unless_closed(reader, writer, query, whois, stream)
         writer.close()
 
-    svr = await asyncio.start_server(handle_request, host=iface, port=port)
+    if sock is not None:
+        svr = await asyncio.start_server(handle_request, sock=sock)
+    else:
+        svr = await asyncio.start_server(handle_request, host=iface, port=port, reuse_port=reuse_port)
+    async with svr:
+        await svr.serve_forever()
+
+
+class HTTPOptions(t.NamedTuple):
+    """Limits on the HTTP API.
+
+    Attributes:
+        max_requests: The most requests a client can make over a single
+            connection before it's closed.
+        idle_timeout: Seconds to wait for the next request on a connection
+            before closing it.
+        max_batch: The most queries that can be made in a single batch.
+        max_body: The largest request body accepted, in bytes.
+    """
+
+    max_requests: int = 100
+    idle_timeout: float = 30.0
+    max_batch: int = 100
+    max_body: int = 65536
+
+
+class HTTPError(Exception):
+    """A request can't be answered, and the connection needs to be closed.
+
+    Args:
+        status: The HTTP status line to respond with.
+    """
+
+    def __init__(self, status: str) -> None:
+        super().__init__(status)
+        self.status = status
+
+
+class Request(t.NamedTuple):
+    """An HTTP request.
+
+    Attributes:
+        method: The request method.
+        path: The request path, without any query string.
+        version: The HTTP version.
+        headers: The request headers, keyed by their lowercased names.
+        body: The request body.
+    """
+
+    method: str
+    path: str
+    version: str
+    headers: dict[str, str]
+    body: bytes = b""
+
+    def keep_alive(self) -> bool:
+        """Check if the client wants the connection kept open.
+
+        Returns:
+            `True` if the connection should be kept open.
+        """
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+
+DEFAULT_HTTP_OPTIONS = HTTPOptions()
+
+# Responses smaller than this aren't worth compressing.
+GZIP_MIN_SIZE = 256
+
+RATE_LIMITED: tuple[str, dict[str, t.Any]] = ("429 Too Many Requests", {"error": "Rate limited"})
+
+HTTP_REQUESTS = metrics.counter("uwhoisd_http_requests_total", "HTTP API requests, by status.", ("status",))
+
+
+async def read_request(reader: asyncio.StreamReader, options: HTTPOptions) -> Request:
+    """Read an HTTP request from a client.
+
+    Args:
+        reader: The client connection.
+        options: Limits on the HTTP API.
+
+    Returns:
+        The request.
+
+    Raises:
+        HTTPError: If the request is malformed or too large.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.LimitOverrunError:
+        raise HTTPError("431 Request Header Fields Too Large") from None
+    request_line, *lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+    parts = request_line.split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HTTPError("400 Bad Request")
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "transfer-encoding" in headers:
+        raise HTTPError("501 Not Implemented")
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPError("400 Bad Request") from None
+    if length > options.max_body:
+        raise HTTPError("413 Content Too Large")
+    body = await reader.readexactly(length) if length > 0 else b""
+    return Request(parts[0], parts[1].split("?", 1)[0], parts[2], headers, body)
+
+
+async def lookup(whois: t.Callable[[str], t.Awaitable[str]], query: str) -> tuple[str, dict[str, str]]:
+    """Look up a query for the HTTP API.
+
+    Args:
+        whois: The WHOIS query function to use.
+        query: The cleaned up query.
+
+    Returns:
+        The HTTP status and the result, with the response if the lookup
+        succeeded, and the reason it didn't otherwise.
+    """
+    if not utils.is_well_formed_query(query):
+        return "400 Bad Request", {"query": query, "error": "Bad query"}
+    try:
+        return "200 OK", {"query": query, "response": await whois(query)}
+    except asyncio.TimeoutError:
+        return "504 Gateway Timeout", {"query": query, "error": "Timeout from upstream server"}
+    except (rl.RateLimitedError, health.UnavailableError) as exc:
+        return "503 Service Unavailable", {"query": query, "error": str(exc)}
+    except OSError as exc:
+        # Such as the upstream's hostname not resolving or it refusing to
+        # connect; this query failing shouldn't take the rest of a batch with it.
+        logger.warning("Lookup of '%s' failed: %r", query, exc)
+        return "502 Bad Gateway", {"query": query, "error": str(exc) or type(exc).__name__}
+
+
+async def lookup_batch(
+    whois: t.Callable[[str], t.Awaitable[str]],
+    body: bytes,
+    options: HTTPOptions,
+    allow: t.Optional[t.Callable[[int], bool]] = None,
+) -> tuple[str, dict[str, t.Any]]:
+    """Look up a batch of queries for the HTTP API.
+
+    The body is a JSON object with the queries in its `queries` array. Each
+    distinct query is only looked up once, but the client is charged for
+    every query in the batch, and if they can't afford them all, none are
+    looked up.
+
+    Args:
+        whois: The WHOIS query function to use.
+        body: The request body.
+        options: Limits on the HTTP API.
+        allow: Charges the client for the given number of queries, returning
+            `False` if they're over their rate limit.
+
+    Returns:
+        The HTTP status and the results, in the same order as the queries.
+    """
+    try:
+        queries = json.loads(body)["queries"]
+    except (ValueError, KeyError, TypeError):
+        return "400 Bad Request", {"error": "Expected a JSON object with a 'queries' array"}
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return "400 Bad Request", {"error": "Expected a JSON object with a 'queries' array"}
+    if len(queries) > options.max_batch:
+        return "413 Content Too Large", {"error": f"At most {options.max_batch} queries can be made at once"}
+    if allow is not None and not allow(len(queries)):
+        return RATE_LIMITED
+    queries = [query.strip().lower() for query in queries]
+    unique = list(dict.fromkeys(queries))
+    results = dict(zip(unique, await asyncio.gather(*(lookup(whois, query) for query in unique))))
+    return "200 OK", {"results": [results[query][1] for query in queries]}
+
+
+def render(status: str, payload: t.Optional[object], request: t.Optional[Request], *, keep_alive: bool) -> bytes:
+    """Render an HTTP response.
+
+    Successful responses are given an ETag derived from their content, and if
+    it matches the one the client already has, the response is replaced with
+    a 304. Larger responses are compressed if the client accepts gzip.
+
+    Args:
+        status: The HTTP status line.
+        payload: The JSON payload, if any.
+        request: The request being responded to, if it could be read.
+        keep_alive: Whether the connection is being kept open.
+
+    Returns:
+        The response.
+    """
+    body = b"" if payload is None else json.dumps(payload).encode()
+    headers = {
+        "Content-Type": "application/json",
+        "Connection": "keep-alive" if keep_alive else "close",
+    }
+    if request is not None and status == "200 OK" and request.method == "GET":
+        etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        headers["ETag"] = etag
+        headers["Vary"] = "Accept-Encoding"
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            status, body = "304 Not Modified", b""
+    if request is not None and len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    headers["Content-Length"] = str(len(body))
+    HTTP_REQUESTS.inc((status.split(" ", 1)[0],))
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return f"HTTP/1.1 {status}\r\n{head}\r\n".encode("latin-1") + body
+
+
+async def handle_http_request(
+    request: Request,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    options: HTTPOptions,
+    allow: t.Optional[t.Callable[[int], bool]] = None,
+) -> tuple[str, t.Optional[object]]:
+    """Answer an HTTP API request.
+
+    Args:
+        request: The request.
+        whois: The WHOIS query function to use.
+        options: Limits on the HTTP API.
+        allow: Charges the client for the given number of queries, returning
+            `False` if they're over their rate limit.
+
+    Returns:
+        The HTTP status and JSON payload, if any.
+    """
+    if request.path.startswith("/whois/"):
+        if request.method != "GET":
+            return "405 Method Not Allowed", None
+        if allow is not None and not allow(1):
+            return RATE_LIMITED
+        return await lookup(whois, urllib.parse.unquote(request.path[7:]).strip().lower())
+    if request.path == "/whois":
+        if request.method != "POST":
+            return "405 Method Not Allowed", None
+        return await lookup_batch(whois, request.body, options, allow)
+    return "404 Not Found", None
+
+
+async def start_http_service(
+    iface: str,
+    port: int,
+    whois: t.Callable[[str], t.Awaitable[str]],
+    limiter: t.Optional[rl.ClientLimiter] = None,
+    options: HTTPOptions = DEFAULT_HTTP_OPTIONS,
+    sock: t.Optional[socket.socket] = None,
+    *,
+    reuse_port: bool = False,
+) -> None:
+    """Start the HTTP API.
+
+    `GET /whois/<domain>` looks up a single domain, and `POST /whois` looks up
+    a batch of them, using the same WHOIS query function, and so the same
+    cache, as the WHOIS server.
+
+    Args:
+        iface: The interface to bind to.
+        port: The port to bind to.
+        whois: The WHOIS query function to use.
+        limiter: Per-client rate limiter, if any. Batches larger than a client
+            could ever afford are refused as too large.
+        options: Limits on the HTTP API.
+        sock: A listening socket to serve on, in which case `iface` and `port`
+            are ignored.
+        reuse_port: Bind with `SO_REUSEPORT` so several processes can listen
+            on the same port.
+    """
+
+    if limiter is not None:
+        # A batch is charged a token per query, so retrying one larger than
+        # the burst would never succeed.
+        options = options._replace(max_batch=min(options.max_batch, limiter.max_cost()))
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+
+        def allow(cost: int) -> bool:
+            return limiter is None or peer is None or limiter.allow(peer[0], cost)
+
+        try:
+            for served in range(1, options.max_requests + 1):
+                try:
+                    request = await asyncio.wait_for(read_request(reader, options), timeout=options.idle_timeout)
+                except HTTPError as exc:
+                    writer.write(render(exc.status, None, None, keep_alive=False))
+                    break
+                keep_alive = request.keep_alive() and served < options.max_requests
+                status, payload = await handle_http_request(request, whois, options, allow)
+                writer.write(render(status, payload, request, keep_alive=keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    logger.info("Serving HTTP API on %s:%d", iface, port)
+    if sock is not None:
+        svr = await asyncio.start_server(handle_connection, sock=sock)
+    else:
+        svr = await asyncio.start_server(handle_connection, host=iface, port=port, reuse_port=reuse_port)
     async with svr:
         await svr.serve_forever()
+
+
+def get_http_options(cfg: t.Mapping[str, str]) -> HTTPOptions:
+    """Create the HTTP API's limits from the configuration.
+
+    Args:
+        cfg: The HTTP configuration.
+
+    Returns:
+        The limits.
+    """
+    return HTTPOptions(
+        max_requests=int(cfg.get("max_requests", 100)),
+        idle_timeout=float(cfg.get("idle_timeout", 30)),
+        max_batch=int(cfg.get("max_batch", 100)),
+        max_body=int(cfg.get("max_body", 65536)),
+    )
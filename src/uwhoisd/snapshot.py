@@ -0,0 +1,313 @@
+"""Precompiled routing snapshots, for starting the daemon quickly.
+
+Parsing the routing tables out of the config files, `scraped.ini` especially,
+is most of the work of starting the daemon. A snapshot holds the decoded
+routing tables, along with enough about the config files they came from, and
+the defaults shipped with the package, to tell when it's gone stale. While it's fresh, config files holding nothing but
+routing tables aren't parsed at all.
+"""
+
+import argparse
+import configparser
+import hashlib
+from importlib import resources
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+import typing as t
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"UWHOISRS"
+# Bump this whenever the layout of the snapshot changes.
+VERSION = 3
+# The magic, the snapshot version, and the major and minor version of the Python
+# that wrote it, as the marshal format can change between them.
+HEADER = struct.Struct("<8sIBB")
+
+# Config sections whose contents go into the snapshot.
+ROUTING_SECTIONS = frozenset(("overrides", "prefixes", "recursion_patterns", "ipv4_assignments"))
+
+# The size and modification time of a config file, in nanoseconds.
+Signature = tuple[int, int]
+
+
+class Routes(t.NamedTuple):
+    """The routing tables from the configuration.
+
+    Attributes:
+        overrides: Maps zones onto their WHOIS servers.
+        prefixes: Maps zones onto query prefixes.
+        recursion_patterns: Maps thin zones onto the uncompiled patterns for
+            extracting registrar WHOIS servers.
+        assignments: Maps IP networks onto their WHOIS servers.
+    """
+
+    overrides: dict[str, str]
+    prefixes: dict[str, str]
+    recursion_patterns: dict[str, str]
+    assignments: dict[str, str]
+
+
+class Snapshot(t.NamedTuple):
+    """A snapshot of the routing tables.
+
+    Attributes:
+        routes: The routing tables.
+        sources: Maps each config file the tables were read from onto its
+            signature at the time.
+        routing_only: The included config files holding nothing but routing
+            tables, which needn't be read while the snapshot is fresh.
+        defaults: The digest of the package's default config at the time.
+    """
+
+    routes: Routes
+    sources: dict[str, Signature]
+    routing_only: tuple[str, ...]
+    defaults: str
+
+
+def get_routes(parser: utils.ConfigParser) -> Routes:
+    """Read the routing tables from the configuration.
+
+    Args:
+        parser: The config parser to read from.
+
+    Returns:
+        The routing tables.
+    """
+    return Routes(
+        parser.get_section_dict("overrides"),
+        parser.get_section_dict("prefixes"),
+        {zone: utils.decode_value(pattern) for zone, pattern in parser.items("recursion_patterns")},
+        parser.get_section_dict("ipv4_assignments"),
+    )
+
+
+def get_signature(path: str) -> Signature:
+    """Get the signature of a config file, to tell if it's changed.
+
+    Args:
+        path: The path to the config file.
+
+    Returns:
+        The file's size and modification time.
+    """
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def get_defaults_digest() -> str:
+    """Get the digest of the package's default config, to tell if it's changed.
+
+    Returns:
+        The hex digest.
+    """
+    with resources.open_binary("uwhoisd", "defaults.ini") as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def get_sources(config_path: str) -> list[str]:
+    """Get the paths of every config file that would be read.
+
+    Args:
+        config_path: The path to the main config file.
+
+    Returns:
+        The paths, with the main config file first.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(config_path)
+    return [config_path, *sorted(utils.get_included_paths(parser, config_path))]
+
+
+def is_routing_only(path: str) -> bool:
+    """Check if a config file holds nothing but routing tables.
+
+    Args:
+        path: The path to the config file.
+
+    Returns:
+        `True` if the file has only routing sections.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(path)
+    return not parser.defaults() and set(parser.sections()) <= ROUTING_SECTIONS
+
+
+def compile_snapshot(config_path: str) -> Snapshot:
+    """Compile a snapshot of the routing tables in the configuration.
+
+    Args:
+        config_path: The path to the main config file.
+
+    Returns:
+        The snapshot.
+    """
+    sources = get_sources(config_path)
+    signatures = {path: get_signature(path) for path in sources}
+    routes = get_routes(utils.make_config_parser(config_path))
+    routing_only = tuple(path for path in sources[1:] if is_routing_only(path))
+    return Snapshot(routes, signatures, routing_only, get_defaults_digest())
+
+
+def write_snapshot(path: str, snapshot: Snapshot) -> None:
+    """Write a snapshot, replacing any existing one atomically.
+
+    Args:
+        path: Where to write the snapshot.
+        snapshot: The snapshot.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, *sys.version_info[:2]))
+        fh.write(marshal.dumps((tuple(snapshot.routes), snapshot.sources, snapshot.routing_only, snapshot.defaults)))
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str) -> t.Optional[Snapshot]:
+    """Load a snapshot.
+
+    The snapshot is memory-mapped rather than read, which saves copying the
+    file into memory before decoding it. The decoded tables are still built
+    afresh in each process that loads them.
+
+    Args:
+        path: The path to the snapshot.
+
+    Returns:
+        The snapshot, or `None` if it's missing, unreadable, or was written by
+        a different version of Python.
+    """
+    try:
+        with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, *python = HEADER.unpack_from(mm)
+            if magic != MAGIC or version != VERSION:
+                logger.warning("Ignoring routing snapshot %s: not a version %d snapshot", path, VERSION)
+                return None
+            if tuple(python) != sys.version_info[:2]:
+                logger.warning("Ignoring routing snapshot %s: written by Python %d.%d", path, *python)
+                return None
+            # Snapshots are only ever written by whoever writes the config.
+            with memoryview(mm)[HEADER.size :] as view:
+                routes, sources, routing_only, defaults = marshal.loads(view)  # noqa: S302
+    except FileNotFoundError:
+        logger.warning("Routing snapshot %s not found", path)
+        return None
+    except (OSError, ValueError, EOFError, TypeError, struct.error):
+        logger.warning("Ignoring unreadable routing snapshot %s", path)
+        return None
+    return Snapshot(Routes(*routes), sources, routing_only, defaults)
+
+
+def is_fresh(snapshot: Snapshot, sources: t.Sequence[str]) -> bool:
+    """Check if a snapshot is up to date with the config files.
+
+    Args:
+        snapshot: The snapshot.
+        sources: The paths of the config files that would be read.
+
+    Returns:
+        `True` if the same config files would be read, and neither they nor
+        the package's default config have changed since the snapshot was
+        compiled.
+    """
+    if snapshot.defaults != get_defaults_digest() or sorted(snapshot.sources) != sorted(sources):
+        return False
+    try:
+        return all(get_signature(path) == signature for path, signature in snapshot.sources.items())
+    except OSError:
+        return False
+
+
+def get_snapshot_path(config_path: str) -> t.Optional[str]:
+    """Get the path of the routing snapshot from the main config file.
+
+    Args:
+        config_path: The path to the main config file.
+
+    Returns:
+        The path, relative paths being relative to the main config file, or
+        `None` if no snapshot is configured.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(config_path)
+    path = parser.get("uwhoisd", "snapshot", fallback="").strip()
+    return os.path.join(os.path.dirname(config_path), path) if path else None
+
+
+def read_config(config_path: str) -> tuple[utils.ConfigParser, t.Optional[Routes]]:
+    """Read the configuration, using the routing snapshot if it's fresh.
+
+    Args:
+        config_path: The path to the main config file.
+
+    Returns:
+        The config parser, and the routing tables from the snapshot if it was
+        used. If not, the routing tables have to be read from the parser.
+    """
+    path = get_snapshot_path(config_path)
+    snapshot = None if path is None else load_snapshot(path)
+    if snapshot is not None and not is_fresh(snapshot, get_sources(config_path)):
+        logger.warning("Routing snapshot %s is stale; reading the routing tables from the config", path)
+        snapshot = None
+    if snapshot is None:
+        return utils.make_config_parser(config_path), None
+    logger.info("Using routing snapshot %s", path)
+    return utils.make_config_parser(config_path, skip=snapshot.routing_only), snapshot.routes
+
+
+def make_arg_parser() -> argparse.ArgumentParser:
+    """Create the argument parser.
+
+    Returns:
+        The argument parser.
+    """
+    parser = argparse.ArgumentParser(description="Compile a routing snapshot.")
+    parser.add_argument("config", help="uwhoisd configuration")
+    parser.add_argument("--output", help="Where to write the snapshot (default: as configured)")
+    parser.add_argument("--check", action="store_true", help="Only check whether the snapshot is fresh")
+    return parser
+
+
+def main() -> int:
+    """Driver for compiling routing snapshots."""
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    args = make_arg_parser().parse_args()
+
+    path = args.output or get_snapshot_path(args.config)
+    if path is None:
+        logger.error("No snapshot configured in %s; use --output", args.config)
+        return 1
+
+    if args.check:
+        snapshot = load_snapshot(path)
+        if snapshot is None or not is_fresh(snapshot, get_sources(args.config)):
+            logger.info("Routing snapshot %s is stale", path)
+            return 1
+        logger.info("Routing snapshot %s is fresh", path)
+        return 0
+
+    try:
+        snapshot = compile_snapshot(args.config)
+    except configparser.Error:
+        logger.exception("Could not parse config file")
+        return 1
+    write_snapshot(path, snapshot)
+    logger.info(
+        "Wrote routing snapshot of %d zones to %s, skipping %d config files",
+        len(snapshot.routes.overrides),
+        path,
+        len(snapshot.routing_only),
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
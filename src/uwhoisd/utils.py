@@ -4,6 +4,7 @@ import codecs
 import configparser
 import glob
 from importlib import resources
+import ipaddress
 import os.path
 import re
 import typing as t
@@ -52,7 +53,22 @@ class ConfigParser(configparser.ConfigParser):
         return {}
 
 
-def make_config_parser(config_path: t.Optional[str] = None) -> ConfigParser:
+def get_included_paths(parser: configparser.ConfigParser, config_path: str) -> t.List[str]:
+    """Find the config files to include, as per the `[include]` section.
+
+    Args:
+        parser: The config parser the main config file was read into.
+        config_path: The path to the main config file.
+
+    Returns:
+        The paths of the config files to include.
+    """
+    if not parser.has_option("include", "path"):
+        return []
+    return glob.glob(os.path.join(os.path.dirname(config_path), parser.get("include", "path")))
+
+
+def make_config_parser(config_path: t.Optional[str] = None, skip: t.Container[str] = ()) -> ConfigParser:
     """Create a config parser.
 
     This will load the default config from the package, and then overlay
@@ -62,6 +78,7 @@ def make_config_parser(config_path: t.Optional[str] = None) -> ConfigParser:
 
     Args:
         config_path: Optional path to a config file to load.
+        skip: Paths of included config files not to load.
 
     Returns:
         The config parser.
@@ -73,9 +90,7 @@ def make_config_parser(config_path: t.Optional[str] = None) -> ConfigParser:
 
     if config_path is not None:
         parser.read(config_path)
-        if parser.has_option("include", "path"):
-            glob_path = os.path.join(os.path.dirname(config_path), parser.get("include", "path"))
-            parser.read(glob.glob(glob_path))
+        parser.read([path for path in get_included_paths(parser, config_path) if path not in skip])
 
     return parser
 
@@ -92,6 +107,36 @@ def is_well_formed_fqdn(fqdn: str) -> bool:
     return FQDN_PATTERN.match(fqdn) is not None
 
 
+def parse_address(query: str) -> t.Optional[t.Union[ipaddress.IPv4Address, ipaddress.IPv6Address]]:
+    """Parse a query for an IP address, or for a network in CIDR notation.
+
+    Args:
+        query: The query.
+
+    Returns:
+        The address, or the network's first address, or `None` if the query
+        isn't for either.
+    """
+    try:
+        if "/" in query:
+            return ipaddress.ip_network(query, strict=False).network_address
+        return ipaddress.ip_address(query)
+    except ValueError:
+        return None
+
+
+def is_well_formed_query(query: str) -> bool:
+    """Check if a query is for a well formed FQDN, IP address, or network.
+
+    Args:
+        query: The query to check.
+
+    Returns:
+        True if the query is well formed, False otherwise.
+    """
+    return is_well_formed_fqdn(query) or parse_address(query) is not None
+
+
 def split_fqdn(fqdn: str) -> t.List[str]:
     """Split an FQDN into the domain name and zone.
 
@@ -0,0 +1,147 @@
+"""Multi-process worker support."""
+
+import contextlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+
+def bind(iface: str, port: int) -> socket.socket:
+    """Bind a listening socket to be shared by the workers.
+
+    Args:
+        iface: The interface to bind to.
+        port: The port to bind to.
+
+    Returns:
+        The listening socket.
+    """
+    sock = socket.create_server((iface, port), backlog=1024)
+    sock.setblocking(False)  # noqa: FBT003
+    return sock
+
+
+class Supervisor:
+    """Runs a fixed number of worker processes, restarting any that die.
+
+    Workers are forked from the supervisor, so anything set up before the
+    supervisor starts, such as the routing tables, is shared between them
+    copy-on-write. A SIGHUP sent to the supervisor is passed on to every
+    worker.
+
+    Args:
+        count: The number of workers to run.
+        target: Run in each worker with the worker's index, which runs from
+            zero up to `count`; its return value is the worker's exit status.
+            A worker started to replace one that died takes over its index.
+        restart_delay: A worker that dies within this many seconds of being
+            started is only restarted after waiting this long, so a worker
+            that dies immediately doesn't send the supervisor into a spin.
+    """
+
+    __slots__ = (
+        "children",
+        "count",
+        "restart_delay",
+        "stopping",
+        "target",
+    )
+
+    def __init__(self, count: int, target: t.Callable[[int], int], restart_delay: float = 1.0) -> None:
+        super().__init__()
+        self.count = count
+        self.target = target
+        self.restart_delay = restart_delay
+        self.stopping = False
+        # Maps the PIDs of running workers onto their index and when they were
+        # started.
+        self.children: dict[int, tuple[int, float]] = {}
+
+    def spawn(self, index: int) -> int:
+        """Fork a new worker.
+
+        Args:
+            index: The index of the worker.
+
+        Returns:
+            The PID of the worker.
+        """
+        pid = os.fork()
+        if pid == 0:
+            # The worker shouldn't act on the supervisor's signal handlers.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # Until the worker's ready to handle it, a SIGHUP shouldn't kill it.
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            status = 1
+            try:
+                status = self.target(index)
+            except KeyboardInterrupt:
+                status = 0
+            except BaseException:
+                logger.exception("Worker %d failed", os.getpid())
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        self.children[pid] = (index, time.monotonic())
+        logger.info("Started worker %d", pid)
+        return pid
+
+    def stop(self, signum: int = signal.SIGTERM, _frame: t.Any = None) -> None:
+        """Stop all the workers.
+
+        Args:
+            signum: The signal to send to the workers.
+        """
+        self.stopping = True
+        self.forward(signum)
+
+    def forward(self, signum: int = signal.SIGHUP, _frame: t.Any = None) -> None:
+        """Pass a signal on to every worker.
+
+        Args:
+            signum: The signal to send to the workers.
+        """
+        for pid in self.children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signum)
+
+    def reap(self) -> None:
+        """Wait for a worker to exit, and restart it unless stopping."""
+        pid, status = os.wait()
+        child = self.children.pop(pid, None)
+        if child is None:  # pragma: no cover
+            return
+        index, started = child
+        code = os.waitstatus_to_exitcode(status)
+        if self.stopping:
+            logger.info("Worker %d exited with status %d", pid, code)
+            return
+        logger.warning("Worker %d died with status %d; restarting", pid, code)
+        if time.monotonic() - started < self.restart_delay:
+            time.sleep(self.restart_delay)
+        # We might have been told to stop while waiting.
+        if not self.stopping:
+            self.spawn(index)
+
+    def run(self) -> int:
+        """Start the workers and supervise them until told to stop.
+
+        Returns:
+            The exit status for the supervisor.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.forward)
+        for index in range(self.count):
+            self.spawn(index)
+        while self.children:
+            self.reap()
+        return 0
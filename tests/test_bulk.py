@@ -0,0 +1,118 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+from uwhoisd import bulk
+
+from . import utils
+
+
+def route(query):
+    return "whois." + query.rsplit(".", 1)[-1]
+
+
+def make_upstream():
+    return utils.Upstream(route=route, released=True, delay=0.001)
+
+
+def test_read_queries():
+    lines = ["Example.COM\n", "\n", "# comment\n", "example.net  # trailing\n"]
+    assert list(bulk.read_queries(lines)) == ["example.com", "example.net"]
+
+
+def test_dedupe():
+    batch = bulk.Batch(route)
+    assert batch.add("a.com")
+    assert not batch.add("a.com")
+    assert batch.add("b.com")
+    assert len(batch) == 2
+
+
+def test_fair_order():
+    batch = bulk.Batch(route, concurrency=10, per_upstream=10)
+    for i in range(4):
+        batch.add(f"{i}.com")
+    batch.add("a.net")
+    batch.add("b.net")
+    batch.add("a.org")
+    order = []
+    while (item := batch.next()) is not None:
+        order.append(item[0])
+    # The upstreams are taken in turn rather than .com going first.
+    assert order == ["0.com", "a.net", "a.org", "1.com", "b.net", "2.com", "3.com"]
+
+
+def test_per_upstream_limit():
+    batch = bulk.Batch(route, concurrency=10, per_upstream=1)
+    batch.add("a.com")
+    batch.add("b.com")
+    batch.add("a.net")
+    assert batch.next() == ("a.com", "whois.com")
+    assert batch.next() == ("a.net", "whois.net")
+    assert batch.next() is None
+    batch.active["whois.com"] -= 1
+    assert batch.next() == ("b.com", "whois.com")
+
+
+def test_run_batch():
+    upstream = make_upstream()
+    batch = bulk.Batch(route, concurrency=4, per_upstream=2)
+    for query in ["bad..query", "timeout.com", "down.net"] + [f"{i}.com" for i in range(10)] + ["0.com", "x.net"]:
+        batch.add(query)
+    out = io.StringIO()
+
+    failed = asyncio.run(bulk.run_batch(batch, upstream, out))
+    results = {result["query"]: result for result in map(json.loads, out.getvalue().splitlines())}
+
+    assert failed == 3
+    assert len(results) == 14
+    assert results["bad..query"]["error"] == "Bad query"
+    assert results["timeout.com"]["error"] == "Timeout from upstream server"
+    assert results["down.net"]["error"] == "Upstream server whois.net:43 is unavailable"
+    assert results["5.com"]["response"] == "response for 5.com"
+    # Duplicates are only looked up once.
+    assert upstream.calls.count("0.com") == 1
+    assert upstream.peak_total <= 4
+    assert max(upstream.peak.values()) <= 2
+
+
+def test_run_batch_streaming():
+    upstream = make_upstream()
+    batch = bulk.Batch(route, concurrency=4, per_upstream=2, lookahead=8)
+    read = []
+
+    def lines():
+        for i in range(2000):
+            read.append(i)
+            yield f"{i % 1000}.{'com' if i % 2 else 'net'}\n"
+        yield "timeout.org\n"
+
+    def whois(query):
+        if not upstream.calls:
+            # Lookups start before the input has all been read.
+            assert len(read) < 2000
+        return upstream(query)
+
+    out = io.StringIO()
+    failed = asyncio.run(bulk.run_batch(batch, whois, out, lines()))
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert failed == 1
+    assert len(results) == 1001
+    assert sorted(upstream.calls) == sorted({result["query"] for result in results})
+    assert upstream.peak_total <= 4
+    assert max(upstream.peak.values()) <= 2
+
+
+def test_run_batch_read_error():
+    upstream = make_upstream()
+    batch = bulk.Batch(route)
+
+    def lines():
+        yield "a.com\n"
+        raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+
+    with pytest.raises(UnicodeDecodeError):
+        asyncio.run(bulk.run_batch(batch, upstream, io.StringIO(), lines()))
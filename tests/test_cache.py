@@ -1,12 +1,18 @@
-from uwhoisd import caching
+import asyncio
+import random
+import threading
+
+import pytest
+
+from uwhoisd import caching, client
 
 from . import utils
 
 
 class LFU(caching.LFU):
-    def __init__(self, max_size=256, max_age=300):
+    def __init__(self, max_size=256, max_age=300, grace=0):
         self.clock = utils.Clock()
-        super().__init__(max_size, max_age)
+        super().__init__(max_size, max_age, grace)
 
 
 def test_insertion():
@@ -128,3 +134,522 @@ def test_eviction():
     assert len(cache.cache) == 2
     assert len(cache.queue) == 2
     assert sorted(cache.cache.keys()) == ["b", "c"]
+
+
+class LRU(caching.LRU):
+    def __init__(self, max_size=256, max_age=300, max_bytes=4096, grace=0):
+        self.clock = utils.Clock()
+        super().__init__(max_size, max_age, max_bytes, grace)
+
+
+def test_lru():
+    cache = LRU(max_size=2)
+    cache.set("a", "x")
+    cache.set("b", "y")
+    # Hits don't use up any more room.
+    for _ in range(5):
+        assert cache.get("a") == "x"
+    assert len(cache) == 2
+
+    # "b" is the least recently used, so it's the one to go.
+    cache.set("c", "z")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == "x"
+    assert cache.get("c") == "z"
+
+
+def test_lru_replace():
+    cache = LRU()
+    cache.set("a", "xx")
+    cache.set("a", "yyy")
+    assert len(cache) == 1
+    assert cache.size == 3
+    assert cache.get("a") == "yyy"
+
+
+def test_lru_expiration():
+    cache = LRU(max_age=5)
+    cache.set("a", "x")
+    cache.clock.ticks += 3
+    cache.set("b", "y")
+    cache.clock.ticks += 2
+    assert cache.get("a") is None
+    assert cache.get("b") == "y"
+    assert len(cache) == 1
+    assert cache.size == 1
+
+
+def test_lru_max_bytes():
+    cache = LRU(max_bytes=10)
+    cache.set("a", "x" * 4)
+    cache.set("b", "y" * 4)
+    assert cache.size == 8
+    cache.get("a")
+    cache.set("c", "z" * 4)
+    assert cache.size == 8
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    # Sizes are in bytes, not characters.
+    cache.set("d", "\u00e9" * 5)
+    assert cache.size == 10
+    assert len(cache) == 1
+
+    # Anything bigger than the whole budget isn't cached at all.
+    cache.set("e", "e" * 11)
+    assert cache.get("e") is None
+    assert cache.get("d") is not None
+
+
+def hit_ratio(cache, workload):
+    hits = 0
+    for key in workload:
+        if cache.get(key) is None:
+            cache.set(key, "x" * 100)
+        else:
+            hits += 1
+    return hits / len(workload)
+
+
+def test_hit_ratio_on_skewed_workload():
+    rng = random.Random(42)  # noqa: S311
+    keys = [f"{i}.com" for i in range(2000)]
+    # Zipfian popularity, roughly like real query traffic.
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(keys))]
+    workload = rng.choices(keys, weights=weights, k=20000)
+
+    lfu = hit_ratio(LFU(max_size=100), workload)
+    lru = hit_ratio(LRU(max_size=100, max_bytes=100 * 100), workload)
+    # The LFU cache's hot keys hog slots in its queue, so it holds fewer
+    # distinct keys than the LRU cache in the same number of slots.
+    assert lru > lfu
+
+
+async def gather_queries(whois, upstream, queries):
+    tasks = [asyncio.ensure_future(whois(query)) for query in queries]
+    # Let every task reach the point where it's waiting on the upstream.
+    await asyncio.sleep(0)
+    upstream.release.set()
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.mark.parametrize("cache", [None, LFU()])
+def test_coalescing(cache):
+    upstream = utils.Upstream()
+    stats = caching.Stats()
+    whois = caching.wrap_whois(cache, upstream, stats)
+
+    results = asyncio.run(gather_queries(whois, upstream, ["a.com"] * 5 + ["b.com"]))
+    assert upstream.calls == ["a.com", "b.com"]
+    assert results == ["response for a.com"] * 5 + ["response for b.com"]
+    assert stats.misses == 2
+    assert stats.coalesced == 4
+    assert stats.hits == 0
+
+
+def test_coalescing_exception():
+    upstream = utils.Upstream()
+    upstream.error = client.UpstreamTimeoutError()
+    stats = caching.Stats()
+    cache = LFU()
+    whois = caching.wrap_whois(cache, upstream, stats)
+
+    results = asyncio.run(gather_queries(whois, upstream, ["a.com"] * 3))
+    assert upstream.calls == ["a.com"]
+    assert all(isinstance(result, asyncio.TimeoutError) for result in results)
+    assert stats.coalesced == 2
+    # Failures aren't cached.
+    assert cache.get("a.com") is None
+
+
+def test_coalescing_waiter_cancelled():
+    upstream = utils.Upstream()
+    whois = caching.wrap_whois(None, upstream)
+
+    async def run():
+        first = asyncio.ensure_future(whois("a.com"))
+        second = asyncio.ensure_future(whois("a.com"))
+        await asyncio.sleep(0)
+        # The first caller going away mustn't take the lookup down with it.
+        first.cancel()
+        await asyncio.sleep(0)
+        upstream.release.set()
+        return await second
+
+    assert asyncio.run(run()) == "response for a.com"
+    assert upstream.calls == ["a.com"]
+
+
+def test_cache_hits_counted():
+    upstream = utils.Upstream(released=True)
+    stats = caching.Stats()
+    whois = caching.wrap_whois(LFU(), upstream, stats)
+
+    async def run():
+        await whois("a.com")
+        await whois("a.com")
+
+    asyncio.run(run())
+    assert upstream.calls == ["a.com"]
+    assert stats.misses == 1
+    assert stats.hits == 1
+
+
+class SQLite(caching.SQLite):
+    def __init__(self, path, **kwargs):
+        self.clock = utils.Clock()
+        super().__init__(str(path), **kwargs)
+
+
+@pytest.fixture
+def sqlite_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = SQLite(tmp_path / "cache.sqlite", **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.close()
+
+
+def test_sqlite(sqlite_cache):
+    cache = sqlite_cache(max_age=5)
+    assert cache.get("a") is None
+    cache.set("a", "x")
+    assert cache.get("a") == "x"
+    cache.set("a", "y")
+    assert cache.get("a") == "y"
+    cache.flush()
+    assert len(cache) == 1
+
+    cache.clock.ticks += 5
+    assert cache.get("a") is None
+
+
+def test_sqlite_persistence(sqlite_cache):
+    first = sqlite_cache()
+    first.set("a", "x")
+    first.flush()
+
+    # A second process sharing the same file sees the same entries...
+    second = sqlite_cache()
+    assert second.get("a") == "x"
+    second.set("b", "y")
+    second.flush()
+    assert first.get("b") == "y"
+
+    # ...and they survive a restart.
+    first.close()
+    second.close()
+    assert sqlite_cache().get("b") == "y"
+
+
+def test_sqlite_prune_expired(sqlite_cache):
+    cache = sqlite_cache(max_age=5, prune_interval=1000)
+    cache.set("a", "x")
+    cache.clock.ticks += 3
+    cache.set("b", "y")
+    cache.clock.ticks += 3
+    cache.prune()
+    assert len(cache) == 1
+    assert cache.get("b") == "y"
+
+
+def test_sqlite_prune_max_size(sqlite_cache):
+    cache = sqlite_cache(max_size=2, prune_interval=1)
+    for i, key in enumerate("abcd"):
+        cache.clock.ticks = i
+        cache.set(key, "x")
+    cache.flush()
+    assert len(cache) == 2
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("d") == "x"
+
+
+def test_sqlite_prune_max_bytes(sqlite_cache):
+    cache = sqlite_cache(max_bytes=25, prune_interval=1000)
+    for i, key in enumerate("abcd"):
+        cache.clock.ticks = i
+        cache.set(key, key * 10)
+    cache.prune()
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("c") == "c" * 10
+    assert cache.get("d") == "d" * 10
+
+
+def test_sqlite_pending_writes(sqlite_cache):
+    cache = sqlite_cache(max_age=5)
+    release = threading.Event()
+    cache.writer.submit(release.wait)
+    # The write's queued behind the one holding up the writer thread, but
+    # it's already there to be looked up.
+    cache.set("a", "x")
+    assert cache.get("a") == "x"
+    assert len(cache) == 0
+    release.set()
+    cache.flush()
+    assert not cache.pending
+    assert len(cache) == 1
+    assert cache.get("a") == "x"
+
+
+def test_sqlite_write_failure(sqlite_cache, caplog):
+    cache = sqlite_cache()
+    cache.write_conn.execute("DROP TABLE cache")
+    upstream = utils.Upstream(released=True)
+    whois = caching.wrap_whois(cache, upstream)
+    # The response still makes it back, even though it couldn't be cached.
+    assert asyncio.run(whois("a.com")) == "response for a.com"
+    cache.flush()
+    assert "Could not write 'a.com' to the SQLite cache" in caplog.text
+    assert cache.get("a.com") is None
+
+
+def test_max_age_per_entry(sqlite_cache):
+    for cache in (LFU(max_age=60), LRU(max_age=60), sqlite_cache(max_age=60)):
+        cache.set("short", "x", max_age=5)
+        cache.set("long", "y")
+        cache.clock.ticks += 5
+        assert cache.get("short") is None
+        assert cache.get("long") == "y"
+
+        # Replacing an entry gives it the cache's own maximum age again.
+        cache.set("short", "z")
+        cache.clock.ticks += 5
+        assert cache.get("short") == "z"
+
+
+def test_invalidate(sqlite_cache):
+    for cache in (LFU(max_size=4), LRU(max_size=4), sqlite_cache(max_size=4)):
+        for key in ("a.com", "b.org", "c.org", "d.net"):
+            cache.set(key, key.upper())
+        threads = set()
+
+        def stale(key, threads=threads):
+            threads.add(threading.current_thread())
+            return key.endswith(".org")
+
+        assert asyncio.run(cache.invalidate(stale)) == 2
+        # The keys are checked off the event loop.
+        assert threading.main_thread() not in threads
+        assert [cache.get(key) for key in ("a.com", "b.org", "c.org", "d.net")] == ["A.COM", None, None, "D.NET"]
+        assert asyncio.run(cache.invalidate(lambda key: key.endswith(".org"))) == 0
+
+        # The dropped entries' room can be used again without anything else
+        # being pushed out.
+        cache.set("b.org", "B")
+        cache.set("e.org", "E")
+        if isinstance(cache, SQLite):
+            cache.flush()
+        assert len(cache) == 4
+        assert cache.get("a.com") == "A.COM"
+
+
+def test_invalidate_failures():
+    policy = caching.TTLPolicy(timeout=10)
+    policy.fail("a.com", client.UpstreamTimeoutError())
+    policy.fail("b.org", client.UpstreamTimeoutError())
+    assert asyncio.run(policy.invalidate(lambda key: key.endswith(".org"))) == 1
+    assert policy.check("a.com")
+    assert not policy.check("b.org")
+
+
+@pytest.mark.parametrize(
+    ("response", "expected"),
+    [
+        ("Domain Name: EXAMPLE.COM\r\nRegistrar: Example\r\n", caching.FOUND),
+        ('No match for "EXAMPLE.COM".\r\n>>> Last update of whois database', caching.NOT_FOUND),
+        ("%ERROR:101: no entries found\n", caching.NOT_FOUND),
+        ("Domain: example.de\nStatus: free\n", caching.NOT_FOUND),
+        ("WHOIS LIMIT EXCEEDED - SEE WWW.PIR.ORG/WHOIS FOR DETAILS\n", caching.RATE_LIMITED),
+        ("Your connection limit exceeded. Please slow down and try again later.\n", caching.RATE_LIMITED),
+        ("\r\n%ERROR:201: query rate limit exceeded\r\n", caching.RATE_LIMITED),
+        # Boilerplate about rate limits in a record doesn't count.
+        ("Domain Name: EXAMPLE.ORG\r\nComment: Too many requests may be throttled\r\n", caching.FOUND),
+        ("Too many queries will be rate limited.\r\nDomain Name: EXAMPLE.ORG\r\n", caching.FOUND),
+        ("% Terms of use\r\n% Rate limits apply\r\nRegistrant: Someone\r\n", caching.FOUND),
+    ],
+)
+def test_classify(response, expected):
+    assert caching.classify(response) == expected
+
+
+def test_classify_transcript():
+    assert caching.classify(utils.read_transcript("google.com.txt")) == caching.FOUND
+
+
+def test_ttl_policy():
+    cache = LRU(max_age=300)
+    policy = caching.TTLPolicy(not_found=60, rate_limited=0)
+    policy.store(cache, "a.com", "Domain Name: A.COM\n")
+    policy.store(cache, "b.com", "No match for B.COM\n")
+    policy.store(cache, "c.com", "Query rate limit exceeded\n")
+    assert cache.get("c.com") is None
+    cache.clock.ticks += 60
+    assert cache.get("a.com") is not None
+    assert cache.get("b.com") is None
+
+
+def test_wrap_whois_timeout():
+    cache = LFU()
+    policy = caching.TTLPolicy(timeout=10)
+    policy.failures = LRU(max_age=10)
+    upstream = utils.Upstream(released=True)
+    upstream.error = client.UpstreamTimeoutError()
+    stats = caching.Stats()
+    whois = caching.wrap_whois(cache, upstream, stats, policy)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await whois("a.com")
+        # Remembered, so upstream isn't tried again...
+        with pytest.raises(asyncio.TimeoutError):
+            await whois("a.com")
+        assert upstream.calls == ["a.com"]
+        # ...until the timeout's been forgotten about.
+        policy.failures.clock.ticks += 10
+        with pytest.raises(asyncio.TimeoutError):
+            await whois("a.com")
+        assert upstream.calls == ["a.com", "a.com"]
+
+    asyncio.run(run())
+    assert stats.hits == 1
+    assert stats.misses == 2
+
+
+def test_wrap_whois_local_timeout():
+    policy = caching.TTLPolicy(timeout=10)
+    upstream = utils.Upstream(released=True)
+    # Such as the query waiting too long for its turn at the upstream.
+    upstream.error = asyncio.TimeoutError()
+    whois = caching.wrap_whois(LFU(), upstream, policy=policy)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await whois("a.com")
+
+    asyncio.run(run())
+    # That says nothing about the upstream, so it's not remembered.
+    assert upstream.calls == ["a.com", "a.com"]
+    assert not policy.check("a.com")
+
+
+def test_grace(sqlite_cache):
+    for cache in (LFU(max_age=60, grace=30), LRU(max_age=60, grace=30), sqlite_cache(max_age=60, grace=30)):
+        cache.set("a", "x")
+        assert cache.get_entry("a") == ("x", 60)
+        cache.clock.ticks += 70
+        # Stale, so only available to those prepared to take it.
+        assert cache.get("a") is None
+        assert cache.get_entry("a") == ("x", -10)
+        cache.clock.ticks += 20
+        assert cache.get_entry("a") is None
+
+
+def test_lfu_hits_do_not_keep_entries_fresh():
+    cache = LFU(max_age=5)
+    cache.set("a", "x")
+    for _ in range(5):
+        cache.clock.ticks += 1
+        cache.get("a")
+    assert cache.get("a") is None
+
+
+def test_stale_while_revalidate():
+    upstream = utils.Upstream(released=True)
+    cache = LRU(max_age=60, grace=30)
+    cache.set("a.com", "old")
+    cache.clock.ticks += 70
+    stats = caching.Stats()
+    whois = caching.wrap_whois(cache, upstream, stats, refresher=caching.Refresher())
+
+    async def run():
+        # The stale response comes back straight away...
+        assert await whois("a.com") == "old"
+        assert await whois("a.com") == "old"
+        # ...while a single refresh happens in the background.
+        await asyncio.sleep(0.01)
+        assert await whois("a.com") == "response for a.com"
+
+    asyncio.run(run())
+    assert upstream.calls == ["a.com"]
+    assert (stats.hits, stats.misses) == (3, 0)
+
+
+def test_stale_over_failure():
+    upstream = utils.Upstream(released=True)
+    upstream.error = client.UpstreamTimeoutError()
+    cache = LRU(max_age=60, grace=30)
+    cache.set("a.com", "old")
+    cache.clock.ticks += 70
+    policy = caching.TTLPolicy(timeout=10)
+    policy.failures = LRU(max_age=10)
+    whois = caching.wrap_whois(cache, upstream, policy=policy, refresher=caching.Refresher())
+
+    async def run():
+        assert await whois("a.com") == "old"
+        # The refresh fails and the failure is remembered...
+        await asyncio.sleep(0.01)
+        assert upstream.calls == ["a.com"]
+        # ...but the stale response is still served in the meantime.
+        assert await whois("a.com") == "old"
+
+    asyncio.run(run())
+
+
+def test_stale_without_refresher():
+    upstream = utils.Upstream(released=True)
+    cache = LRU(max_age=60, grace=30)
+    cache.set("a.com", "old")
+    cache.clock.ticks += 70
+    whois = caching.wrap_whois(cache, upstream)
+    assert asyncio.run(whois("a.com")) == "response for a.com"
+
+
+def test_refresh_ahead():
+    upstream = utils.Upstream(released=True)
+    cache = LRU(max_age=60)
+    cache.set("hot.com", "old")
+    cache.set("cold.com", "old")
+    cache.clock.ticks += 50
+    refresher = caching.Refresher(refresh_ahead=15, hot_hits=3)
+    whois = caching.wrap_whois(cache, upstream, refresher=refresher)
+
+    async def run():
+        for _ in range(3):
+            await whois("hot.com")
+        await whois("cold.com")
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert upstream.calls == ["hot.com"]
+    assert cache.get_entry("hot.com") == ("response for hot.com", 60)
+
+
+def test_max_refreshes():
+    upstream = utils.Upstream()
+    cache = LRU(max_age=60, grace=30)
+    for name in ("a.com", "b.com", "c.com"):
+        cache.set(name, "old")
+    cache.clock.ticks += 70
+    refresher = caching.Refresher(max_refreshes=2)
+    whois = caching.wrap_whois(cache, upstream, refresher=refresher)
+
+    async def run():
+        for name in ("a.com", "b.com", "c.com"):
+            assert await whois(name) == "old"
+        await asyncio.sleep(0)
+        assert sorted(refresher.refreshing) == ["a.com", "b.com"]
+        upstream.release.set()
+        await asyncio.sleep(0.01)
+        assert not refresher.refreshing
+
+    asyncio.run(run())
+    assert upstream.calls == ["a.com", "b.com"]
@@ -0,0 +1,116 @@
+import pytest
+
+from uwhoisd import rl
+
+from . import utils
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = utils.Clock(100)
+    monkeypatch.setattr(rl.TokenBucket, "clock", staticmethod(clock))
+    return clock
+
+
+def test_per_client(clock):
+    limiter = rl.ClientLimiter(rate=1, burst=2)
+    assert limiter.allow("192.0.2.1")
+    assert limiter.allow("192.0.2.1")
+    assert not limiter.allow("192.0.2.1")
+    # Other clients are unaffected.
+    assert limiter.allow("192.0.2.2")
+    clock.ticks += 1
+    assert limiter.allow("192.0.2.1")
+    assert not limiter.allow("192.0.2.1")
+
+
+def test_cost(clock):
+    limiter = rl.ClientLimiter(rate=1, burst=5, prefix_rate=1, prefix_burst=3)
+    assert not limiter.allow("192.0.2.1", 4)
+    assert limiter.allow("192.0.2.1", 3)
+    assert not limiter.allow("192.0.2.1")
+    clock.ticks += 2
+    assert limiter.allow("192.0.2.1", 2)
+
+
+@pytest.mark.parametrize(
+    ("addr", "expected"),
+    [
+        ("192.0.2.77", "192.0.2.0/24"),
+        ("2001:db8:1:2::5", "2001:db8:1::/48"),
+        ("not-an-ip", None),
+    ],
+)
+def test_get_prefix(addr, expected):
+    limiter = rl.ClientLimiter(rate=1, burst=1)
+    assert limiter.get_prefix(addr) == expected
+
+
+def test_per_prefix(clock):
+    limiter = rl.ClientLimiter(rate=1, burst=2, prefix_rate=1, prefix_burst=3)
+    assert limiter.allow("192.0.2.1")
+    assert limiter.allow("192.0.2.2")
+    assert limiter.allow("192.0.2.3")
+    # The prefix is exhausted even though this address hasn't been seen.
+    assert not limiter.allow("192.0.2.4")
+    assert limiter.allow("198.51.100.1")
+    clock.ticks += 1
+    assert limiter.allow("192.0.2.4")
+
+
+def test_rejection_does_not_charge(clock):
+    limiter = rl.ClientLimiter(rate=1, burst=1, prefix_rate=1, prefix_burst=1)
+    assert limiter.allow("192.0.2.1")
+    assert not limiter.allow("192.0.2.2")
+    clock.ticks += 1
+    # The rejected client wasn't charged for the rejected query.
+    assert limiter.buckets["192.0.2.2"].tokens == 1
+
+
+def test_idle_eviction(clock):
+    limiter = rl.ClientLimiter(rate=1, burst=2)
+    limiter.allow("192.0.2.1")
+    clock.ticks += 1
+    limiter.allow("192.0.2.2")
+    assert len(limiter) == 2
+    # The first client's bucket has had time to refill, so it goes.
+    clock.ticks += 1
+    limiter.allow("192.0.2.3")
+    assert list(limiter.buckets) == ["192.0.2.2", "192.0.2.3"]
+
+
+@pytest.mark.usefixtures("clock")
+def test_max_clients():
+    limiter = rl.ClientLimiter(rate=1, burst=100, max_clients=2)
+    for i in range(1, 5):
+        limiter.allow(f"192.0.2.{i}")
+    limiter.allow("192.0.2.3")
+    limiter.allow("192.0.2.5")
+    assert list(limiter.buckets) == ["192.0.2.3", "192.0.2.5"]
+
+
+def test_max_cost():
+    assert rl.ClientLimiter(rate=1, burst=10).max_cost() == 10
+    assert rl.ClientLimiter(rate=1, burst=10, prefix_burst=3).max_cost() == 10
+    assert rl.ClientLimiter(rate=1, burst=10, prefix_rate=5, prefix_burst=3).max_cost() == 3
+
+
+def test_get_client_limiter():
+    assert rl.get_client_limiter({"rate": "0", "burst": "10"}) is None
+    limiter = rl.get_client_limiter({"rate": "2", "burst": "10", "max_clients": "5"})
+    assert limiter.rate == 2.0
+    assert limiter.burst == 10
+    assert limiter.max_clients == 5
+
+
+def test_partition_client_config():
+    cfg = {"rate": "1", "burst": "10", "prefix_rate": "5", "prefix_burst": "3", "max_clients": "100"}
+    assert rl.partition_client_config(cfg, 1) == cfg
+    assert rl.partition_client_config(cfg, 4) == {
+        "rate": "0.25",
+        "burst": "2",
+        "prefix_rate": "1.25",
+        "prefix_burst": "1",
+        "max_clients": "100",
+    }
+    assert cfg["rate"] == "1"
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from uwhoisd import health
+
+from . import utils
+
+
+class Breaker(health.Breaker):
+    __slots__ = ()
+
+    clock = utils.Clock()
+
+
+@pytest.fixture
+def breaker():
+    Breaker.clock.ticks = 0
+    return Breaker(("whois.example.com", 43), threshold=3, reset_timeout=30)
+
+
+def test_breaker_opens(breaker):
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.fail(0.1)
+    assert breaker.state == health.CLOSED
+    # A success resets the count.
+    breaker.succeed(0.1)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.fail(0.1)
+    assert breaker.state == health.OPEN
+    assert not breaker.is_available()
+    assert not breaker.allow()
+    assert breaker.success_rate < 1.0
+
+
+def test_breaker_probe(breaker):
+    for _ in range(3):
+        breaker.fail(0.1)
+    Breaker.clock.ticks = 30
+    assert breaker.is_available()
+    assert breaker.allow()
+    assert breaker.state == health.HALF_OPEN
+    # Only one probe at a time.
+    assert not breaker.is_available()
+    assert not breaker.allow()
+    breaker.fail(0.1)
+    assert breaker.state == health.OPEN
+    assert not breaker.allow()
+
+    Breaker.clock.ticks = 60
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+    breaker.succeed(0.1)
+    assert breaker.state == health.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_disabled():
+    breaker = health.Breaker(("whois.example.com", 43), threshold=0)
+    for _ in range(100):
+        breaker.fail(1.0)
+    assert breaker.state == health.CLOSED
+
+
+def test_tracker():
+    tracker = health.HealthTracker(threshold=1)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError), tracker.track("whois.example.com", 43):
+            raise asyncio.TimeoutError
+        with pytest.raises(health.UnavailableError, match="whois.example.com:43 is unavailable"):
+            tracker.check("whois.example.com", 43)
+        with pytest.raises(health.UnavailableError), tracker.track("whois.example.com", 43):
+            pass  # pragma: no cover
+        # Upstreams are tracked by port too.
+        tracker.check("whois.example.com", 4343)
+        # Errors that aren't the upstream's fault don't count.
+        with pytest.raises(ValueError, match="oops"), tracker.track("whois.example.net", 43):
+            raise ValueError("oops")
+        with tracker.track("whois.example.net", 43):
+            pass
+
+    asyncio.run(run())
+    assert tracker.collect()[("whois.example.com:43", health.OPEN)] == 1.0
+    assert tracker.collect()[("whois.example.net:43", health.CLOSED)] == 1.0
+    assert tracker.collect_success_rates()[("whois.example.net:43",)] == 1.0
+    assert ("whois.example.com:4343",) in tracker.collect_latencies()
+
+
+def test_tracker_max_upstreams():
+    tracker = health.HealthTracker(threshold=1, max_upstreams=2)
+    tracker.get_breaker("whois.example.com", 43).fail(1.0)
+    tracker.get_breaker("whois.example.net", 43)
+    tracker.get_breaker("whois.example.com", 43)
+    for i in range(200):
+        tracker.get_breaker(f"x{i}.zzzz.whois-servers.net", 43)
+        # The most recently used breakers are the ones kept.
+        tracker.get_breaker("whois.example.com", 43)
+    assert len(tracker.breakers) == 2
+    assert tracker.get_breaker("whois.example.com", 43).state == health.OPEN
+    assert ("whois.example.net", 43) not in tracker.breakers
+
+
+def test_get_health_tracker():
+    tracker = health.get_health_tracker({"threshold": "2", "reset_timeout": "5", "max_upstreams": "10"})
+    assert tracker.threshold == 2
+    assert tracker.reset_timeout == 5.0
+    assert tracker.max_upstreams == 10
+
+
+def test_uwhois_fails_fast():
+    uwhois = utils.create_uwhois()
+    uwhois.health = health.HealthTracker(threshold=1, reset_timeout=60)
+    route = uwhois.router.route("example.com")
+    uwhois.health.get_breaker(route.server, route.port).fail(1.0)
+
+    with pytest.raises(health.UnavailableError):
+        asyncio.run(uwhois.whois("example.com"))
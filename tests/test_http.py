@@ -0,0 +1,181 @@
+import asyncio
+import gzip
+import json
+import socket
+
+import pytest
+
+from uwhoisd import rl, server, workers
+
+from . import utils
+
+
+async def send(reader, writer, request):
+    writer.write(request)
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+    status, *lines = head.rstrip("\r\n").split("\r\n")
+    headers = {name.lower(): value for name, _, value in (line.partition(": ") for line in lines)}
+    body = await reader.readexactly(int(headers["content-length"]))
+    return status, headers, body
+
+
+def run_client(requests, limiter=None, options=server.DEFAULT_HTTP_OPTIONS):
+    upstream = utils.Upstream("Domain Name: {query}\r\n" * 20, released=True)
+    sock = workers.bind("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+
+    async def run():
+        service = asyncio.ensure_future(
+            server.start_http_service("127.0.0.1", 0, upstream, limiter, options, sock=sock)
+        )
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            responses = []
+            for request in requests:
+                if callable(request):
+                    request = request(responses)
+                responses.append(await asyncio.wait_for(send(reader, writer, request), 2))
+            closed = await asyncio.wait_for(reader.read(), 2) == b"" if requests else None
+            writer.close()
+            return responses, closed
+        finally:
+            service.cancel()
+
+    return upstream, *asyncio.run(run())
+
+
+CLOSE = "Connection: close\r\n"
+
+
+def get(path, headers=""):
+    return f"GET {path} HTTP/1.1\r\nHost: localhost\r\n{headers}\r\n".encode()
+
+
+def post(body, headers=""):
+    data = json.dumps(body).encode()
+    return f"POST /whois HTTP/1.1\r\nContent-Length: {len(data)}\r\n{headers}\r\n".encode() + data
+
+
+def test_lookup_keep_alive():
+    upstream, responses, closed = run_client(
+        [get("/whois/Example.com"), get("/whois/bad..query"), get("/whois/timeout.com", CLOSE)]
+    )
+    (status, headers, body), bad, timeout = responses
+    assert status == "HTTP/1.1 200 OK"
+    assert headers["connection"] == "keep-alive"
+    assert json.loads(body) == {"query": "example.com", "response": "Domain Name: example.com\r\n" * 20}
+    assert bad[0] == "HTTP/1.1 400 Bad Request"
+    assert timeout[0] == "HTTP/1.1 504 Gateway Timeout"
+    assert timeout[1]["connection"] == "close"
+    assert closed
+    assert upstream.calls == ["example.com", "timeout.com"]
+
+
+def test_gzip_and_etag():
+    def revalidate(responses):
+        return get("/whois/example.com", f"If-None-Match: {responses[0][1]['etag']}\r\n")
+
+    _, responses, _ = run_client(
+        [
+            get("/whois/example.com", "Accept-Encoding: gzip\r\n"),
+            revalidate,
+            get("/whois/example.com", CLOSE),
+        ]
+    )
+    (status, headers, body), not_modified, plain = responses
+    assert headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == plain[2]
+    # The ETag doesn't depend on the encoding.
+    assert headers["etag"] == plain[1]["etag"]
+    assert not_modified[0] == "HTTP/1.1 304 Not Modified"
+    assert not_modified[2] == b""
+
+
+def test_batch():
+    upstream, responses, _ = run_client([post({"queries": ["a.com", "B.com", "a.com", "x"]}, CLOSE)])
+    status, _, body = responses[0]
+    assert status == "HTTP/1.1 200 OK"
+    results = json.loads(body)["results"]
+    assert [result["query"] for result in results] == ["a.com", "b.com", "a.com", "x"]
+    assert results[3] == {"query": "x", "error": "Bad query"}
+    assert sorted(upstream.calls) == ["a.com", "b.com"]
+
+
+UNRESOLVABLE = str(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+
+
+def test_upstream_error():
+    upstream, responses, _ = run_client(
+        [get("/whois/unresolvable.zz"), post({"queries": ["a.com", "unresolvable.zz"]}, CLOSE)]
+    )
+    (status, _, body), (batch_status, _, batch_body) = responses
+    assert status == "HTTP/1.1 502 Bad Gateway"
+    assert json.loads(body) == {"query": "unresolvable.zz", "error": UNRESOLVABLE}
+    # The rest of the batch is still answered.
+    assert batch_status == "HTTP/1.1 200 OK"
+    assert json.loads(batch_body)["results"] == [
+        {"query": "a.com", "response": "Domain Name: a.com\r\n" * 20},
+        {"query": "unresolvable.zz", "error": UNRESOLVABLE},
+    ]
+    assert sorted(upstream.calls) == ["a.com", "unresolvable.zz", "unresolvable.zz"]
+
+
+@pytest.mark.parametrize(
+    ("request_", "expected"),
+    [
+        (post({"queries": "a.com"}, CLOSE), "400 Bad Request"),
+        (post({"queries": ["a.com"] * 3}, CLOSE), "413 Content Too Large"),
+        (get("/metrics", CLOSE), "404 Not Found"),
+        (get("/whois", CLOSE), "405 Method Not Allowed"),
+        (b"GET /whois/a.com HTTP/1.1\r\nContent-Length: 1000\r\n\r\n", "413 Content Too Large"),
+        (b"nonsense\r\n\r\n", "400 Bad Request"),
+    ],
+)
+def test_bad_requests(request_, expected):
+    options = server.HTTPOptions(max_batch=2, max_body=100)
+    _, responses, _ = run_client([request_], options=options)
+    assert responses[0][0] == f"HTTP/1.1 {expected}"
+
+
+def test_max_requests():
+    _, responses, closed = run_client(
+        [get("/whois/a.com"), get("/whois/b.com")], options=server.HTTPOptions(max_requests=2)
+    )
+    assert [headers["connection"] for _, headers, _ in responses] == ["keep-alive", "close"]
+    assert closed
+
+
+def test_rate_limited():
+    limiter = rl.ClientLimiter(rate=0.001, burst=1)
+    _, responses, _ = run_client([get("/whois/a.com"), get("/whois/b.com", CLOSE)], limiter)
+    assert responses[1][0] == "HTTP/1.1 429 Too Many Requests"
+
+
+def test_http_options():
+    assert server.get_http_options({"max_batch": "5"}) == server.HTTPOptions(max_batch=5)
+
+
+def test_batch_rate_limited():
+    limiter = rl.ClientLimiter(rate=0.001, burst=3)
+    upstream, responses, _ = run_client(
+        [
+            post({"queries": ["c.com", "d.com"]}),
+            post({"queries": ["a.com", "b.com"]}),
+            post({"queries": ["e.com"]}, CLOSE),
+        ],
+        limiter,
+    )
+    statuses = [status for status, _, _ in responses]
+    assert statuses == ["HTTP/1.1 200 OK", "HTTP/1.1 429 Too Many Requests", "HTTP/1.1 200 OK"]
+    assert upstream.calls == ["c.com", "d.com", "e.com"]
+    assert limiter.buckets["127.0.0.1"].tokens < 1
+
+
+def test_batch_larger_than_burst():
+    limiter = rl.ClientLimiter(rate=0.001, burst=10, prefix_rate=1, prefix_burst=3)
+    upstream, responses, _ = run_client([post({"queries": ["a.com", "b.com", "c.com", "d.com"]}, CLOSE)], limiter)
+    status, _, body = responses[0]
+    # It could never be afforded, so it's not worth the client retrying.
+    assert status == "HTTP/1.1 413 Content Too Large"
+    assert json.loads(body) == {"error": "At most 3 queries can be made at once"}
+    assert upstream.calls == []
@@ -0,0 +1,127 @@
+import asyncio
+import socket
+
+import pytest
+
+import uwhoisd
+from uwhoisd import client, metrics
+
+from . import utils
+
+
+def test_counter():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter("requests_total", "Requests.", ("outcome",)))
+    counter.inc(("ok",))
+    counter.inc(("ok",), 2)
+    counter.inc(('say "hi"\n',))
+    assert registry.render() == (
+        "# HELP requests_total Requests.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{outcome="ok"} 3\n'
+        'requests_total{outcome="say \\"hi\\"\\n"} 1\n'
+    )
+
+
+def test_gauge():
+    gauge = metrics.Gauge("connections", "Connections.")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.get() == 1
+    gauge.set(7)
+    assert list(gauge.samples()) == ["connections 7"]
+
+
+def test_callback():
+    size = {(): 3}
+    callback = metrics.Callback("entries", "Entries.", (), lambda: size)
+    assert list(callback.samples()) == ["entries 3"]
+    size[()] = 4
+    assert list(callback.samples()) == ["entries 4"]
+
+
+def test_histogram():
+    histogram = metrics.Histogram("duration_seconds", "Duration.", ("zone",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, ("com",))
+    histogram.observe(0.1, ("com",))
+    histogram.observe(0.5, ("com",))
+    histogram.observe(5.0, ("com",))
+    assert histogram.count(("com",)) == 4
+    assert histogram.count(("net",)) == 0
+    assert list(histogram.samples()) == [
+        'duration_seconds_bucket{zone="com",le="0.1"} 2',
+        'duration_seconds_bucket{zone="com",le="1.0"} 3',
+        'duration_seconds_bucket{zone="com",le="+Inf"} 4',
+        'duration_seconds_sum{zone="com"} 5.65',
+        'duration_seconds_count{zone="com"} 4',
+    ]
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def fetch(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    response = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    return response
+
+
+def test_endpoint():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter("requests_total", "Requests.")).inc()
+    port = get_free_port()
+
+    async def run():
+        service = asyncio.ensure_future(metrics.start_service("127.0.0.1", port, registry))
+        for _ in range(100):
+            try:
+                found = await fetch(port, b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                break
+            except OSError:
+                await asyncio.sleep(0.01)
+        missing = await fetch(port, b"GET /nope HTTP/1.0\r\n\r\n")
+        wrong = await fetch(port, b"POST /metrics HTTP/1.0\r\n\r\n")
+        service.cancel()
+        return found, missing, wrong
+
+    found, missing, wrong = asyncio.run(run())
+    head, body = found.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.0 200 OK\r\n")
+    assert b"Content-Type: text/plain; version=0.0.4" in head
+    assert body == b"# HELP requests_total Requests.\n# TYPE requests_total counter\nrequests_total 1\n"
+    assert missing.startswith(b"HTTP/1.0 404 ")
+    assert wrong.startswith(b"HTTP/1.0 405 ")
+
+
+def test_observe_upstream():
+    labels = ("test", "whois.test", "timeout")
+    before = uwhoisd.UPSTREAM_DURATION.count(labels)
+    with pytest.raises(asyncio.TimeoutError), uwhoisd.observe_upstream("test", "whois.test"):
+        raise asyncio.TimeoutError
+    assert uwhoisd.UPSTREAM_DURATION.count(labels) == before + 1
+
+
+def test_upstream_labels_bounded(monkeypatch):
+    async def stream_whois(server, port, query, resolver, timeouts, deadline):  # noqa: ARG001
+        yield b"response\r\n"
+
+    monkeypatch.setattr(client, "stream_whois", stream_whois)
+    uwhois = utils.create_uwhois()
+
+    async def run():
+        await uwhois.whois("example.org")
+        for i in range(20):
+            await uwhois.whois(f"x.r{i}.zzzz")
+
+    asyncio.run(run())
+    labels = set(uwhoisd.UPSTREAM_DURATION.values)
+    assert ("org", "whois.publicinterestregistry.org", "ok") in labels
+    assert ("other", "other", "ok") in labels
+    assert not any(zone.endswith(".zzzz") or server.endswith(".zzzz.whois-servers.net") for zone, server, _ in labels)
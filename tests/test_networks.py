@@ -0,0 +1,203 @@
+import asyncio
+import ipaddress
+import re
+
+import pytest
+
+import uwhoisd
+from uwhoisd import caching, networks, routing
+
+ARIN = """\
+NetRange:       8.0.0.0 - 8.127.255.255
+CIDR:           8.0.0.0/9
+NetName:        LVLT-ORG-8-8
+
+NetRange:       8.8.8.0 - 8.8.8.255
+CIDR:           8.8.8.0/24
+NetName:        GOGL
+"""
+
+ARIN_REFERRAL = """\
+NetRange:       193.0.0.0 - 193.255.255.255
+CIDR:           193.0.0.0/8
+NetName:        RIPE-CIDR-BLOCK
+ReferralServer:  whois://whois.ripe.net
+"""
+
+RIPE = """\
+inetnum:        193.0.0.0 - 193.0.7.255
+netname:        RIPE-NCC
+"""
+
+
+def address(value):
+    return ipaddress.ip_address(value)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("1", "1.0.0.0/8"),
+        ("41", "41.0.0.0/8"),
+        ("200.3.12/22", "200.3.12.0/22"),
+        ("192.0.2.0/24", "192.0.2.0/24"),
+        ("2001:db8::/32", "2001:db8::/32"),
+    ],
+)
+def test_parse_network(value, expected):
+    assert networks.parse_network(value) == ipaddress.ip_network(expected)
+
+
+@pytest.mark.parametrize("value", ["", "bogus", "300", "192.0.2.0/33"])
+def test_parse_bad_network(value):
+    assert networks.parse_network(value) is None
+
+
+def test_find_network():
+    # The most specific network is picked out of ARIN's list.
+    assert networks.find_network(ARIN, address("8.8.8.8")) == ipaddress.ip_network("8.8.8.0/24")
+    assert networks.find_network(ARIN, address("8.1.2.3")) == ipaddress.ip_network("8.0.0.0/9")
+    assert networks.find_network(RIPE, address("193.0.6.139")) == ipaddress.ip_network("193.0.0.0/21")
+    assert networks.find_network("inet6num: 2001:67c:2e8::/48\n", address("2001:67c:2e8::1")) == (
+        ipaddress.ip_network("2001:67c:2e8::/48")
+    )
+    assert networks.find_network("inetnum: 200.3.12/22\n", address("200.3.13.1")) == (
+        ipaddress.ip_network("200.3.12.0/22")
+    )
+    # Networks not covering the address are ignored.
+    assert networks.find_network(RIPE, address("192.0.2.1")) is None
+    assert networks.find_network("No match found\n", address("192.0.2.1")) is None
+
+
+def test_prefix_table():
+    table = networks.PrefixTable()
+    table.add(ipaddress.ip_network("8.0.0.0/8"), "a")
+    table.add(ipaddress.ip_network("8.8.0.0/16"), "b")
+    table.add(ipaddress.ip_network("8.8.8.0/24"), "c")
+    table.add(ipaddress.ip_network("2001:db8::/32"), "d")
+    assert len(table) == 4
+    assert table.lookup(address("8.1.1.1")) == "a"
+    assert table.lookup(address("8.8.4.4")) == "b"
+    assert table.lookup(address("8.8.8.8")) == "c"
+    assert table.lookup(address("9.9.9.9")) is None
+    assert table.lookup(address("2001:db8::1")) == "d"
+    assert table.lookup(address("2001:db9::1")) is None
+    table.clear()
+    assert len(table) == 0
+    assert table.lookup(address("8.8.8.8")) is None
+
+
+def test_covering_prefixes():
+    keys = networks.CoveringPrefixes(ipv4_prefix=16, ipv6_prefix=48)
+    assert keys.key("example.com") == "example.com"
+    assert keys.key_response("example.com", ARIN) == "example.com"
+    assert keys.key("8.8.8.8") == "8.8.8.8"
+    assert keys.key_response("8.8.8.8", ARIN) == "8.8.8.0/24"
+    assert keys.key("8.8.8.4") == "8.8.8.0/24"
+    assert keys.key("8.8.4.4") == "8.8.4.4"
+    # The /9 is wider than responses are shared across.
+    assert keys.key_response("8.1.2.3", ARIN) == "8.1.0.0/16"
+    assert keys.key("8.1.200.1") == "8.1.0.0/16"
+    assert keys.key("8.2.0.1") == "8.2.0.1"
+    # No network in the response, so it's keyed by the address.
+    assert keys.key_response("192.0.2.1", "No match found\n") == "192.0.2.1"
+    assert keys.key("192.0.2.2") == "192.0.2.2"
+    # Queries for networks aren't answered by responses for part of them.
+    assert keys.key("8.8.8.0/24") == "8.8.8.0/24"
+    assert keys.key_response("8.0.0.0/8", ARIN) == "8.0.0.0/8"
+    assert keys.key("8.0.0.0/8") == "8.0.0.0/8"
+
+
+def test_covering_prefixes_max_size():
+    keys = networks.CoveringPrefixes(max_size=1)
+    keys.key_response("8.8.8.8", ARIN)
+    keys.key_response("193.0.6.139", RIPE)
+    assert keys.key("8.8.8.4") == "8.8.8.4"
+    assert keys.key("193.0.6.1") == "193.0.6.0/24"
+
+
+def test_router():
+    patterns = {"ipv4": re.compile(r"ReferralServer: whois://(?P<server>\S+)")}
+    router = routing.Router.build(
+        "whois-servers.net",
+        43,
+        {},
+        {"ipv4": "n + "},
+        patterns,
+        assignments={"8": "whois.arin.net", "193": "whois.ripe.net", "8.8.8.0/24": "whois.example.net:4343"},
+        unassigned_server="whois.iana.org",
+    )
+    assert router.route("8.1.2.3") == routing.Route("ipv4", "whois.arin.net", 43, "n + ", patterns["ipv4"])
+    assert router.route("8.8.8.8").server == "whois.example.net"
+    assert router.route("8.8.8.8").port == 4343
+    assert router.route("193.0.6.139").server == "whois.ripe.net"
+    assert router.route("193.0.0.0/21").server == "whois.ripe.net"
+    assert router.route("192.0.2.1").server == "whois.iana.org"
+    assert router.route("2001:db8::1") == routing.Route("ipv6", "whois.iana.org", 43)
+    # The address zones aren't domain names.
+    assert router.route("example.ipv4").server == "ipv4.whois-servers.net"
+
+
+def test_router_bad_assignment():
+    with pytest.raises(ValueError, match="Bad network"):
+        routing.Router.build(None, 43, {}, {}, {}, assignments={"bogus": "whois.arin.net"})
+
+
+def test_referral(monkeypatch):
+    uwhois = uwhoisd.UWhois()
+    uwhois.router = routing.Router.build(
+        None,
+        43,
+        {},
+        {},
+        {"ipv4": re.compile(r"ReferralServer:\s*whois://(?P<server>[-a-z0-9.]+)")},
+        assignments={"193": "whois.arin.net"},
+    )
+    calls = []
+
+    async def query_upstream(self, zone, server, port, query, deadline, limit_zone=None):  # noqa: ARG001
+        calls.append((zone, server, query))
+        yield (ARIN_REFERRAL if server == "whois.arin.net" else RIPE).encode()
+
+    monkeypatch.setattr(uwhoisd.UWhois, "query_upstream", query_upstream)
+    assert asyncio.run(uwhois.whois("193.0.6.139")) == RIPE
+    assert calls == [("ipv4", "whois.arin.net", "193.0.6.139"), ("ipv4", "whois.ripe.net", "193.0.6.139")]
+
+
+def test_shared_response():
+    calls = []
+
+    async def upstream(query):
+        calls.append(query)
+        return ARIN
+
+    cache = caching.LRU()
+    whois = caching.wrap_whois(cache, upstream, keys=networks.CoveringPrefixes())
+
+    async def run():
+        return [await whois(query) for query in ("8.8.8.8", "8.8.8.4", "8.8.4.4", "example.com")]
+
+    assert asyncio.run(run()) == [ARIN] * 4
+    # The second address is in the network the first's response covered.
+    assert calls == ["8.8.8.8", "8.8.4.4", "example.com"]
+    assert cache.get("8.8.8.0/24") == ARIN
+    assert cache.get("8.8.4.0/24") == ARIN
+
+
+def test_shared_response_streamed():
+    calls = []
+
+    async def upstream(query):
+        calls.append(query)
+        yield ARIN.encode()
+
+    whois = caching.wrap_whois_stream(caching.LRU(), upstream, keys=networks.CoveringPrefixes())
+
+    async def run():
+        responses = []
+        for query in ("8.8.8.8", "8.8.8.4"):
+            responses.append(b"".join([chunk async for chunk in whois(query)]))  # noqa: PERF401
+        return responses
+
+    assert asyncio.run(run()) == [ARIN.encode()] * 2
+    assert calls == ["8.8.8.8"]
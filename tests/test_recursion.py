@@ -1,4 +1,22 @@
+import asyncio
+
+import pytest
+
 from tests import utils
+import uwhoisd
+from uwhoisd import routing
+
+EXPECTED = "whois.markmonitor.com"
+
+
+@pytest.fixture(scope="module")
+def uwhois():
+    return utils.create_uwhois()
+
+
+@pytest.fixture(scope="module")
+def transcript():
+    return utils.read_transcript("google.com.txt")
 
 
 def test_recursion():
@@ -8,3 +26,66 @@ def test_recursion():
     # Make sure there's nothing wrong with the WHOIS transcript.
     assert transcript.count(expected) == 1
     assert uwhois.get_registrar_whois_server("com", transcript) == expected
+
+
+def test_shared_patterns(uwhois):
+    patterns = uwhois.recursion_patterns
+    assert patterns["com"] is patterns["net"]
+    assert len({id(pattern) for pattern in patterns.values()}) < len(patterns)
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 4096])
+def test_scanner_chunked(uwhois, transcript, size):
+    scanner = routing.ReferralScanner(uwhois.recursion_patterns["com"])
+    data = transcript.encode()
+    for i in range(0, len(data), size):
+        scanner.feed(data[i : i + size])
+    match = scanner.close()
+    assert match is not None
+    assert match.group("server") == EXPECTED
+
+
+def test_scanner_stops_at_referral(uwhois, transcript):
+    scanner = routing.ReferralScanner(uwhois.recursion_patterns["com"])
+    assert scanner.feed(transcript.encode()) is not None
+    assert scanner.is_done()
+    # Nothing more is kept once the referral's been found.
+    scanner.feed(b"x" * 100000)
+    assert not scanner.partial
+
+
+def test_scanner_window(uwhois, transcript):
+    # The window ends partway through the registrar's WHOIS server.
+    uwhois.referral_window = transcript.index(EXPECTED) + 5
+    try:
+        assert uwhois.get_registrar_whois_server("com", transcript) is None
+        uwhois.referral_window = len(transcript)
+        assert uwhois.get_registrar_whois_server("com", transcript) == EXPECTED
+    finally:
+        uwhois.referral_window = routing.REFERRAL_WINDOW
+
+
+def test_scanner_huge_line(uwhois):
+    scanner = routing.ReferralScanner(uwhois.recursion_patterns["com"], window=1024)
+    for _ in range(1000):
+        scanner.feed(b"a" * 4096)
+    assert scanner.is_done()
+    assert len(scanner.partial) == 0
+    assert scanner.close() is None
+
+
+def test_thin_registry_stream(uwhois, transcript, monkeypatch):
+    calls = []
+
+    async def query_upstream(self, zone, server, port, query, deadline, limit_zone=None):  # noqa: ARG001
+        calls.append(server)
+        if len(calls) == 1:
+            data = transcript.encode()
+            for i in range(0, len(data), 100):
+                yield data[i : i + 100]
+        else:
+            yield b"Registrant: Google LLC\r\n"
+
+    monkeypatch.setattr(uwhoisd.UWhois, "query_upstream", query_upstream)
+    assert asyncio.run(uwhois.whois("example.com")) == "Registrant: Google LLC\r\n"
+    assert calls == ["whois.verisign-grs.com", EXPECTED]
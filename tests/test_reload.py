@@ -0,0 +1,144 @@
+import asyncio
+import os
+import signal
+import sqlite3
+
+import pytest
+
+import uwhoisd
+from uwhoisd import caching, utils
+
+MAIN = """\
+[include]
+path=conf.d/*.ini
+
+[uwhoisd]
+suffix=whois-servers.net
+conservative=
+"""
+
+RECURSION = """\
+[recursion_patterns]
+com=Whois Server: ?(?P<server>[\\-a-z0-9.]+)
+"""
+
+
+def write_overrides(tmp_path, **overrides):
+    lines = ["[overrides]"] + [f"{zone}={server}" for zone, server in overrides.items()]
+    (tmp_path / "conf.d" / "overrides.ini").write_text("\n".join(lines) + "\n")
+
+
+@pytest.fixture
+def config(tmp_path):
+    (tmp_path / "conf.d").mkdir()
+    (tmp_path / "uwhoisd.ini").write_text(MAIN)
+    (tmp_path / "conf.d" / "recursion.ini").write_text(RECURSION)
+    write_overrides(tmp_path, com="whois.verisign-grs.com", org="whois.pir.org")
+    return str(tmp_path / "uwhoisd.ini")
+
+
+@pytest.fixture
+def uwhois(config):
+    uwhois = uwhoisd.UWhois()
+    uwhois.read_config(utils.make_config_parser(config))
+    return uwhois
+
+
+def test_reload(config, tmp_path, uwhois):
+    cache = caching.LRU()
+    policy = caching.TTLPolicy()
+    for query in ("example.com", "example.org", "example.net"):
+        cache.set(query, f"response for {query}")
+    policy.fail("other.org", asyncio.TimeoutError())
+    assert uwhois.router.route("example.org").server == "whois.pir.org"
+
+    write_overrides(tmp_path, com="whois.verisign-grs.com", org="whois.example.org")
+    assert asyncio.run(uwhoisd.reload_routing_tables(config, uwhois, (cache, policy, None)))
+
+    assert uwhois.router.route("example.org").server == "whois.example.org"
+    assert uwhois.get_whois_server("org") == ("whois.example.org", 43)
+    # Only what was cached for the rerouted zone was dropped.
+    assert cache.get("example.com") == "response for example.com"
+    assert cache.get("example.net") == "response for example.net"
+    assert cache.get("example.org") is None
+    assert not policy.check("other.org")
+
+
+def test_reload_broken_config(config, tmp_path, uwhois):
+    cache = caching.LRU()
+    cache.set("example.org", "response")
+    (tmp_path / "conf.d" / "overrides.ini").write_text("[overrides\norg=whois.example.org\n")
+    assert not asyncio.run(uwhoisd.reload_routing_tables(config, uwhois, (cache,)))
+    # The old routing tables are kept, along with the cache.
+    assert uwhois.router.route("example.org").server == "whois.pir.org"
+    assert cache.get("example.org") == "response"
+
+
+def test_reload_invalidation_failure(config, tmp_path, uwhois, caplog):
+    class LockedCache(caching.LRU):
+        async def invalidate(self, stale):  # noqa: ARG002
+            raise sqlite3.OperationalError("database is locked")
+
+    cache = LockedCache()
+    cache.set("example.org", "response")
+    write_overrides(tmp_path, com="whois.verisign-grs.com", org="whois.example.org")
+    assert asyncio.run(uwhoisd.reload_routing_tables(config, uwhois, (cache,)))
+    # The new tables are kept even so.
+    assert uwhois.router.route("example.org").server == "whois.example.org"
+    assert "database is locked" in caplog.text
+
+
+def test_in_flight_query_keeps_old_tables(config, tmp_path, uwhois, monkeypatch):
+    calls = []
+    # Made within the event loop, as on Python 3.9 events are tied to the
+    # loop current when they're made.
+    registry_started = registry_release = None
+
+    async def query_upstream(self, zone, server, port, query, deadline, limit_zone=None):  # noqa: ARG001
+        calls.append(server)
+        if len(calls) == 1:
+            registry_started.set()
+            await registry_release.wait()
+            yield b"Whois Server: whois.registrar.example\r\n"
+        else:
+            yield b"Registrant: Example\r\n"
+
+    monkeypatch.setattr(uwhoisd.UWhois, "query_upstream", query_upstream)
+
+    async def run():
+        nonlocal registry_started, registry_release
+        registry_started = asyncio.Event()
+        registry_release = asyncio.Event()
+        query = asyncio.ensure_future(uwhois.whois("example.com"))
+        await registry_started.wait()
+        # Swap in tables where 'com' is no longer thin, and goes elsewhere.
+        (tmp_path / "conf.d" / "recursion.ini").unlink()
+        write_overrides(tmp_path, com="whois.example.com")
+        assert await uwhoisd.reload_routing_tables(config, uwhois, ())
+        registry_release.set()
+        return await query
+
+    response = asyncio.run(run())
+    # The query started on the old tables, so it still followed the referral.
+    assert calls == ["whois.verisign-grs.com", "whois.registrar.example"]
+    assert response == "Registrant: Example\r\n"
+    assert uwhois.router.route("example.com").server == "whois.example.com"
+    assert uwhois.router.route("example.com").pattern is None
+
+
+def test_reload_on_sighup(config, tmp_path, uwhois):
+    async def run():
+        task = asyncio.ensure_future(uwhoisd.handle_reloads(config, uwhois, ()))
+        await asyncio.sleep(0)
+        write_overrides(tmp_path, org="whois.example.org")
+        os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(200):
+            if uwhois.router.route("example.org").server == "whois.example.org":
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert uwhois.router.route("example.org").server == "whois.example.org"
+    assert signal.getsignal(signal.SIGHUP) == signal.SIG_DFL
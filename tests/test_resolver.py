@@ -0,0 +1,158 @@
+import asyncio
+import socket
+
+import pytest
+
+from uwhoisd import client, resolver
+
+from . import utils
+
+
+class Resolver(resolver.Resolver):
+    def __init__(self, **kwargs):
+        self.clock = utils.Clock()
+        super().__init__(**kwargs)
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    lookups = []
+
+    async def getaddrinfo(self, host, port, **kwargs):  # noqa: ARG001
+        lookups.append(host)
+        await asyncio.sleep(0)
+        if host.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", port)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", port)),
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("2001:db8::1", port, 0, 0)),
+        ]
+
+    monkeypatch.setattr(asyncio.BaseEventLoop, "getaddrinfo", getaddrinfo)
+    return lookups
+
+
+def test_caching(lookups):
+    res = Resolver(max_age=10)
+
+    async def run():
+        return [await res.resolve("whois.example.com", 43) for _ in range(3)]
+
+    results = asyncio.run(run())
+    expected = [(socket.AF_INET, "192.0.2.1"), (socket.AF_INET6, "2001:db8::1")]
+    assert results == [expected] * 3
+    assert lookups == ["whois.example.com"]
+    assert (res.hits, res.misses) == (2, 1)
+
+    res.clock.ticks += 10
+    asyncio.run(run())
+    assert lookups == ["whois.example.com"] * 2
+
+
+def test_parallel_lookups_coalesced(lookups):
+    res = Resolver()
+
+    async def run():
+        return await asyncio.gather(
+            res.resolve("whois.example.com", 43),
+            res.resolve("whois.example.com", 43),
+            res.resolve("whois.example.net", 43),
+        )
+
+    asyncio.run(run())
+    assert sorted(lookups) == ["whois.example.com", "whois.example.net"]
+
+
+def test_negative_caching(lookups):
+    res = Resolver(negative_max_age=5)
+
+    async def run():
+        with pytest.raises(socket.gaierror):
+            await res.resolve("whois.example.invalid", 43)
+
+    asyncio.run(run())
+    asyncio.run(run())
+    assert lookups == ["whois.example.invalid"]
+    res.clock.ticks += 5
+    asyncio.run(run())
+    assert lookups == ["whois.example.invalid"] * 2
+
+
+def test_discard(lookups):
+    res = Resolver()
+
+    async def run():
+        return await res.resolve("whois.example.com", 43)
+
+    asyncio.run(run())
+    res.discard("whois.example.com", (socket.AF_INET, "192.0.2.1"))
+    assert asyncio.run(run()) == [(socket.AF_INET6, "2001:db8::1")]
+    res.discard("whois.example.com", (socket.AF_INET6, "2001:db8::1"))
+    # With nothing left, the host is looked up afresh.
+    asyncio.run(run())
+    assert lookups == ["whois.example.com"] * 2
+
+
+@pytest.mark.usefixtures("lookups")
+def test_max_size():
+    res = Resolver(max_size=2)
+
+    async def run(host):
+        await res.resolve(host, 43)
+
+    for host in ("a.example", "b.example", "c.example"):
+        asyncio.run(run(host))
+    assert list(res.cache) == ["b.example", "c.example"]
+
+
+@pytest.mark.usefixtures("lookups")
+def test_metrics():
+    res = Resolver(max_size=1, max_age=10)
+
+    def counts():
+        return (
+            resolver.LOOKUPS.get(("hit",)),
+            resolver.LOOKUPS.get(("miss",)),
+            resolver.EVICTIONS.get(("expired",)),
+            resolver.EVICTIONS.get(("capacity",)),
+        )
+
+    async def run(*hosts):
+        for host in hosts:
+            await res.resolve(host, 43)
+
+    before = counts()
+    asyncio.run(run("a.example", "a.example"))
+    res.clock.ticks += 10
+    asyncio.run(run("a.example", "b.example"))
+    assert [after - start for after, start in zip(counts(), before)] == [1, 3, 1, 1]
+
+
+def test_connect_skips_bad_addresses():
+    async def handle(reader, writer):
+        query = await reader.readuntil(b"\r\n")
+        writer.write(b"You asked for " + query)
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, host="127.0.0.1", port=0)
+        port = server.sockets[0].getsockname()[1]
+        res = Resolver()
+        # Nothing's listening on the first address.
+        res.store("whois.example.com", 60, [(socket.AF_INET, "127.0.0.2"), (socket.AF_INET, "127.0.0.1")])
+        async with server:
+            try:
+                # Make sure the first address really is refused.
+                await asyncio.open_connection("127.0.0.2", port)
+            except OSError:
+                pass
+            else:  # pragma: no cover
+                pytest.skip("127.0.0.2 is reachable")
+            response = await client.query_whois("whois.example.com", port, "example.com", res)
+        return res, response
+
+    res, response = asyncio.run(run())
+    assert response == "You asked for example.com\r\n"
+    assert res.cache["whois.example.com"][1] == [(socket.AF_INET, "127.0.0.1")]
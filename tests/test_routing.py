@@ -0,0 +1,97 @@
+import re
+
+import pytest
+
+from uwhoisd import routing
+
+from . import utils
+
+
+@pytest.fixture(scope="module")
+def router():
+    return utils.create_uwhois().router
+
+
+@pytest.mark.parametrize(
+    ("query", "zone", "server"),
+    [
+        ("google.com", "com", "whois.verisign-grs.com"),
+        ("www.google.com", "com", "whois.verisign-grs.com"),
+        ("bbc.co.uk", "uk", "whois.nic.uk"),
+        ("example.ac.uk", "ac.uk", "whois.ja.net"),
+        ("example.ae.org", "ae.org", "whois.centralnic.com"),
+        ("example.br.com", "br.com", "whois.centralnic.com"),
+        # No override of its own, so it inherits that of the enclosing zone.
+        ("example.co.bz", "co.bz", "whois.nic.bz"),
+        # Conservative zones without an override use the suffix.
+        ("example.gz", "gz", "gz.whois-servers.net"),
+        # Unknown zones fall back on the suffix too.
+        ("example.invalid", "invalid", "invalid.whois-servers.net"),
+        ("www.example.invalid", "example.invalid", "example.invalid.whois-servers.net"),
+    ],
+)
+def test_route(router, query, zone, server):
+    route = router.route(query)
+    assert route.zone == zone
+    assert route.server == server
+    assert route.port == 43
+
+
+def test_route_prefixes_and_patterns(router):
+    route = router.route("example.com")
+    assert route.prefix == "domain "
+    assert route.pattern is not None
+
+    # Neither prefixes nor patterns are inherited from enclosing zones.
+    route = router.route("example.br.com")
+    assert route.prefix == ""
+    assert route.pattern is None
+
+    route = router.route("example.co.bz")
+    assert route.pattern is not None
+
+
+@pytest.mark.parametrize(
+    ("zone", "server", "prefix"),
+    [
+        ("com", "whois.verisign-grs.com", "domain "),
+        ("br.com", "whois.centralnic.com", ""),
+        ("co.bz", "whois.nic.bz", ""),
+        ("invalid", "invalid.whois-servers.net", ""),
+    ],
+)
+def test_uwhois_follows_router(zone, server, prefix):
+    uwhois = utils.create_uwhois()
+    assert uwhois.get_whois_server(zone) == (server, 43)
+    assert uwhois.get_prefix(zone) == prefix
+    assert uwhois.router.route_zone(zone).zone == zone
+
+
+def test_zone_is_never_whole_query():
+    router = routing.Router.build("whois-servers.net", 43, {"co.bz": "whois.nic.bz", "bz": "whois.nic.bz"}, {}, {})
+    assert router.route("co.bz").zone == "bz"
+    assert router.lookup("bz") is None
+
+
+def test_ports():
+    router = routing.Router.build(
+        "whois-servers.net",
+        43,
+        {"example": "whois.example:4343"},
+        {"sub.example": "prefix "},
+        {"sub.example": re.compile("x")},
+    )
+    assert router.route("foo.example") == routing.Route("example", "whois.example", 4343)
+    route = router.route("foo.sub.example")
+    assert (route.zone, route.server, route.port, route.prefix) == ("sub.example", "whois.example", 4343, "prefix ")
+
+
+@pytest.mark.parametrize(
+    ("server", "expected"),
+    [
+        ("whois.example.com", ("whois.example.com", 43)),
+        ("whois.example.com:4343", ("whois.example.com", 4343)),
+    ],
+)
+def test_parse_server(server, expected):
+    assert routing.parse_server(server, 43) == expected
@@ -1,9 +1,15 @@
+import http.server
 from os import path
+import socket
+import threading
+import typing as t
 
 import bs4
 import pytest
 
-from uwhoisd import scraper
+from uwhoisd import extract, scraper
+
+from . import utils
 
 HERE = path.dirname(__file__)
 
@@ -44,3 +50,236 @@ def test_extract_whois_server_no_matches(fragment):
     body = bs4.BeautifulSoup(fragment, "html.parser")
     result = scraper.extract_whois_server(body)
     assert result is None
+
+
+class ZoneDB(http.server.BaseHTTPRequestHandler):
+    """Serves the fixtures as a stand-in for IANA's root zone database."""
+
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+    # Maps zones onto the WHOIS servers to list on their pages.
+    servers: t.ClassVar[dict[str, str]] = {}
+    # Zone pages served in full.
+    served: t.ClassVar[list[str]] = []
+    # Whether zone pages have ETags.
+    etags = True
+    # If set, zone pages are held here until as many are being served as it
+    # has parties, so they're known to be fetched at once.
+    barrier: t.ClassVar[t.Optional[threading.Barrier]] = None
+
+    def get_body(self):
+        if self.path == "/domains/root/db":
+            with open(path.join(HERE, "iana-root-zone.html"), "rb") as fh:
+                return None, fh.read()
+        zone = path.splitext(path.basename(self.path))[0]
+        if self.barrier is not None:
+            self.barrier.wait()
+        # The 'bt' page has no WHOIS server, so the fallback's used.
+        if zone == "bt":
+            return zone, b""
+        with open(path.join(HERE, "zone-info-fragment.html"), "rb") as fh:
+            whois_server = self.servers.get(zone, f"whois.nic.{zone}")
+            return zone, fh.read().replace(b"whois.nic.abc", whois_server.encode())
+
+    def do_GET(self):  # noqa: N802
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.peak = max(cls.peak, cls.active)
+        try:
+            zone, body = self.get_body()
+            etag = f'"{len(body)}-{hash(body)}"'
+            if zone is not None and self.etags and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            if zone is not None:
+                self.served.append(zone)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            if self.etags:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def zone_db(monkeypatch):
+    def gethostbyname(host):
+        if host != "whois.nic.bt":
+            raise socket.gaierror(host)
+        return "192.0.2.1"
+
+    monkeypatch.setattr(socket, "gethostbyname", gethostbyname)
+    ZoneDB.peak = 0
+    ZoneDB.servers.clear()
+    ZoneDB.served.clear()
+    ZoneDB.etags = True
+    ZoneDB.barrier = None
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ZoneDB)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_address[1]}/domains/root/db"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_scrape_whois_from_iana(zone_db, workers):
+    ZoneDB.barrier = threading.Barrier(min(workers, 3), timeout=10)
+    result = list(scraper.scrape_whois_from_iana(zone_db, {}, workers=workers))
+    # In the same order as the root zone database, however they finish.
+    assert result == [("aaa", "whois.nic.aaa"), ("bt", "whois.nic.bt"), ("xxx", "whois.nic.xxx")]
+    assert ZoneDB.peak == min(workers, 3)
+
+
+def test_scrape_whois_from_iana_existing(zone_db):
+    result = list(scraper.scrape_whois_from_iana(zone_db, {"bt": "whois.example.bt"}, workers=4))
+    assert result == [("aaa", "whois.nic.aaa"), ("bt", "whois.example.bt"), ("xxx", "whois.nic.xxx")]
+
+
+def test_fetcher_rate():
+    clock = utils.Clock()
+    sleeps = []
+
+    class Fetcher(scraper.Fetcher):
+        __slots__ = ()
+
+    Fetcher.clock = clock
+    Fetcher.sleep = sleeps.append
+    fetcher = Fetcher(rate=2)
+    for _ in range(3):
+        fetcher.wait("www.iana.org")
+    fetcher.wait("www.example.com")
+    assert sleeps == [0.5, 1.0]
+    clock.ticks = 10
+    fetcher.wait("www.iana.org")
+    assert sleeps == [0.5, 1.0]
+
+
+EXPECTED = [("aaa", "whois.nic.aaa"), ("bt", "whois.nic.bt"), ("xxx", "whois.nic.xxx")]
+
+
+def test_incremental_scrape(zone_db):
+    state = {}
+    assert list(scraper.scrape_whois_from_iana(zone_db, {}, workers=4, state=state)) == EXPECTED
+    assert sorted(ZoneDB.served) == ["aaa", "bt", "xxx"]
+    assert state["aaa"].etag is not None
+    assert state["bt"].whois_server == "whois.nic.bt"
+
+    # Nothing's changed, so the pages don't need to be sent again.
+    ZoneDB.served.clear()
+    assert list(scraper.scrape_whois_from_iana(zone_db, {}, workers=4, state=state)) == EXPECTED
+    assert ZoneDB.served == []
+
+    ZoneDB.servers["xxx"] = "whois.example.xxx"
+    scraped = scraper.scrape_whois_from_iana(zone_db, {}, workers=4, state=state)
+    assert list(scraper.diff_overrides(dict(EXPECTED), scraped)) == ["-xxx=whois.nic.xxx", "+xxx=whois.example.xxx"]
+    assert ZoneDB.served == ["xxx"]
+
+
+def test_incremental_scrape_without_etags(zone_db, monkeypatch):
+    ZoneDB.etags = False
+    state = {}
+    list(scraper.scrape_whois_from_iana(zone_db, {}, state=state))
+    # An unchanged page isn't scraped again, so the fallback isn't retried.
+    monkeypatch.setattr(socket, "gethostbyname", None)
+    assert list(scraper.scrape_whois_from_iana(zone_db, {}, state=state)) == EXPECTED
+
+
+def test_incremental_scrape_max_age(zone_db):
+    state = {"gone": scraper.ZoneState("http://example.com/gone.html")}
+    list(scraper.scrape_whois_from_iana(zone_db, {}, state=state, max_age=3600))
+    ZoneDB.served.clear()
+    assert list(scraper.scrape_whois_from_iana(zone_db, {}, state=state, max_age=3600)) == EXPECTED
+    assert ZoneDB.served == []
+    assert sorted(state) == ["aaa", "bt", "xxx"]
+
+
+def test_max_age_default():
+    # A nightly run shouldn't check every zone page every night.
+    assert scraper.make_arg_parser().parse_args(["--full"]).max_age == scraper.MAX_AGE > 0
+    assert scraper.make_arg_parser().parse_args(["--full", "--max-age", "0"]).max_age == 0
+
+
+def test_state_round_trip(tmp_path):
+    state_path = str(tmp_path / "state.json")
+    assert scraper.load_state(state_path) == {}
+    state = {"aaa": scraper.ZoneState("http://example.com/aaa.html", '"x"', None, "abc", "whois.nic.aaa", 1.5)}
+    scraper.save_state(state_path, state)
+    assert scraper.load_state(state_path) == state
+    with open(state_path, "w") as fh:
+        fh.write("{")
+    assert scraper.load_state(state_path) == {}
+
+
+def test_diff_overrides():
+    old = {"aaa": "whois.nic.aaa", "bt": "whois.nic.bt", "gone": "whois.nic.gone"}
+    new = [("aaa", "whois.nic.aaa"), ("bt", "whois.example.bt"), ("new", "whois.nic.new")]
+    assert list(scraper.diff_overrides(old, new)) == [
+        "-bt=whois.nic.bt",
+        "+bt=whois.example.bt",
+        "+new=whois.nic.new",
+        "-gone=whois.nic.gone",
+    ]
+
+
+def read_fixture(name):
+    with open(path.join(HERE, name), encoding="utf-8") as fh:
+        return fh.read()
+
+
+def test_extractors_agree_on_root_zone():
+    html = read_fixture("iana-root-zone.html")
+    expected = list(scraper.soup_zone_urls("http://example.com", html))
+    assert list(scraper.stream_zone_urls("http://example.com", html)) == expected
+    assert [zone for zone, _ in expected] == ["aaa", "bt", "xxx"]
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        read_fixture("zone-info-fragment.html"),
+        "<html><body></body></html>",
+        "<html><body><b>WHOIS Server:</b> </body></html>",
+        "<html><body><b>WHOIS Server:</b></body></html>",
+        "<p><b>WHOIS Server:</b> <a href='#'>WHOIS.Example.COM</a></p>",
+        "<p><b>WHOIS Server:</b><a href='#'><i>whois</i>.example.com</a> trailing</p>",
+        "<p><b>WHOIS Server:</b>whois.example.com<br>other</p>",
+        "<p><b>WHOIS Server:</b>whois.example.com</p><p><b>WHOIS Server:</b>second</p>",
+        "<p><b>WHOIS Server: </b>whois.example.com</p><p><b>WHOIS Server:</b>second</p>",
+        "<p><b><i>WHOIS Server:</i></b>whois.example.com</p>",
+        "<p><b>WHOIS Server:</b><br>whois.example.com</p>",
+        "<p><b>WHOIS Server:</b>whois.example&#46;com &amp; more</p>",
+    ],
+)
+def test_extractors_agree_on_whois_server(html):
+    assert extract.whois_server(html) == scraper.soup_whois_server(html)
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        "",
+        '<table id="tld-table"><tr><td class="tld"><a href="/a.html">.a</a></td><td>generic</td><td>X</td></tr>',
+        '<table id="tld-table"><tr><td><span class="tld"><a href="/a.html">.a</a><a href="/b.html">.b</a></span></td>'
+        "<td>test</td><td>X</td></tr><tr><td><b class='x tld'><a href=/c.html><i>.c</i></a></b></td><td></td><td>"
+        "</td></tr></table>",
+        '<div class="tld"><table id="tld-table"><tr><td><a href="/a.html">.a</a></td></tr></table></div>',
+        '<table id="tld-table"><tr><td class="tld"><a href="/a.html">.a<!-- x --></a></td><td>generic<td>Retired'
+        '</tr><tr><td class="tld"><a href="/b.html">.B</a><td><br></td><td>Retired </td></tr></table>',
+    ],
+)
+def test_extractors_agree_on_zone_urls(html):
+    expected = list(scraper.soup_zone_urls("http://example.com", html))
+    assert list(scraper.stream_zone_urls("http://example.com", html)) == expected
@@ -0,0 +1,73 @@
+import asyncio
+
+from uwhoisd import rl, server, workers
+
+from . import utils
+
+whois = utils.Upstream("response for {query}\r\n", released=True)
+
+
+async def start(port, sock, sessions, limiter=None):
+    service = asyncio.ensure_future(
+        server.start_service("127.0.0.1", port, whois, limiter, sock=sock, sessions=sessions)
+    )
+    await asyncio.sleep(0)
+    return service
+
+
+def run_client(sessions, request, limiter=None):
+    sock = workers.bind("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+
+    async def run():
+        service = await start(port, sock, sessions, limiter)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            response = await asyncio.wait_for(reader.read(), 2)
+            writer.close()
+            return response.decode()
+        finally:
+            service.cancel()
+
+    return asyncio.run(run())
+
+
+def test_session_pipelined():
+    response = run_client(server.Sessions(), b"-k a.com\r\nb.com\r\n\r\nc.com\r\n-k\r\n")
+    assert response.split("\r\n; End of response\r\n") == [
+        "response for a.com\r\n",
+        "response for b.com\r\n",
+        "response for c.com\r\n",
+        "",
+    ]
+
+
+def test_session_without_query():
+    response = run_client(server.Sessions(), b"-k\r\na.com\r\n-k\r\n")
+    assert response == "response for a.com\r\n\r\n; End of response\r\n"
+
+
+def test_session_query_limit():
+    response = run_client(server.Sessions(max_queries=2), b"-k a.com\r\nb.com\r\nc.com\r\n")
+    assert "response for b.com" in response
+    assert "c.com" not in response
+    assert response.endswith("; End of response\r\n; Query limit reached: closing\r\n")
+
+
+def test_session_idle_timeout():
+    response = run_client(server.Sessions(idle_timeout=0.05), b"-k a.com\r\n")
+    assert response.endswith("; End of response\r\n; Idle timeout: closing\r\n")
+
+
+def test_session_rate_limited():
+    limiter = rl.ClientLimiter(rate=0.001, burst=2)
+    response = run_client(server.Sessions(), b"-k a.com\r\nb.com\r\nc.com\r\n-k\r\n", limiter)
+    assert "response for b.com" in response
+    assert "; Rate limited\r\n" in response
+    assert "response for c.com" not in response
+
+
+def test_sessions_disabled():
+    response = run_client(None, b"-k a.com\r\n")
+    assert response == "; Bad query: '-k a.com'\r\n"
@@ -0,0 +1,161 @@
+import os
+import sys
+
+import pytest
+
+from uwhoisd import UWhois, snapshot, utils
+
+MAIN = """\
+[include]
+path=conf.d/*.ini
+
+[uwhoisd]
+snapshot=routes.snap
+"""
+
+SCRAPED = """\
+[overrides]
+com=whois.verisign-grs.com
+net=whois.verisign-grs.com
+org=whois.pir.org
+"""
+
+OTHER = """\
+[uwhoisd]
+suffix=whois-servers.net
+conservative=
+
+[prefixes]
+whois.verisign-grs.com="domain "
+
+[recursion_patterns]
+whois.verisign-grs.com=Registrar\\s+WHOIS\\s+Server:\\s+(\\S+)
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    (tmp_path / "conf.d").mkdir()
+    (tmp_path / "uwhoisd.ini").write_text(MAIN)
+    (tmp_path / "conf.d" / "scraped.ini").write_text(SCRAPED)
+    (tmp_path / "conf.d" / "other.ini").write_text(OTHER)
+    return str(tmp_path / "uwhoisd.ini")
+
+
+def compile_snapshot(config):
+    path = snapshot.get_snapshot_path(config)
+    snapshot.write_snapshot(path, snapshot.compile_snapshot(config))
+    return path
+
+
+def test_routing_only(config):
+    snap = snapshot.compile_snapshot(config)
+    assert snap.routing_only == (os.path.join(os.path.dirname(config), "conf.d", "scraped.ini"),)
+    assert sorted(snap.sources) == sorted(snapshot.get_sources(config))
+
+
+def test_round_trip(config):
+    path = compile_snapshot(config)
+    assert snapshot.load_snapshot(path) == snapshot.compile_snapshot(config)
+
+
+def test_routes_match_full_parse(config):
+    compile_snapshot(config)
+    parser, routes = snapshot.read_config(config)
+    assert routes == snapshot.get_routes(utils.make_config_parser(config))
+    assert routes.prefixes["whois.verisign-grs.com"] == "domain "
+    # The routing-only file was skipped, but everything else was read.
+    assert not parser.has_option("overrides", "com")
+    assert parser.get("uwhoisd", "suffix") == "whois-servers.net"
+
+
+def test_no_snapshot(config, tmp_path):
+    (tmp_path / "uwhoisd.ini").write_text("[include]\npath=conf.d/*.ini\n")
+    parser, routes = snapshot.read_config(config)
+    assert routes is None
+    assert parser.get("overrides", "com") == "whois.verisign-grs.com"
+
+
+def test_missing_snapshot(config):
+    parser, routes = snapshot.read_config(config)
+    assert routes is None
+    assert parser.get("overrides", "com") == "whois.verisign-grs.com"
+
+
+def test_stale_on_change(config, tmp_path):
+    compile_snapshot(config)
+    scraped = tmp_path / "conf.d" / "scraped.ini"
+    scraped.write_text(SCRAPED + "io=whois.nic.io\n")
+    parser, routes = snapshot.read_config(config)
+    assert routes is None
+    assert parser.get("overrides", "io") == "whois.nic.io"
+
+
+def test_stale_on_new_file(config, tmp_path):
+    compile_snapshot(config)
+    (tmp_path / "conf.d" / "extra.ini").write_text("[overrides]\nio=whois.nic.io\n")
+    parser, routes = snapshot.read_config(config)
+    assert routes is None
+    assert parser.get("overrides", "io") == "whois.nic.io"
+
+
+def test_stale_on_removed_file(config, tmp_path):
+    compile_snapshot(config)
+    (tmp_path / "conf.d" / "other.ini").unlink()
+    _, routes = snapshot.read_config(config)
+    assert routes is None
+
+
+def test_bad_magic(config):
+    path = compile_snapshot(config)
+    with open(path, "r+b") as fh:
+        fh.write(b"NOTASNAP")
+    assert snapshot.load_snapshot(path) is None
+    _, routes = snapshot.read_config(config)
+    assert routes is None
+
+
+def test_other_python(config):
+    path = compile_snapshot(config)
+    with open(path, "r+b") as fh:
+        fh.write(snapshot.HEADER.pack(snapshot.MAGIC, snapshot.VERSION, 2, 7))
+    assert snapshot.load_snapshot(path) is None
+    _, routes = snapshot.read_config(config)
+    assert routes is None
+
+
+def test_stale_on_new_defaults(config, monkeypatch):
+    compile_snapshot(config)
+    monkeypatch.setattr(snapshot, "get_defaults_digest", lambda: "changed")
+    _, routes = snapshot.read_config(config)
+    assert routes is None
+
+
+def test_truncated(config):
+    path = compile_snapshot(config)
+    with open(path, "r+b") as fh:
+        fh.truncate(snapshot.HEADER.size + 4)
+    assert snapshot.load_snapshot(path) is None
+
+
+def test_uwhois_routes_the_same(config):
+    compile_snapshot(config)
+    parser, routes = snapshot.read_config(config)
+    from_snapshot = UWhois()
+    from_snapshot.read_config(parser, routes)
+    from_config = UWhois()
+    from_config.read_config(utils.make_config_parser(config))
+    assert from_snapshot.overrides == from_config.overrides
+    assert from_snapshot.prefixes == from_config.prefixes
+    assert from_snapshot.recursion_patterns == from_config.recursion_patterns
+    for query in ("example.com", "example.org", "example.io"):
+        assert from_snapshot.router.route(query) == from_config.router.route(query)
+
+
+def test_main(config, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["uwhoisd-snapshot", "--check", config])
+    assert snapshot.main() == 1
+    monkeypatch.setattr(sys, "argv", ["uwhoisd-snapshot", config])
+    assert snapshot.main() == 0
+    monkeypatch.setattr(sys, "argv", ["uwhoisd-snapshot", "--check", config])
+    assert snapshot.main() == 0
@@ -0,0 +1,235 @@
+import asyncio
+import re
+
+import pytest
+
+import uwhoisd
+from uwhoisd import caching, client, routing
+
+from . import utils
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_broadcast():
+    async def run():
+        broadcast = caching.Broadcast()
+        broadcast.feed(b"a")
+        early = asyncio.ensure_future(collect(broadcast))
+        await asyncio.sleep(0)
+        broadcast.feed(b"b")
+        await asyncio.sleep(0)
+        late = asyncio.ensure_future(collect(broadcast))
+        broadcast.feed(b"c")
+        broadcast.close()
+        return await early, await late
+
+    early, late = asyncio.run(run())
+    assert early == late == [b"a", b"b", b"c"]
+
+
+def test_broadcast_error():
+    async def run():
+        broadcast = caching.Broadcast()
+        broadcast.feed(b"a")
+        broadcast.close(asyncio.TimeoutError())
+        return await collect(broadcast)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+
+
+def test_wrap_whois_stream():
+    upstream = utils.Upstream("first second")
+    stats = caching.Stats()
+    cache = caching.LRU()
+    stream = caching.wrap_whois_stream(cache, upstream.stream, stats)
+
+    async def run():
+        tasks = [asyncio.ensure_future(collect(stream("a.com"))) for _ in range(3)]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        results = await asyncio.gather(*tasks)
+        results.append(await collect(stream("a.com")))
+        return results
+
+    results = asyncio.run(run())
+    assert upstream.calls == ["a.com"]
+    assert results[:3] == [[b"first ", b"second"]] * 3
+    # Cache hits come back in one piece.
+    assert results[3] == [b"first second"]
+    assert cache.get("a.com") == "first second"
+    assert (stats.misses, stats.coalesced, stats.hits) == (1, 2, 1)
+
+
+def test_wrap_whois_stream_error():
+    async def upstream(query):  # noqa: ARG001
+        yield b"partial"
+        raise asyncio.TimeoutError
+
+    cache = caching.LRU()
+    stream = caching.wrap_whois_stream(cache, upstream)
+
+    chunks = []
+
+    async def run():
+        async for chunk in stream("a.com"):
+            chunks.append(chunk)  # noqa: PERF401
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert chunks == [b"partial"]
+    assert cache.get("a.com") is None
+
+
+def test_wrap_whois_stream_cached_timeout():
+    calls = []
+
+    async def upstream(query):
+        calls.append(query)
+        raise client.UpstreamTimeoutError
+        yield b""  # pragma: no cover
+
+    stream = caching.wrap_whois_stream(caching.LRU(), upstream, policy=caching.TTLPolicy(timeout=10))
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await collect(stream("a.com"))
+
+    asyncio.run(run())
+    assert calls == ["a.com"]
+
+
+def test_wrap_whois_stream_stale(monkeypatch):
+    clock = utils.Clock()
+    monkeypatch.setattr(caching.LRU, "clock", staticmethod(clock))
+    upstream = utils.Upstream("first second", released=True)
+    cache = caching.LRU(max_age=60, grace=30)
+    cache.set("a.com", "old")
+    clock.ticks += 70
+    stream = caching.wrap_whois_stream(cache, upstream.stream, refresher=caching.Refresher())
+
+    async def run():
+        stale = await collect(stream("a.com"))
+        await asyncio.sleep(0.01)
+        return stale, await collect(stream("a.com"))
+
+    assert asyncio.run(run()) == ([b"old"], [b"first second"])
+    assert upstream.calls == ["a.com"]
+
+
+class FakeWhois(utils.FakeWhoisServer):
+    """A fake WHOIS server acting as both a thin registry and a registrar."""
+
+    def __init__(self, registrar=(b"Registrant: Someone\r\n",)):
+        super().__init__()
+        # What the registrar says, in turn, the last answer being repeated.
+        self.registrar = list(registrar)
+
+    async def handle(self, reader, writer):
+        query = (await reader.readuntil(b"\r\n")).decode().strip()
+        self.queries.append(query)
+        if query.startswith("domain "):
+            writer.write(b"Domain: example.test\r\n")
+            await writer.drain()
+            writer.write(b"Whois Server: 127.0.0.1\r\n")
+        else:
+            writer.write(self.registrar.pop(0) if len(self.registrar) > 1 else self.registrar[0])
+        await writer.drain()
+        writer.close()
+
+
+def make_uwhois(port, registry_whois):
+    uwhois = uwhoisd.UWhois()
+    uwhois.registry_whois = registry_whois
+    uwhois.router = routing.Router.build(
+        "whois-servers.net",
+        43,
+        {"test": f"127.0.0.1:{port}"},
+        {"test": "domain "},
+        {"test": re.compile("Whois Server: (?P<server>[-a-z0-9.]+)", re.IGNORECASE)},
+    )
+    return uwhois
+
+
+@pytest.mark.parametrize(
+    ("registry_whois", "expected"),
+    [
+        (False, "Registrant: Someone\r\n"),
+        (True, "Domain: example.test\r\nWhois Server: 127.0.0.1\r\n\fRegistrant: Someone\r\n"),
+    ],
+)
+def test_uwhois_stream(registry_whois, expected):
+    fake = FakeWhois()
+
+    async def run():
+        async with fake as port:
+            uwhois = make_uwhois(port, registry_whois)
+            chunks = await collect(uwhois.stream("example.test"))
+            response = await uwhois.whois("example.test")
+        return chunks, response
+
+    chunks, response = asyncio.run(run())
+    assert b"".join(chunks).decode() == expected
+    assert response == expected
+    assert fake.queries == ["domain example.test", "example.test"] * 2
+
+
+@pytest.mark.parametrize(
+    ("registry_whois", "expected"),
+    [
+        # The registrar's WHOIS server is remembered, so the registry's skipped.
+        (False, ["domain example.test", "example.test", "example.test"]),
+        # The registry's response is wanted, so it has to be queried anyway.
+        (True, ["domain example.test", "example.test"] * 2),
+    ],
+)
+def test_uwhois_referrals(registry_whois, expected):
+    fake = FakeWhois()
+
+    async def run():
+        async with fake as port:
+            uwhois = make_uwhois(port, registry_whois)
+            uwhois.referrals = caching.LRU()
+            first = await uwhois.whois("example.test")
+            second = await uwhois.whois("example.test")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert fake.queries == expected
+
+
+def test_uwhois_referral_failure():
+    async def run():
+        uwhois = make_uwhois(1, registry_whois=False)
+        uwhois.referrals = caching.LRU()
+        # Pretend a registrar that's since gone away was found earlier.
+        uwhois.referrals.set("example.test", "127.0.0.1")
+        with pytest.raises(ConnectionRefusedError):
+            await uwhois.whois("example.test")
+        return uwhois.referrals.get("example.test")
+
+    assert asyncio.run(run()) is None
+
+
+def test_uwhois_referral_not_found():
+    fake = FakeWhois([b"No match for example.test\r\n", b"Registrant: Someone\r\n"])
+
+    async def run():
+        async with fake as port:
+            uwhois = make_uwhois(port, registry_whois=False)
+            uwhois.referrals = caching.LRU()
+            # The name's since moved away from the registrar found earlier.
+            uwhois.referrals.set("example.test", "127.0.0.1")
+            response = await uwhois.whois("example.test")
+        return response, uwhois.referrals.get("example.test")
+
+    response, referral = asyncio.run(run())
+    assert response == "Registrant: Someone\r\n"
+    # The registry was asked, and referred to the registrar afresh.
+    assert fake.queries == ["example.test", "domain example.test", "example.test"]
+    assert referral == "127.0.0.1"
@@ -0,0 +1,227 @@
+import asyncio
+import re
+import socket
+import struct
+
+import pytest
+
+import uwhoisd
+from uwhoisd import caching, client, routing, server, workers
+
+from . import utils
+
+
+def test_parse_timeouts():
+    default = client.parse_timeouts("total=8 connect=2")
+    assert default == client.Timeouts(total=8, connect=2)
+    assert client.parse_timeouts("read=1.5", default) == client.Timeouts(total=8, connect=2, read=1.5)
+    with pytest.raises(ValueError, match="Unknown timeout"):
+        client.parse_timeouts("bogus=1")
+
+
+def test_deadline():
+    async def run():
+        deadline = client.Deadline(0.05)
+        assert deadline.limit(10) <= 0.05
+        assert deadline.limit(0.01) == 0.01
+        await asyncio.sleep(0.06)
+        with pytest.raises(asyncio.TimeoutError):
+            deadline.limit(10)
+
+    asyncio.run(run())
+
+
+class SlowResolver:
+    async def resolve(self, host, port):  # noqa: ARG002
+        await asyncio.sleep(10)
+
+    def discard(self, host, addr):  # pragma: no cover
+        pass
+
+
+def test_resolve_timeout():
+    timeouts = client.Timeouts(resolve=0.01)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await client.query_whois("whois.example.com", 43, "example.com", SlowResolver(), timeouts)
+
+    asyncio.run(run())
+
+
+class Silent(utils.FakeWhoisServer):
+    """A WHOIS server that accepts queries and never answers them."""
+
+    async def handle(self, reader, writer):
+        self.queries.append((await reader.readuntil(b"\r\n")).decode().strip())
+        try:
+            await reader.read()
+        finally:
+            writer.close()
+
+
+def test_read_timeout():
+    silent = Silent()
+    timeouts = client.Timeouts(read=0.05)
+
+    async def run():
+        async with silent as port:
+            with pytest.raises(client.UpstreamTimeoutError):
+                await client.query_whois("127.0.0.1", port, "example.com", timeouts=timeouts)
+
+    asyncio.run(run())
+    assert silent.queries == ["example.com"]
+
+
+class Registry(utils.FakeWhoisServer):
+    """A thin registry that takes its time answering."""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    async def handle(self, reader, writer):
+        try:
+            await reader.readuntil(b"\r\n")
+            await asyncio.sleep(self.delay)
+            writer.write(b"Whois Server: 127.0.0.1\r\n")
+            await writer.drain()
+        finally:
+            # The client may well have given up and the test ended by now.
+            writer.close()
+
+
+def test_deadline_carries_across_hops():
+    registry = Registry(0.15)
+
+    async def run():
+        async with registry as port:
+            uwhois = uwhoisd.UWhois()
+            uwhois.router = routing.Router.build(
+                "whois-servers.net",
+                43,
+                {"test": f"127.0.0.1:{port}"},
+                {},
+                {"test": re.compile("Whois Server: (?P<server>[-a-z0-9.]+)", re.IGNORECASE)},
+            )
+            # Each hop is allowed 0.2s, but both together only 0.25s, so the
+            # registrar has to answer within what the registry left over.
+            uwhois.timeouts = {"test": client.Timeouts(total=0.25, read=0.2)}
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            with pytest.raises(asyncio.TimeoutError) as exc_info:
+                await uwhois.whois("example.test")
+            # It was the deadline that ran out, not the registrar's read timeout.
+            assert not isinstance(exc_info.value, client.UpstreamTimeoutError)
+            return loop.time() - start
+
+    elapsed = asyncio.run(run())
+    assert 0.25 <= elapsed < 0.35
+
+
+def test_single_flight_cancelled_once_abandoned():
+    cancelled = None
+
+    async def call():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def run():
+        nonlocal cancelled
+        cancelled = asyncio.Event()
+        flights = caching.SingleFlight()
+        first = asyncio.ensure_future(flights.run("a", call))
+        second = asyncio.ensure_future(flights.run("a", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        # Somebody's still waiting on it.
+        assert not cancelled.is_set()
+        second.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert len(flights) == 0
+
+    asyncio.run(run())
+
+
+def test_broadcast_cancelled_once_abandoned():
+    cancelled = None
+
+    async def upstream(query):  # noqa: ARG001
+        yield b"first"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        yield b"second"  # pragma: no cover
+
+    stream = caching.wrap_whois_stream(None, upstream)
+
+    async def run():
+        nonlocal cancelled
+        cancelled = asyncio.Event()
+        reader = stream("a.com")
+        assert await reader.__anext__() == b"first"
+        await reader.aclose()
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(run())
+
+
+def test_client_disconnect_cancels_lookup():
+    started = cancelled = None
+
+    async def whois(query):  # noqa: ARG001
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return ""  # pragma: no cover
+
+    sock = workers.bind("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+
+    async def run():
+        nonlocal started, cancelled
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+        whois_func = caching.wrap_whois(None, whois)
+        service = asyncio.ensure_future(server.start_service("127.0.0.1", port, whois_func, sock=sock))
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"example.com\r\n")
+        await asyncio.wait_for(started.wait(), 1)
+        # Reset the connection, as a client that's killed would.
+        writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        writer.close()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        service.cancel()
+
+    asyncio.run(run())
+
+
+def test_half_closed_client_gets_response():
+    whois = utils.Upstream("response for {query}\r\n", released=True, delay=0.05)
+
+    sock = workers.bind("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+
+    async def run():
+        service = asyncio.ensure_future(server.start_service("127.0.0.1", port, whois, sock=sock))
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"example.com\r\n")
+        # Done sending, as with `nc -N`, but still waiting for the response.
+        writer.write_eof()
+        response = await asyncio.wait_for(reader.read(), 1)
+        writer.close()
+        service.cancel()
+        await asyncio.gather(service, return_exceptions=True)
+        return response
+
+    assert asyncio.run(run()) == b"response for example.com\r\n"
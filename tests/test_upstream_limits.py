@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+
+from uwhoisd import rl
+
+from . import utils
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("", rl.Limits()),
+        ("rate=10", rl.Limits(rate=10.0, burst=10)),
+        ("rate=0.5", rl.Limits(rate=0.5, burst=1)),
+        ("rate=2 burst=5 connections=3 queue=0", rl.Limits(2.0, 5, 3, 0)),
+        ("connections=4", rl.Limits(connections=4)),
+    ],
+)
+def test_parse_limits(value, expected):
+    assert rl.parse_limits(value) == expected
+
+
+def test_parse_limits_unknown():
+    with pytest.raises(ValueError, match="Unknown upstream limit: 'speed'"):
+        rl.parse_limits("speed=11")
+
+
+@pytest.mark.parametrize(
+    ("limits", "parts", "expected"),
+    [
+        (rl.Limits(2.0, 5, 3, 0), 1, rl.Limits(2.0, 5, 3, 0)),
+        (rl.Limits(10.0, 20, 8, 128), 4, rl.Limits(2.5, 5, 2, 32)),
+        (rl.Limits(1.0, 1, 3, 16), 4, rl.Limits(0.25, 1, 1, 4)),
+        (rl.Limits(), 2, rl.Limits(burst=1, queue=8)),
+    ],
+)
+def test_partition_limits(limits, parts, expected):
+    assert rl.partition_limits(limits, parts) == expected
+
+
+def test_limiter_lookup():
+    # Upstreams are made within the event loop, as on Python 3.9 their
+    # semaphores are tied to the loop current when they're made.
+    async def run():
+        limiter = rl.UpstreamLimiter(
+            {
+                "whois.verisign-grs.com": rl.Limits(connections=8),
+                "uk": rl.Limits(connections=2),
+            }
+        )
+        assert limiter.get_upstream("whois.example.com") is None
+        assert limiter.get_upstream("whois.verisign-grs.com", "com").name == "whois.verisign-grs.com"
+        # Servers for a zone share the zone's limits.
+        upstream = limiter.get_upstream("whois.nic.uk", "uk")
+        assert upstream.name == "uk"
+        assert limiter.get_upstream("whois.example.uk", "uk") is upstream
+
+        limiter = rl.UpstreamLimiter({"default": rl.Limits(connections=1)})
+        assert limiter.get_upstream("whois.example.com").name == "whois.example.com"
+        assert limiter.get_upstream("whois.example.net") is not limiter.get_upstream("whois.example.com")
+
+    asyncio.run(run())
+
+
+def test_idle_upstreams_evicted():
+    limiter = rl.UpstreamLimiter({"default": rl.Limits(connections=1)})
+
+    async def query(server):
+        async with limiter.slot(server):
+            pass
+
+    async def run():
+        for i in range(200):
+            await query(f"x{i}.zzzz.whois-servers.net")
+
+    asyncio.run(run())
+    # Each was swept once it was done with.
+    assert len(limiter) == 1
+
+
+def test_busy_upstreams_kept():
+    limiter = rl.UpstreamLimiter({"default": rl.Limits(connections=1)}, max_upstreams=2)
+
+    async def run():
+        async with limiter.slot("whois.example.com"):
+            for i in range(200):
+                limiter.get_upstream(f"x{i}.zzzz.whois-servers.net")
+                limiter.get_upstream("whois.example.com")
+            assert "whois.example.com" in limiter.upstreams
+            assert len(limiter) == 2
+
+    asyncio.run(run())
+
+
+def test_concurrency_cap():
+    limiter = rl.UpstreamLimiter({"default": rl.Limits(connections=2, queue=10)})
+    active = []
+    peak = 0
+
+    async def query():
+        nonlocal peak
+        async with limiter.slot("whois.example.com"):
+            active.append(None)
+            peak = max(peak, len(active))
+            await asyncio.sleep(0)
+            active.pop()
+
+    async def run():
+        await asyncio.gather(*(query() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2
+
+
+def test_fail_fast():
+    limiter = rl.UpstreamLimiter({"default": rl.Limits(connections=1, queue=1)})
+
+    async def query(release):
+        async with limiter.slot("whois.example.com"):
+            await release.wait()
+
+    async def run():
+        release = asyncio.Event()
+        first = asyncio.ensure_future(query(release))
+        await asyncio.sleep(0)
+        # This one waits...
+        second = asyncio.ensure_future(query(release))
+        await asyncio.sleep(0)
+        # ...but there's no room in the queue for this one.
+        with pytest.raises(rl.RateLimitedError, match="Rate limit exceeded for whois.example.com"):
+            await query(release)
+        release.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(run())
+
+
+def test_rate(monkeypatch):
+    clock = utils.Clock()
+    monkeypatch.setattr(rl.TokenBucket, "clock", staticmethod(clock))
+    limiter = rl.UpstreamLimiter({"default": rl.Limits(rate=1, burst=2, queue=0)})
+
+    async def query():
+        async with limiter.slot("whois.example.com"):
+            pass
+
+    async def run():
+        await query()
+        await query()
+        with pytest.raises(rl.RateLimitedError):
+            await query()
+        clock.ticks += 1
+        await query()
+
+    asyncio.run(run())
+
+
+def test_rate_queueing():
+    limiter = rl.UpstreamLimiter({"default": rl.Limits(rate=200, burst=1, queue=5)})
+    done = []
+
+    async def query(i):
+        async with limiter.slot("whois.example.com"):
+            done.append(i)
+
+    async def run():
+        await asyncio.gather(*(query(i) for i in range(3)))
+
+    asyncio.run(run())
+    assert sorted(done) == [0, 1, 2]
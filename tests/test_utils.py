@@ -1,3 +1,5 @@
+import ipaddress
+
 import pytest
 
 from uwhoisd import utils
@@ -26,6 +28,25 @@ def test_malformed_domains(fqdn):
     assert not utils.is_well_formed_fqdn(fqdn)
 
 
+@pytest.mark.parametrize("query", ["stereochro.me", "192.0.2.1", "2001:db8::1", "192.0.2.0/24", "2001:db8::/32"])
+def test_is_well_formed_query(query):
+    assert utils.is_well_formed_query(query)
+
+
+@pytest.mark.parametrize("query", ["stereochrome", "192.0.2.0/33", "2001:db8::1::1", "::ffff:192.0.2.1.5"])
+def test_malformed_queries(query):
+    assert not utils.is_well_formed_query(query)
+
+
+def test_parse_address():
+    assert utils.parse_address("192.0.2.1") == ipaddress.ip_address("192.0.2.1")
+    assert utils.parse_address("2001:db8::1") == ipaddress.ip_address("2001:db8::1")
+    # Networks are parsed for their first address.
+    assert utils.parse_address("192.0.2.0/24") == ipaddress.ip_address("192.0.2.0")
+    assert utils.parse_address("192.0.2.7/24") == ipaddress.ip_address("192.0.2.0")
+    assert utils.parse_address("example.com") is None
+
+
 @pytest.mark.parametrize(
     ("to_split", "expected"),
     [
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import signal
+import socket
+import time
+
+import uwhoisd
+from uwhoisd import caching, server, workers
+
+from . import utils
+
+
+def test_partition_config():
+    cfg = {"type": "lru", "max_size": "1024", "max_bytes": "4096", "max_age": "300"}
+    assert caching.partition_config(cfg, 1) == cfg
+    assert caching.partition_config(cfg, 4) == {"type": "lru", "max_size": "256", "max_bytes": "1024", "max_age": "300"}
+    assert caching.partition_config({"max_size": "2"}, 4) == {"max_size": "1"}
+
+
+def test_bind():
+    sock = workers.bind("127.0.0.1", 0)
+    try:
+        assert not sock.getblocking()
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)
+    finally:
+        sock.close()
+
+
+def test_restart(tmp_path):
+    marker = tmp_path / "starts"
+
+    def target(index):
+        with marker.open("a") as fh:
+            fh.write(str(index))
+        return 3
+
+    supervisor = workers.Supervisor(1, target, restart_delay=0)
+    first = supervisor.spawn(7)
+    supervisor.reap()
+    # The dead worker was replaced.
+    assert first not in supervisor.children
+    assert len(supervisor.children) == 1
+    # The replacement takes over the dead worker's index.
+    assert next(iter(supervisor.children.values()))[0] == 7
+
+    # Let the replacement exit by itself, but don't replace it in turn.
+    supervisor.stopping = True
+    supervisor.reap()
+    assert supervisor.children == {}
+    assert marker.read_text() == "77"
+
+
+def test_stop():
+    def target(_index):
+        time.sleep(60)
+        return 0
+
+    supervisor = workers.Supervisor(2, target)
+    for index in range(2):
+        supervisor.spawn(index)
+    supervisor.stop()
+    assert supervisor.stopping
+    while supervisor.children:
+        supervisor.reap()
+    # Nothing was restarted.
+    assert supervisor.children == {}
+
+
+def test_worker_signals_reset():
+    r, w = os.pipe()
+
+    def target(_index):
+        os.close(r)
+        handler = signal.getsignal(signal.SIGTERM)
+        os.write(w, b"default" if handler == signal.SIG_DFL else b"other")
+        return 0
+
+    supervisor = workers.Supervisor(1, target)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    try:
+        supervisor.spawn(0)
+        os.close(w)
+        with os.fdopen(r, "rb") as fh:
+            assert fh.read() == b"default"
+        supervisor.stopping = True
+        supervisor.reap()
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def test_forward_sighup():
+    r, w = os.pipe()
+
+    def target(_index):
+        os.close(r)
+        ignored = signal.getsignal(signal.SIGHUP) == signal.SIG_IGN
+        received = []
+        signal.signal(signal.SIGHUP, lambda *_: received.append(True))
+        os.write(w, b"ignored" if ignored else b"default")
+        deadline = time.monotonic() + 10
+        while not received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        os.write(w, b" reloaded" if received else b" timed out")
+        return 0
+
+    supervisor = workers.Supervisor(1, target)
+    supervisor.spawn(0)
+    os.close(w)
+    with os.fdopen(r, "rb") as fh:
+        # Until the worker's ready for it, a SIGHUP is ignored.
+        assert fh.read(7) == b"ignored"
+        supervisor.forward()
+        assert fh.read() == b" reloaded"
+    supervisor.stopping = True
+    supervisor.reap()
+
+
+def test_stop_flushes_cache(monkeypatch, tmp_path):
+    r, w = os.pipe()
+    path = str(tmp_path / "cache.sqlite")
+    parser = utils.make_config_parser(os.path.join(utils.HERE, "..", "extra", "uwhoisd.ini"))
+    parser.set("uwhoisd", "iface", "127.0.0.1")
+    parser.set("uwhoisd", "port", "0")
+    parser.set("http", "port", "0")
+    parser.set("metrics", "port", "0")
+    parser.set("cache", "type", "sqlite")
+    parser.set("cache", "path", path)
+    uwhois = utils.create_uwhois()
+
+    def slow_cache(cfg):
+        del cfg["type"]
+        cache = caching.SQLite(**cfg)
+        # Hold up the writer so the entry's still queued when the worker's
+        # told to stop.
+        cache.writer.submit(time.sleep, 0.5)
+        cache.set("example.com", "cached")
+        return cache
+
+    async def start_service(*_args, **_kwargs):
+        os.write(w, b"ready")
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(caching, "get_cache", slow_cache)
+    monkeypatch.setattr(server, "start_service", start_service)
+
+    supervisor = workers.Supervisor(1, lambda _index: uwhoisd.serve(parser, uwhois))
+    supervisor.spawn(0)
+    os.close(w)
+    with os.fdopen(r, "rb") as fh:
+        assert fh.read(5) == b"ready"
+        supervisor.stop()
+    while supervisor.children:
+        supervisor.reap()
+
+    cache = caching.SQLite(path)
+    try:
+        assert cache.get("example.com") == "cached"
+    finally:
+        cache.close()
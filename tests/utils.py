@@ -1,8 +1,12 @@
 """Utility functions for testing."""
 
+import asyncio
+import collections
 from os import path
+import socket
 
 import uwhoisd
+from uwhoisd import client, health
 from uwhoisd.utils import make_config_parser
 
 HERE = path.dirname(__file__)
@@ -19,6 +23,92 @@ class Clock:
         return self.ticks
 
 
+class Upstream:
+    """A fake upstream WHOIS function.
+
+    Queries are recorded, and wait until `release` is set. Those for names
+    under 'timeout.' time out, those under 'down.' find the upstream
+    unavailable, and those under 'unresolvable.' can't find the upstream. The
+    most queries in flight at once is tracked, both in total and for each
+    upstream.
+
+    The release event is only made once it's first needed, so that it's made
+    within the running event loop, as Python 3.9 ties it to the event loop
+    current when it's made.
+    """
+
+    def __init__(self, response="response for {query}", route=str, *, released=False, delay=0.0):
+        super().__init__()
+        self.response = response
+        self.route = route
+        self.delay = delay
+        self.released = released
+        self.calls = []
+        self._release = None
+        self.error = None
+        self.active = collections.Counter()
+        self.peak = collections.Counter()
+        self.peak_total = 0
+
+    @property
+    def release(self):
+        if self._release is None:
+            self._release = asyncio.Event()
+            if self.released:
+                self._release.set()
+        return self._release
+
+    async def __call__(self, query):
+        self.calls.append(query)
+        upstream = self.route(query)
+        self.active[upstream] += 1
+        self.peak[upstream] = max(self.peak[upstream], self.active[upstream])
+        self.peak_total = max(self.peak_total, sum(self.active.values()))
+        try:
+            await self.release.wait()
+            if self.delay:
+                await asyncio.sleep(self.delay)
+        finally:
+            self.active[upstream] -= 1
+        if self.error is not None:
+            raise self.error
+        if query.startswith("timeout."):
+            raise client.UpstreamTimeoutError
+        if query.startswith("down."):
+            raise health.UnavailableError((upstream, 43))
+        if query.startswith("unresolvable."):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return self.response.format(query=query)
+
+    async def stream(self, query):
+        """Stream the response in two halves, the second once released."""
+        self.calls.append(query)
+        response = self.response.format(query=query).encode()
+        yield response[: len(response) // 2]
+        await self.release.wait()
+        yield response[len(response) // 2 :]
+
+
+class FakeWhoisServer:
+    """A fake WHOIS server, answering connections with `handle`."""
+
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+        self.server = None
+
+    async def handle(self, reader, writer):
+        raise NotImplementedError
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, host="127.0.0.1", port=0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+
+
 def create_uwhois() -> uwhoisd.UWhois:
     """Prepare a UWhois object for testing."""
     config = path.join(HERE, "..", "extra", "uwhoisd.ini")